@@ -2,11 +2,10 @@ import asyncio
 import logging
 import sys, os, time, yaml, json, random
 from datetime import datetime
-import subprocess
-from captureworker import CaptureWorker
+import threading
+from captureworker import CaptureWorker, switch_canon_to_liveview
 import cv2
 from PIL import Image, ImageFont, ImageDraw
-import qrcode
 import numpy as np
 import zc.lockfile
 from PyQt6 import QtCore, QtWidgets
@@ -14,10 +13,24 @@ from PyQt6.QtCore import QThread, pyqtSignal, pyqtSlot, QTimer
 from PyQt6.QtGui import QImage, QPixmap, QIcon, QFontDatabase, QColor
 from PyQt6.QtWidgets import QApplication, QMainWindow
 from MainWindow import Ui_MainWindow
+from backgroundCache import BackgroundCache
 from cameraInitializer import CameraInitializer
-from collageBuilder import CollageRenderer
+from collageBuilder import IncrementalCollage
+from collageTemplates import TemplateRegistry, THUMBNAIL_SIZE
+from streamPipeline import LiveViewTransform, FrameMailbox, FramePacer, FrameStats
 import share_gdrive
-from list_cameras import list_stream_cameras
+import galleryServer
+import cameraSession
+import captureIndex
+import derivatives
+import filters
+import imageCache
+import tracing
+from printQueue import PrintQueue
+from qrCode import make_qr_image
+from fileWatcher import wait_for_complete_file
+import list_cameras
+from mjpegLiveView import MjpegLiveView
 from settings_button import SettingsButton
 import globals
 import resources_rc
@@ -25,94 +38,239 @@ import resources_rc
 # prevent application from running twice
 lock = zc.lockfile.LockFile('lock')
 
-def switch_canon_to_liveview():
-    # only do this if we use a Canon M3
-    if globals.CURRENT_CAMERA is not None and "Canon" in globals.CURRENT_CAMERA and "M3" in globals.CURRENT_CAMERA:
-        # canon eos m3 goes to picture playback on usb connect and after taking images
-        # this function resets it to shooting mode/liveview
-        # install chdk on your sd card and run this command gphoto2 --set-config chdk=On
-        p =subprocess.Popen(["gphoto2", "--capture-movie", "--stdout"], stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
-        p.communicate()
-        time.sleep(0.1)
-        p.kill()
+def share_file(file_name):
+    # uploads use the share sized copy, the original if it can not be made
+    return derivatives.PIPELINE.get(file_name, "share", timeout=30) or file_name
 
 class UploadThread(QThread):
     changePixmap = pyqtSignal(QImage)
+    failed = pyqtSignal(str)
+    TIMEOUT_SECONDS = 120
 
     def run(self):
-        # share file via link
+        with tracing.TRACER.span("share", derivatives.capture_id(globals.FILE_NAME), backend=globals.SETTINGS["SHARE_BACKEND"]):
+            self.share()
+
+    def share(self):
+        if globals.SETTINGS["SHARE_BACKEND"] == "gdrive":
+            link = self.upload()
+        elif galleryServer.SERVER is not None:
+            # the photo is served by the booth itself, guests only need to be in its hotspot
+            link = galleryServer.SERVER.url_for(globals.FILE_NAME)
+        else:
+            logging.error("Sharing failed: gallery server is not running")
+            self.failed.emit("Teilen ist leider nicht verfügbar")
+            return
+        if link is None:
+            return
+        logging.info(f"Image shared as {link}")
+        if captureIndex.INDEX is not None:
+            captureIndex.INDEX.record_share(globals.FILE_NAME, link)
+
+        # create qr code for image
+        img = make_qr_image(link)
+        qt_img = QImage(img.data, img.shape[1], img.shape[0], img.shape[1]*img.shape[2], QImage.Format.Format_RGB888)
+        self.changePixmap.emit(qt_img)
+
+    def upload(self):
+        # share file via link, usually the photo was already uploaded after capture
+        if share_gdrive.QUEUE is None:
+            logging.error("Upload failed: Google Drive is not set up")
+            self.failed.emit("Teilen ist leider nicht verfügbar")
+            return
         try:
-            file_id = share_gdrive.upload_image(globals.FILE_NAME)
-            link = share_gdrive.share_image(file_id)
-            logging.info(f"Image uploaded to {link}")
-
-            # create qr code for image
-            qr = qrcode.QRCode(
-                version=1,
-                error_correction=qrcode.constants.ERROR_CORRECT_L,
-                box_size=10,
-                border=4,
-            )
-            qr.add_data(link)
-            qr.make(fit=True)
-
-            img = qr.make_image(fill_color=(247, 244, 183), back_color=(42, 49, 65))
-            img = np.array(img.resize((600,600), Image.NEAREST))
-            qt_img = QImage(img.data, img.shape[1], img.shape[0], img.shape[1]*img.shape[2], QImage.Format.Format_RGB888)
-            self.changePixmap.emit(qt_img)
-        except:
-            logging.error("Upload failed")
+            link = share_gdrive.QUEUE.wait_for_link(globals.FILE_NAME, self.TIMEOUT_SECONDS)
+        except share_gdrive.UploadError as e:
+            logging.error(f"Upload failed: {e}")
+            self.failed.emit("Download leider fehlgeschlagen.\nBitte später nochmal versuchen")
+            return
+        return link
 
 class StreamThread(QThread):
-    changePixmap = pyqtSignal(QImage)
+    # Live view of the photo page. Runs only while the photo page is shown, the capture
+    # device stays open in between so live view resumes without reopening it. Frames are
+    # handed over in a FrameMailbox, frameReady is emitted when the GUI has to pick one up.
+    frameReady = pyqtSignal()
+    TARGET_FPS = 25
+    PREVIEW_RECHECK_SECONDS = 1.0
+    FLUSH_FRAMES = 4                                        # frames the driver may have queued while paused
+    STALE_FRAME_SECONDS = 0.005                             # a grab this fast returned a queued frame
+    DISPLAY_HEIGHT = 840                                    # height of the live view on screen
+    DEFAULT_FRAME_SIZE = (840, 525)                         # requested where no mode can be negotiated
+    REOPEN_SECONDS = 5.0                                    # retry interval of a capture device that did not open
 
-    def run(self):
-        #height, width, channel = 720, 1280, 3
-        height, width, channel = 525, 840, 3
-        scale = 1.6
-        cropped_width = int(3*height/2)                     #crop black borders of 16:9 monitor
-        width_to_crop = width-cropped_width
-        scaled_width = int(cropped_width*scale)
-        scaled_height = int(height*scale)
-        
-        cap = cv2.VideoCapture(globals.SETTINGS["CAMERA_INDEX"])
-        cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
-        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
-        cap.set(cv2.CAP_PROP_FPS, 25)
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.mailbox = FrameMailbox()
+        self.active = threading.Event()
+        self.resumed_at = None
+        self.mode = None
+        self.preview = None                                 # the preview image that was delivered last
+
+    def set_active(self, active):
+        if active == self.active.is_set():
+            return
+        if active:
+            self.resumed_at = time.monotonic()
+            self.active.set()
+        else:
+            self.active.clear()
+        globals.STREAM_CHANGED.set()                        # wakes a waiting preview
+
+    def counters(self) -> dict:
+        counters = self.mailbox.counters()
+        counters["active"] = self.active.is_set()
+        counters["mode"] = str(self.mode)
+        return counters
+
+    def deliver(self, image, buffer, captured_at):
+        if self.mailbox.post(image, buffer, captured_at):
+            self.frameReady.emit()
+
+    def flush(self, cap):
+        # frames queued in the driver while paused are old, they are skipped without decoding
+        for _ in range(self.FLUSH_FRAMES):
+            start = time.monotonic()
+            if not cap.grab() or time.monotonic() - start > self.STALE_FRAME_SECONDS:
+                break
+
+    def open_stream(self):
+        # returns the opened capture, the mode it delivers and the transform to the display size
+        if globals.SETTINGS["LIVEVIEW_SOURCE"] == "gphoto2" or globals.SETTINGS["LIVEVIEW_FILE"]:
+            # frame size is only known from the first frame, the transform adapts to it
+            cap = MjpegLiveView(file=globals.SETTINGS["LIVEVIEW_FILE"] or None, fps=self.TARGET_FPS)
+            mode = list_cameras.CaptureMode("MJPG", *self.DEFAULT_FRAME_SIZE, self.TARGET_FPS)
+            logging.info(f"Live view from {globals.SETTINGS['LIVEVIEW_FILE'] or 'gphoto2'}")
+            return cap, mode, LiveViewTransform(mode.width, mode.height, self.DISPLAY_HEIGHT / mode.height)
+        devices = list_cameras.probe_devices()
+        device = list_cameras.select_device(devices, globals.SETTINGS["CAMERA_INDEX"])
+        if device is None:
+            logging.warning("No V4L2 capture device found. Opening camera index without negotiating a mode")
+            cap, mode = list_cameras.open_capture(None, None, max(0, globals.SETTINGS["CAMERA_INDEX"]))
+            cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.DEFAULT_FRAME_SIZE[0])
+            cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.DEFAULT_FRAME_SIZE[1])
+            cap.set(cv2.CAP_PROP_FPS, self.TARGET_FPS)
+            mode.width, mode.height = self.DEFAULT_FRAME_SIZE    # corrected by the transform if the device ignores it
+        else:
+            wanted = list_cameras.choose_mode(device.modes, self.DISPLAY_HEIGHT, self.TARGET_FPS, device.bus_budget())
+            cap, mode = list_cameras.open_capture(device, wanted)
+            logging.info(f"Live view from {device}: requested {wanted}, negotiated {mode}")
+        if not cap.isOpened() or mode.width <= 0 or mode.height <= 0:
+            # e.g. the device is gone or busy: reads fail and back off until it is opened again
+            logging.warning(f"Capture device did not open (reports {mode}). Retrying every {self.REOPEN_SECONDS:g} s")
+            mode.width, mode.height = self.DEFAULT_FRAME_SIZE
+        # frames are scaled to the display, whatever size the device delivers
+        transform = LiveViewTransform(mode.width, mode.height, self.DISPLAY_HEIGHT / mode.height)
+        return cap, mode, transform
 
+    def run(self):
+        cap, mode, transform = self.open_stream()
+        self.mode = mode
+        derivatives.PIPELINE.preview_size = (transform.scaled_width, transform.scaled_height)
+        pacer = FramePacer(self.TARGET_FPS)
+        stats = FrameStats(f"Live view {mode}")
+        reopen_at = time.monotonic() + self.REOPEN_SECONDS
+
+        frame = None
+        shown_preview = None
         while True:
-            ret, frame = cap.read()
-            if not ret:
+            if not self.active.is_set():
+                logging.info(f"Live view paused. {stats.summary()}")
+                self.active.wait()
+                self.flush(cap)
+                stats.reset()
+                shown_preview = None
+
+            globals.STREAM_CHANGED.clear()
+            if globals.FREEZE_STREAM:
+                # the preview is decoded once, afterwards we sleep until something changes
+                shown_preview = self.showPreview(shown_preview, transform.scaled_width, transform.scaled_height)
+                globals.STREAM_CHANGED.wait(self.PREVIEW_RECHECK_SECONDS)
                 continue
+            shown_preview = None
 
-            if not globals.FREEZE_STREAM:
-                frame = frame[:,int(width_to_crop/2):int(width-(width_to_crop/2)),:].copy()
-            elif os.path.isfile(globals.FILE_NAME):
-                frame = cv2.imread(globals.FILE_NAME)
-                # collages are saved "unflipped"! -> Flip twice here
-                # if "collage" in globals.FILE_NAME:
-                #     frame = cv2.flip(frame, 1)
-            else:
+            pacer.wait_for_next_frame()
+            ret, frame = cap.read(frame)                    # reuse the buffer of the last frame
+            if not ret:
+                frame = None
+                pacer.read_failed()
+                if not cap.isOpened() and time.monotonic() >= reopen_at:
+                    cap.release()
+                    cap, mode, transform = self.open_stream()
+                    self.mode = mode
+                    derivatives.PIPELINE.preview_size = (transform.scaled_width, transform.scaled_height)
+                    reopen_at = time.monotonic() + self.REOPEN_SECONDS
                 continue
-            
-            frame = cv2.flip(frame, 1)
-            rgbImage = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            rgbImage_resized = cv2.resize(rgbImage, (scaled_width, scaled_height), interpolation = cv2.INTER_AREA)
-            convertToQtFormat = QImage(rgbImage_resized.data, scaled_width, scaled_height, channel*scaled_width, QImage.Format.Format_RGB888)
-            self.changePixmap.emit(convertToQtFormat)
+            pacer.read_succeeded()
+            captured_at = time.monotonic()
+
+            rgbImage = transform.apply(frame, self.mailbox.busy())
+            look = filters.ENGINE.look()
+            if look is not None:
+                filters.ENGINE.apply_live(look, rgbImage)
+            stats.add(time.monotonic() - captured_at)
+            self.deliver(rgbImage, transform.last_output, captured_at)
+            if self.resumed_at is not None:
+                logging.info(f"Live view resumed, first frame after {1000*(captured_at - self.resumed_at):.0f} ms")
+                self.resumed_at = None
+
+    def showPreview(self, shown_preview, width, height):
+        # returns an identifier of the preview that is currently shown
+        file_name = globals.FILE_NAME
+        if not wait_for_complete_file(file_name, self.PREVIEW_RECHECK_SECONDS):
+            return None                                     # file did not arrive yet
+        try:
+            preview_id = (file_name, os.stat(file_name).st_mtime_ns)
+        except OSError:
+            return None
+        if preview_id == shown_preview:
+            return shown_preview
+
+        start = time.monotonic()
+        # the derivative pipeline usually decoded the preview already
+        derivatives.PIPELINE.preview_size = (width, height)
+        preview = derivatives.PIPELINE.get(file_name, "preview", timeout=self.PREVIEW_RECHECK_SECONDS)
+        if preview is None or preview.shape[:2] != (height, width):
+            try:
+                preview = derivatives.make_preview(file_name, width, height, *derivatives.PIPELINE.source(file_name))
+            except OSError as e:
+                # deleted by the guest before it was shown
+                logging.warning(f"Unable to show preview of {file_name}: {e}")
+                return None
+        # collages are saved "unflipped"! -> Flip twice here
+        # if "collage" in file_name:
+        #     preview = cv2.flip(preview, 1)
+        logging.info(f"Preview of {file_name} ready in {1000*(time.monotonic()-start):.0f} ms")
+        tracing.TRACER.record("preview_decode", start, time.monotonic(), derivatives.capture_id(file_name))
+        self.preview = preview
+        self.deliver(preview, None, time.monotonic())
+        return preview_id
 
 
 class Window(QMainWindow, Ui_MainWindow):
     work_requested = pyqtSignal()
+    cancel_requested = pyqtSignal()
+    liveview_requested = pyqtSignal()
+    collage_rendered = pyqtSignal(str, str)
+    thumbnail_ready = pyqtSignal(str, str)
+    settings_changed = pyqtSignal(set)
+    DEFAULT_COLLAGE = "collage_3_by_2"
+    PHOTO_PAGE = 1
 
     def __init__(self, parent=None):
         super().__init__(parent)
 
         self.loadSettings()
         self.setupUi(self)
+        self.thumbnail_ready.connect(self.setTemplateThumbnail)
+        self.background = BackgroundCache(self)
+        for page in (self.start_page, self.photo_page, self.download_page, self.setup_page, self.collage_page):
+            self.background.add_page(page)
         self.loadBackgroundImage()
         self.loadCollageImages()
         self.refreshWelcomeText()
+        self.applyWelcomeTextColor()
+        self.applyImageBorder()
         self.setRecaptureMode()
         self.overlay_buttons_on_stream()
 
@@ -130,6 +288,8 @@ class Window(QMainWindow, Ui_MainWindow):
         self.timer.setInterval(1000)
         self.timer.timeout.connect(self.refreshWelcomeText)
         self.timer.start()
+        self.settings_changed.connect(self.applySettings)
+        globals.SETTINGS.subscribe(self.settings_changed.emit)
 
         self.hidden_settings.longclicked.connect(self.settingsClicked)
         self.start_button.clicked.connect(self.startButtonClicked)
@@ -144,6 +304,7 @@ class Window(QMainWindow, Ui_MainWindow):
         self.shutdown_button.clicked.connect(self.shutdown)
         self.open_button.clicked.connect(self.openFileDialog)
         self.templateListWidget.itemClicked.connect(self.templateSelected)
+        self.collage_rendered.connect(self.on_collage_rendered)
 
         # start capture worker
         self.worker = CaptureWorker()
@@ -153,52 +314,73 @@ class Window(QMainWindow, Ui_MainWindow):
         self.worker.preview_finished.connect(self.on_preview_finished)
         self.worker.capture_error.connect(self.capture_error)
         self.work_requested.connect(self.worker.run)
+        self.cancel_requested.connect(self.worker.cancel_countdown)
+        self.liveview_requested.connect(self.worker.switch_to_liveview)
+        self.worker.liveview_ready.connect(self.on_liveview_ready)
         self.worker.moveToThread(self.worker_thread)
         self.worker_thread.start()
 
+        self.print_queue = PrintQueue(globals.SETTINGS["PRINTER_NAME"])
+        imageCache.CACHE.set_budget(globals.SETTINGS["IMAGE_CACHE_MB"] * 2**20)
+        captureIndex.open_index(globals.SETTINGS["TARGET_DIR"])
+
         # start streaming thread
-        th = StreamThread(self)
-        th.changePixmap.connect(self.setImage)
-        th.start()
+        self.stream_thread = StreamThread(self)
+        self.stream_thread.frameReady.connect(self.showStreamFrame)
+        self.stackedWidget.currentChanged.connect(self.pageChanged)
+        self.pageChanged(self.stackedWidget.currentIndex())
+        self.stream_thread.start()
 
         # start web server hosting images
-        if globals.SETTINGS["SHOW_SHARE"]:
-            share_gdrive.get_credentials()
+        if globals.SETTINGS["SHOW_SHARE"] and globals.SETTINGS["SHARE_BACKEND"] == "gdrive":
+            share_gdrive.get_credentials(globals.SETTINGS["DRIVE_API_ENDPOINT"] or None, share_file)
+        elif globals.SETTINGS["SHOW_SHARE"]:
+            galleryServer.start_server(globals.SETTINGS["TARGET_DIR"], globals.SETTINGS["GALLERY_PORT"], globals.SETTINGS["GALLERY_HOST"] or None)
 
     def loadBackgroundImage(self):
-        style = "QWidget#start_page{border-image: url(:/files/%s) 0 0 0 0 stretch stretch;}" %globals.SETTINGS["BACKGROUND_IMAGE"]
-        self.start_page.setStyleSheet(style)
-        style = "QWidget#photo_page{border-image: url(:/files/%s) 0 0 0 0 stretch stretch;}" %globals.SETTINGS["BACKGROUND_IMAGE"]
-        self.photo_page.setStyleSheet(style)
-        style = "QWidget#download_page{border-image: url(:/files/%s) 0 0 0 0 stretch stretch;}" %globals.SETTINGS["BACKGROUND_IMAGE"]
-        self.download_page.setStyleSheet(style)
-        style = "QWidget#setup_page{border-image: url(:/files/%s) 0 0 0 0 stretch stretch;}" %globals.SETTINGS["BACKGROUND_IMAGE"]
-        self.setup_page.setStyleSheet(style)
-        style = "QWidget#collage_page{border-image: url(:/files/%s) 0 0 0 0 stretch stretch;}" %globals.SETTINGS["BACKGROUND_IMAGE"]
-        self.collage_page.setStyleSheet(style)
+        # all pages paint the same background, decoded once and scaled once per page size
+        self.background.set_image(":/files/%s" %globals.SETTINGS["BACKGROUND_IMAGE"])
 
     def loadCollageImages(self):
         self.templateListWidget.clear()
-
-        # read images from collage directory
-        dir_path = os.path.dirname(os.path.realpath(__file__))
-        collages_path = os.path.join(dir_path, "ui", "collages")
-        files = os.listdir(collages_path)
-        for f in files:
-            if f.endswith(".png"):
-                item = QtWidgets.QListWidgetItem()
-                item.setText(f[:-4])
-                item.setForeground(QColor(247, 244, 183))
-                icon = QIcon()
-                icon.addPixmap(QPixmap(os.path.join(collages_path, f)), QIcon.Mode.Normal, QIcon.State.Off)
-                item.setIcon(icon)
-                self.templateListWidget.addItem(item)
-        self.templateListWidget.setIconSize(QtCore.QSize(540, 360))
+        self.templates = TemplateRegistry()
+
+        # thumbnails are read from the cache or created in the background and set when ready
+        for layout in self.templates.scan():
+            item = QtWidgets.QListWidgetItem()
+            item.setText(layout.name)
+            item.setForeground(QColor(247, 244, 183))
+            self.templateListWidget.addItem(item)
+            self.templates.thumbnail(layout).add_done_callback(
+                lambda f, name=layout.name: self.thumbnail_ready.emit(name, "" if f.exception() else f.result()))
+        self.templateListWidget.setIconSize(QtCore.QSize(*THUMBNAIL_SIZE))
+
+    def setTemplateThumbnail(self, name, thumbnail_path):
+        if not thumbnail_path:
+            logging.error(f"Unable to create thumbnail for collage template {name}")
+            return
+        for item in self.templateListWidget.findItems(name, QtCore.Qt.MatchFlag.MatchExactly):
+            icon = QIcon()
+            icon.addPixmap(QPixmap(thumbnail_path), QIcon.Mode.Normal, QIcon.State.Off)
+            item.setIcon(icon)
+
+    def startCollage(self, layout):
+        # the template is loaded in the background while the first photo is shot
+        globals.CAPTURE_MODE = globals.CaptureMode.COLLAGE
+        globals.CURRENT_COLLAGE = layout.to_collage()
+        self.collage_file_name = None
+        self.collage_job = IncrementalCollage(globals.CURRENT_COLLAGE, self.templates.load_template(layout))
 
     def refreshWelcomeText(self):
+        # runs every second, only the text is touched and only if it changed
         message_and_time = datetime.now().strftime("%A %d. %b %Y   %H:%M")+"\n"+globals.SETTINGS["WELCOME_MESSAGE"]
-        self.welcome_message.setText(message_and_time)
+        if self.welcome_message.text() != message_and_time:
+            self.welcome_message.setText(message_and_time)
+
+    def applyWelcomeTextColor(self):
         self.welcome_message.setStyleSheet(f"color: {globals.SETTINGS['WELCOME_TEXT_COLOR']};")
+
+    def applyImageBorder(self):
         self.stream.setStyleSheet(f"border: 5px solid {globals.SETTINGS['IMAGE_BORDER_COLOR']};")
 
     def setRecaptureMode(self):
@@ -216,11 +398,12 @@ class Window(QMainWindow, Ui_MainWindow):
         self.photo_page_grid.addItem(spacer, 0, 2, 0, 1)
         self.photo_page_grid.addLayout(self.photo_page_buttons, 4, 0, 1, 1)
 
-        if globals.SETTINGS["SHOW_BUTTON_TEXT"]:
-            self.home_button.setToolButtonStyle(QtCore.Qt.ToolButtonTextUnderIcon)
-            self.delete_button.setToolButtonStyle(QtCore.Qt.ToolButtonTextUnderIcon)
-            self.download_button.setToolButtonStyle(QtCore.Qt.ToolButtonTextUnderIcon)
-            self.print_button.setToolButtonStyle(QtCore.Qt.ToolButtonTextUnderIcon)
+        self.applyButtonText()
+
+    def applyButtonText(self):
+        style = QtCore.Qt.ToolButtonStyle.ToolButtonTextUnderIcon if globals.SETTINGS["SHOW_BUTTON_TEXT"] else QtCore.Qt.ToolButtonStyle.ToolButtonIconOnly
+        for button in (self.home_button, self.delete_button, self.download_button, self.print_button):
+            button.setToolButtonStyle(style)
 
     def showImageControlButtons(self, visible):
         if visible:                          
@@ -239,9 +422,22 @@ class Window(QMainWindow, Ui_MainWindow):
             self.capture_button.setEnabled(False)
         self.show()
 
-    @pyqtSlot(QImage)
-    def setImage(self, image):
-        self.stream.setPixmap(QPixmap.fromImage(image))
+    @pyqtSlot()
+    def showStreamFrame(self):
+        # only the newest frame is shown, older ones were dropped by the mailbox
+        frame = self.stream_thread.mailbox.take()
+        if frame is None:
+            return
+        image, captured_at = frame
+        height, width = image.shape[:2]
+        self.stream.setPixmap(QPixmap.fromImage(QImage(image.data, width, height, 3*width, QImage.Format.Format_RGB888)))
+        self.stream_thread.mailbox.release(captured_at)
+        if image is self.stream_thread.preview and tracing.TRACER.end("preview", derivatives.capture_id(globals.FILE_NAME)) is not None:
+            tracing.TRACER.end_session(derivatives.capture_id(globals.FILE_NAME))
+
+    def pageChanged(self, index):
+        # live view only runs on the photo page
+        self.stream_thread.set_active(index == self.PHOTO_PAGE)
 
     def capture_error(self, error):
         logging.error(f"Error during image capture process. Returning to home screen. Error: {error}")
@@ -259,12 +455,11 @@ class Window(QMainWindow, Ui_MainWindow):
 
     def collageButtonClicked(self):
         logging.info("Start Collage clicked")
-        globals.CAPTURE_MODE = globals.CaptureMode.COLLAGE
-        globals.CURRENT_COLLAGE = globals.Collage("collage_3_by_2.png", [
-            globals.ImagePosition(1, globals.Coordinates(60, 118), 5, 583, globals.Size(505, 360)),
-            globals.ImagePosition(2, globals.Coordinates(60, 525), 356, 583, globals.Size(500, 350)),
-            globals.ImagePosition(3, globals.Coordinates(60, 922), 5, 583, globals.Size(505, 360)),
-        ])
+        layout = self.templates.get(self.DEFAULT_COLLAGE)
+        if layout is None:
+            logging.error(f"Collage template {self.DEFAULT_COLLAGE} is not available")
+            return
+        self.startCollage(layout)
         self.showImageControlButtons(False)
         self.stackedWidget.setCurrentIndex(1)
         self.capture_button.setEnabled(True)
@@ -273,24 +468,19 @@ class Window(QMainWindow, Ui_MainWindow):
     def templateSelected(self):
         logging.info("Template was selected")
         switch_canon_to_liveview()
-        dir_path = os.path.dirname(os.path.realpath(__file__))
-        template_path = os.path.join(dir_path, "ui","collages",self.templateListWidget.selectedItems()[0].text())
-        with open(template_path+"_positions.json") as f:
-            collage_dict = json.load(f)
-            template = cv2.imread(os.path.join(dir_path, "ui","collages", collage_dict["filename"]))
-            template = cv2.cvtColor(template, cv2.COLOR_BGR2RGB)
-            globals.SETTINGS["COLLAGE_TEMPLATE"] = template
-            globals.SETTINGS["COLLAGE_POSITIONS"] = collage_dict["images"]
-        globals.SETTINGS["COLLAGE_ID"] = 0
-        self.original_preview_time = globals.SETTINGS["PREVIEW_TIME_SECONDS"]
-        globals.SETTINGS["PREVIEW_TIME_SECONDS"] = 1                                   # only short preview during collag
+        self.startCollage(self.templates.get(self.templateListWidget.selectedItems()[0].text()))
+        globals.SESSION.collage_id = 0
+        globals.SESSION.preview_time_override = 1                           # only short preview during collage
 
         self.showImageControlButtons(False)
         self.capture_button.setEnabled(True)
         self.stackedWidget.setCurrentIndex(1)
 
     def captureButtonClicked(self):
-        globals.FREEZE_STREAM = False                                       # stops the preview
+        tracing.TRACER.start_session()
+        tracing.TRACER.instant("button")
+        self.worker.cancel_preview_timer()                                  # a recapture must not be sent home by the last preview
+        globals.set_freeze_stream(False)                                    # stops the preview
         self.showImageControlButtons(False)
         self.work_requested.emit()
 
@@ -304,6 +494,7 @@ class Window(QMainWindow, Ui_MainWindow):
             self.capture_button.setIcon(QIcon())
             self.capture_button.setText(str(secs_left))
             self.stream.setStyleSheet(f"border: 5px solid white")               # blinking border
+            QTimer.singleShot(500, self.applyImageBorder)
         elif secs_left == 0:                                                    # at capture
             logging.info("Countdown finished")
             self.capture_button.setText("Click")
@@ -316,27 +507,29 @@ class Window(QMainWindow, Ui_MainWindow):
         if globals.CAPTURE_MODE is not None and globals.CAPTURE_MODE is globals.CaptureMode.COLLAGE:
             logging.info("Collage Image Captured")
             # Set the image path of the current image in the collage at the correct position
-            globals.CURRENT_COLLAGE.images[globals.CURRENT_COLLAGE.currentImage].imagePath = globals.FILE_NAME
+            imagePosition = globals.CURRENT_COLLAGE.images[globals.CURRENT_COLLAGE.currentImage]
+            imagePosition.imagePath = globals.FILE_NAME
+            # composite this image in the background while the next one is shot
+            self.collage_job.add_image(imagePosition)
             
             # in case this was the last photo of the collage we need to save the collage
             if globals.CURRENT_COLLAGE.currentImage == len(globals.CURRENT_COLLAGE.images) - 1:
-                globals.FREEZE_STREAM = True
-                self.showImageControlButtons(True)
+                globals.set_freeze_stream(True)
                 self.capture_button.setEnabled(False)
                 self.renderImagesToCollage(globals.CURRENT_COLLAGE)
-                #globals.SETTINGS["PREVIEW_TIME_SECONDS"] = self.original_preview_time
-                logging.info("Collage Finished")
             else:
                 globals.CURRENT_COLLAGE.currentImage += 1
-                time.sleep(2)
-                switch_canon_to_liveview()
-                self.showImageControlButtons(False)
-                self.capture_button.setEnabled(True)
+                # the shot stays on screen for a moment, then the camera goes back to live view on the worker thread
+                QTimer.singleShot(2000, self.liveview_requested.emit)
         else:
             logging.info("Single Image Captured showing control buttons")
             self.showImageControlButtons(True)
-            
-            
+
+    def on_liveview_ready(self):
+        if globals.CAPTURE_MODE is not globals.CaptureMode.COLLAGE or self.stackedWidget.currentIndex() != self.PHOTO_PAGE:
+            return                                                          # guest already left
+        self.showImageControlButtons(False)
+        self.capture_button.setEnabled(True)
             
     def on_preview_finished(self):
         if globals.CAPTURE_MODE is not None and globals.CAPTURE_MODE is globals.CaptureMode.SINGLE and globals.SETTINGS["SHOW_RECAPTURE"] == False:
@@ -352,9 +545,36 @@ class Window(QMainWindow, Ui_MainWindow):
             
            
     def renderImagesToCollage(self, collage: globals.Collage):
-        renderer = CollageRenderer()
-        globals.FILE_NAME = os.path.join(globals.SETTINGS["TARGET_DIR"], "collage_%s.jpg" %datetime.now().strftime("%m%d%Y_%H%M%S"))
-        renderer.renderImagesToCollage(collage, globals.FILE_NAME)
+        # all images are already composited by the collage job, only the JPEG is left to write
+        file_name = os.path.join(globals.SETTINGS["TARGET_DIR"], "collage_%s.jpg" %datetime.now().strftime("%m%d%Y_%H%M%S"))
+        start = time.monotonic()
+        self.collage_file_name = file_name
+        rendering = self.collage_job.finish(file_name)
+        members = [imagePosition.imagePath for imagePosition in collage.images]
+        def rendered(f):
+            tracing.TRACER.record("collage_render", start, time.monotonic(), derivatives.capture_id(file_name), slots=len(members))
+            if f.exception() is not None:
+                logging.error(f"Rendering collage {file_name} failed: {f.exception()}")
+            if f.exception() is None and captureIndex.INDEX is not None:
+                captureIndex.INDEX.record_collage(file_name, members, f.result().duration)
+            self.collage_rendered.emit(file_name, str(f.exception() or ""))
+        rendering.add_done_callback(rendered)
+
+    def on_collage_rendered(self, file_name, error):
+        if globals.CAPTURE_MODE is not globals.CaptureMode.COLLAGE or file_name != self.collage_file_name:
+            return                                                          # guest already left
+        if error:
+            self.capture_error("Rendering the collage failed")
+            return
+        logging.info("Collage Finished")
+        globals.FILE_NAME = file_name
+        # no look: every slot was filtered while compositing, filtering again would apply it twice
+        derivatives.PIPELINE.submit(file_name)
+        if globals.SETTINGS["SPECULATIVE_UPLOAD"] and share_gdrive.QUEUE is not None:
+            share_gdrive.QUEUE.enqueue(file_name)
+        globals.set_freeze_stream(True)                                     # show the rendered collage as preview
+        self.showImageControlButtons(True)
+        self.capture_button.setEnabled(False)
         #load the collage template
         # collage_template = cv2.imread(os.path.join(os.path.dirname(__file__), "ui", "collages", collage.name))
         # collage_template = cv2.cvtColor(collage_template, cv2.COLOR_BGR2RGB)
@@ -378,15 +598,22 @@ class Window(QMainWindow, Ui_MainWindow):
 
     def homeButtonClicked(self):
         logging.info("Home Button pressed")
+        self.cancel_requested.emit()
         self.worker.cancel_preview_timer()
-        globals.FREEZE_STREAM = False                                       # stops eventually running preview countdown
-        globals.SETTINGS["COLLAGE_ID"] = None
+        globals.set_freeze_stream(False)                                    # stops eventually running preview countdown
+        globals.SESSION.collage_id = None
+        globals.SESSION.preview_time_override = None
         globals.CAPTURE_MODE = None
 
         self.stackedWidget.setCurrentIndex(0)
     
     def deleteButtonClicked(self):
         logging.info("Delete last Photo")
+        derivatives.PIPELINE.discard(globals.FILE_NAME)
+        if captureIndex.INDEX is not None:
+            captureIndex.INDEX.record_delete(globals.FILE_NAME)
+        if share_gdrive.QUEUE is not None:
+            share_gdrive.QUEUE.cancel(globals.FILE_NAME)
         try:
             os.remove(globals.FILE_NAME)
         except FileNotFoundError:
@@ -397,16 +624,16 @@ class Window(QMainWindow, Ui_MainWindow):
         logging.info("Printing photo")
         logging.info(f"Current Capture Mode: {globals.CAPTURE_MODE}")
         
-        args = ["lpr", "-P", globals.SETTINGS["PRINTER_NAME"]]
-        
+        options = []
         if globals.CAPTURE_MODE is not None and globals.CAPTURE_MODE is globals.CaptureMode.COLLAGE:
             # add argument to cut the image to the correct size
-            args.append("-o Cutter=2Inch")
-        
-        args.append(globals.FILE_NAME)
-        
-        printing = subprocess.Popen(args)
-        printing.communicate()
+            options += ["-o", "Cutter=2Inch"]
+
+        # printing continues in the background while the next guest can start
+        print_file = derivatives.PIPELINE.get(globals.FILE_NAME, "print", timeout=0) or globals.FILE_NAME
+        self.print_queue.submit(print_file, options, trace_id=derivatives.capture_id(globals.FILE_NAME))
+        if captureIndex.INDEX is not None:
+            captureIndex.INDEX.record_print(globals.FILE_NAME)
         self.homeButtonClicked()
         
 
@@ -428,6 +655,8 @@ class Window(QMainWindow, Ui_MainWindow):
 
         th = UploadThread(self)
         th.changePixmap.connect(self.insertQRCode)
+        th.failed.connect(self.instructions.setText)
+        th.finished.connect(th.deleteLater)                 # otherwise every share leaves a thread object behind
         th.start()
 
     def settingsClicked(self):
@@ -457,39 +686,6 @@ class Window(QMainWindow, Ui_MainWindow):
             self.collage_button.setVisible(value)
             self.collage_button.setEnabled(value)
 
-    def fillEmptySettingsWIthDefaults(self):
-     # check for empty settings and fill them with defaults according to the initialization of the SETTINGS object
-        if "WELCOME_MESSAGE" not in globals.SETTINGS:
-            globals.SETTINGS["WELCOME_MESSAGE"] = globals.DEFAULT_WELCOME_MESSAGE
-        if "TARGET_DIR" not in globals.SETTINGS:
-            globals.SETTINGS["TARGET_DIR"] = globals.DEFAULT_TARGET_DIR
-        if "COUNTDOWN_TIME_SECONDS" not in globals.SETTINGS:
-            globals.SETTINGS["COUNTDOWN_TIME_SECONDS"] = globals.DEFAULT_COUNTDOWN_TIME_SECONDS
-        if "PREVIEW_TIME_SECONDS" not in globals.SETTINGS:
-            globals.SETTINGS["PREVIEW_TIME_SECONDS"] = globals.DEFAULT_PREVIEW_TIME_SECONDS
-        if "SHOW_COLLAGE" not in globals.SETTINGS:
-            globals.SETTINGS["SHOW_COLLAGE"] = globals.DEFAULT_SHOW_COLLAGE
-        if "SHOW_DELETE" not in globals.SETTINGS:
-            globals.SETTINGS["SHOW_DELETE"] = globals.DEFAULT_SHOW_DELETE
-        if "SHOW_RECAPTURE" not in globals.SETTINGS:
-            globals.SETTINGS["SHOW_RECAPTURE"] = globals.DEFAULT_SHOW_RECAPTURE
-        if "SHOW_PRINT" not in globals.SETTINGS:
-            globals.SETTINGS["SHOW_PRINT"] = globals.DEFAULT_SHOW_PRINT
-        if "SHOW_SHARE" not in globals.SETTINGS:
-            globals.SETTINGS["SHOW_SHARE"] = globals.DEFAULT_SHOW_SHARE
-        if "SHOW_BUTTON_TEXT" not in globals.SETTINGS:
-            globals.SETTINGS["SHOW_BUTTON_TEXT"] = globals.DEFAULT_SHOW_BUTTON_TEXT
-        if "BACKGROUND_IMAGE" not in globals.SETTINGS:
-            globals.SETTINGS["BACKGROUND_IMAGE"] = globals.DEFAULT_BACKGROUND_IMAGE
-        if "CAMERA_INDEX" not in globals.SETTINGS:
-            globals.SETTINGS["CAMERA_INDEX"] = globals.DEFAULT_CAMERA_INDEX
-        if "COUNTDOWN_SOUND" not in globals.SETTINGS:
-            globals.SETTINGS["COUNTDOWN_SOUND"] = globals.DEFAULT_COUNTDOWN_SOUND
-        if "WELCOME_TEXT_COLOR" not in globals.SETTINGS:
-            globals.SETTINGS["WELCOME_TEXT_COLOR"] = globals.DEFAULT_WELCOME_TEXT_COLOR
-        if "IMAGE_BORDER_COLOR" not in globals.SETTINGS:
-            globals.SETTINGS["IMAGE_BORDER_COLOR"] = globals.DEFAULT_IMAGE_BORDER_COLOR
-
     def show_loading_spinner(self):
         self.loading_label.show()
         self.loading_movie.start()
@@ -500,45 +696,11 @@ class Window(QMainWindow, Ui_MainWindow):
 
 
     def loadSettings(self):
-        # load the settings from yaml to globals to use them as variables
-        wasEmptyFile = False
-
-        # check if settings file exists
-        if not os.path.isfile(os.path.join(os.path.dirname(__file__), "settings.yaml")):
-            logging.info("No settings file found. Creating default settings.")
-            with open(os.path.join(os.path.dirname(__file__), "settings.yaml"), "w") as outfile:
-                try:
-                    # fill SETTINGS with default values
-                    yaml.dump(globals.SETTINGS, outfile, default_flow_style=False)
-                except yaml.YAMLError as exc:
-                    logging.error(exc)
-
-        with open(os.path.join(os.path.dirname(__file__), "settings.yaml"), "r") as stream:
-            try:
-                globals.SETTINGS = yaml.safe_load(stream)
-            except yaml.YAMLError as exc:
-                logging.error(exc)
-
-        # in case of an empty settings file the SETTINGS object will be None
-        # Initialization of the values is done in fillEmptySettingsWIthDefaults
-        if globals.SETTINGS is None:
-            wasEmptyFile = True
-            globals.SETTINGS = {}
-
-        self.fillEmptySettingsWIthDefaults()
-
-        # if the settings file was empty we need to write the default values to the file
-        if wasEmptyFile:
-            with open(os.path.join(os.path.dirname(__file__), "settings.yaml"), "w") as outfile:
-                try:
-                    yaml.dump(globals.SETTINGS, outfile, default_flow_style=False)
-                except yaml.YAMLError as exc:
-                    logging.error(exc)
-
-        # init some variables
-        globals.SETTINGS["COLLAGE_TEMPLATE"] = None
-        globals.SETTINGS["COLLAGE_ID"] = None
+        # settings.yaml is read once, missing or invalid values are replaced by their defaults
+        globals.SETTINGS.load()
+        self.ensureTargetDir()
 
+    def ensureTargetDir(self):
         # create the target dir if necessary
         try:
             os.makedirs(globals.SETTINGS["TARGET_DIR"],exist_ok=True)
@@ -549,34 +711,56 @@ class Window(QMainWindow, Ui_MainWindow):
             logging.error(f"Using {globals.SETTINGS['TARGET_DIR']} instead")
 
     def saveSettings(self):
-        global SETTINGS
-
-        globals.SETTINGS["WELCOME_MESSAGE"] = self.lineEdit_welcome_message.text()
-        globals.SETTINGS["TARGET_DIR"] = self.lineEdit_target_dir.text()
-        globals.SETTINGS["COUNTDOWN_TIME_SECONDS"] = self.spinBox_countdown_time.value()
-        globals.SETTINGS["PREVIEW_TIME_SECONDS"] = self.spinBox_preview_time.value()
-        globals.SETTINGS["SHOW_COLLAGE"] = self.checkBox_collage.isChecked()
-        globals.SETTINGS["SHOW_DELETE"] = self.checkBox_delete.isChecked()
-        globals.SETTINGS["SHOW_RECAPTURE"] = self.checkBox_recapture.isChecked()
-        globals.SETTINGS["SHOW_PRINT"] = self.checkBox_print.isChecked()
-        globals.SETTINGS["SHOW_SHARE"] = self.checkBox_share.isChecked()
-        globals.SETTINGS["SHOW_BUTTON_TEXT"] = self.checkBox_button_text.isChecked()
-
-        with open(os.path.join(os.path.dirname(__file__), "settings.yaml"), "w") as outfile:
-            try:
-                yaml.dump(SETTINGS, outfile, default_flow_style=False)
-            except yaml.YAMLError as exc:
-                logging.info(exc)
-
-        self.loadSettings()
-        self.loadBackgroundImage()
-        self.refreshWelcomeText()
-        self.setRecaptureMode()
-        self.overlay_buttons_on_stream()
+        # only settings that changed are applied, see applySettings
+        globals.SETTINGS.update({
+            "WELCOME_MESSAGE": self.lineEdit_welcome_message.text(),
+            "TARGET_DIR": self.lineEdit_target_dir.text(),
+            "COUNTDOWN_TIME_SECONDS": self.spinBox_countdown_time.value(),
+            "PREVIEW_TIME_SECONDS": self.spinBox_preview_time.value(),
+            "SHOW_COLLAGE": self.checkBox_collage.isChecked(),
+            "SHOW_DELETE": self.checkBox_delete.isChecked(),
+            "SHOW_RECAPTURE": self.checkBox_recapture.isChecked(),
+            "SHOW_PRINT": self.checkBox_print.isChecked(),
+            "SHOW_SHARE": self.checkBox_share.isChecked(),
+            "SHOW_BUTTON_TEXT": self.checkBox_button_text.isChecked(),
+        })
+        globals.SETTINGS.save()
         self.stackedWidget.setCurrentIndex(0)
 
+    @pyqtSlot(set)
+    def applySettings(self, changed):
+        # called in the GUI thread whenever settings really changed
+        if "BACKGROUND_IMAGE" in changed:
+            self.loadBackgroundImage()
+        if "WELCOME_MESSAGE" in changed:
+            self.refreshWelcomeText()
+        if "WELCOME_TEXT_COLOR" in changed:
+            self.applyWelcomeTextColor()
+        if "IMAGE_BORDER_COLOR" in changed:
+            self.applyImageBorder()
+        if "SHOW_RECAPTURE" in changed:
+            self.setRecaptureMode()
+        if "SHOW_BUTTON_TEXT" in changed:
+            self.applyButtonText()
+        if "TARGET_DIR" in changed:
+            self.ensureTargetDir()
+            if galleryServer.SERVER is not None:
+                galleryServer.SERVER.root = globals.SETTINGS["TARGET_DIR"]
+            captureIndex.open_index(globals.SETTINGS["TARGET_DIR"])
+        if "IMAGE_CACHE_MB" in changed:
+            imageCache.CACHE.set_budget(globals.SETTINGS["IMAGE_CACHE_MB"] * 2**20)
+
     def shutdown(self):
         logging.info("Goodbye. See you next time.")
+        logging.info(f"Image cache: {imageCache.CACHE.stats()}")
+        logging.info(f"Filter: {filters.ENGINE.stats()}")
+        cameraSession.close_session()
+        self.print_queue.close()
+        if share_gdrive.QUEUE is not None:
+            share_gdrive.QUEUE.close()
+        galleryServer.stop_server()
+        captureIndex.close_index()
+        tracing.TRACER.close()
         QApplication.quit()
     
 
@@ -0,0 +1,56 @@
+import logging
+import time
+from PyQt6.QtCore import QEvent, QObject, QSize, Qt
+from PyQt6.QtGui import QImage, QPainter, QPixmap
+
+
+class BackgroundCache(QObject):
+    # Paints one background image behind several pages. The image is decoded once and
+    # scaled once per page size, every repaint only copies the cached pixmap. Stylesheet
+    # border-images instead rescale the full size image on every repaint of every page.
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.path = None
+        self.source = None
+        self.pixmaps = {}
+        self.pages = []
+
+    def set_image(self, path) -> bool:
+        image = QImage(path)
+        if image.isNull():
+            logging.error(f"Unable to load background image {path}")
+            return False
+        self.path = path
+        self.source = image
+        self.pixmaps.clear()
+        for page in self.pages:
+            page.update()
+        return True
+
+    def add_page(self, page):
+        page.installEventFilter(self)
+        self.pages.append(page)
+        page.update()
+
+    def pixmap(self, size: QSize) -> QPixmap:
+        key = (size.width(), size.height())
+        pixmap = self.pixmaps.get(key)
+        if pixmap is None:
+            start = time.perf_counter()
+            # stretched like the former "border-image ... stretch stretch"
+            pixmap = QPixmap.fromImage(self.source.scaled(size, Qt.AspectRatioMode.IgnoreAspectRatio, Qt.TransformationMode.SmoothTransformation))
+            # only sizes pages currently have are kept
+            sizes = {(page.width(), page.height()) for page in self.pages}
+            self.pixmaps = {k: v for k, v in self.pixmaps.items() if k in sizes}
+            self.pixmaps[key] = pixmap
+            logging.info(f"Scaled background {self.path} to {key[0]}x{key[1]} in {1000*(time.perf_counter()-start):.0f} ms")
+        return pixmap
+
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Type.Paint and self.source is not None and obj.width() > 0 and obj.height() > 0:
+            painter = QPainter(obj)
+            painter.drawPixmap(event.rect(), self.pixmap(obj.size()), event.rect())
+            painter.end()
+        # the page paints its own content on top
+        return False
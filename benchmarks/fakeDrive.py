@@ -0,0 +1,162 @@
+# A local stand-in for the parts of the Google Drive v3 API the booth uses: resumable
+# uploads, sharing and deleting. Point DRIVE_API_ENDPOINT at it to test uploads offline:
+#   python benchmarks/fakeDrive.py --port 8765 --drop-after 2 --drops 2
+# It can drop connections in the middle of an upload after storing the chunk, like a weak
+# connection that loses the answer, so the client has to ask how far it got and resume.
+import argparse
+import json
+import logging
+import re
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+CONTENT_RANGE = re.compile(r"bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)")
+
+
+class FakeDrive:
+    # drop_after: number of chunks that are answered before connections are dropped,
+    # drops: number of chunk requests that are stored but never answered after that
+
+    def __init__(self, port=0, drop_after=None, drops=1):
+        self.drop_after = drop_after
+        self.drops_left = drops if drop_after is not None else 0
+        self.lock = threading.Lock()
+        self.sessions = {}                                  # upload id -> {"name", "size", "data"}
+        self.files = {}                                     # file id -> {"name", "data", "shared"}
+        self.counts = Counter()
+        self.next_id = 1
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-drive", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _new_id(self) -> str:
+        with self.lock:
+            self.next_id += 1
+            return str(self.next_id - 1)
+
+    def _handler(self):
+        drive = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                logging.debug(f"Fake Drive: {format % args}")
+
+            def body(self) -> bytes:
+                return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+            def answer(self, status, content=None, headers=None):
+                data = b"" if content is None else json.dumps(content).encode()
+                self.send_response(status)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                if content is not None:
+                    self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                body = self.body()
+                if url.path == "/upload/drive/v3/files" and query.get("uploadType") == ["resumable"]:
+                    upload_id = drive._new_id()
+                    metadata = json.loads(body or b"{}")
+                    with drive.lock:
+                        drive.sessions[upload_id] = {"name": metadata.get("name"), "size": int(self.headers["X-Upload-Content-Length"]), "data": bytearray()}
+                        drive.counts["sessions"] += 1
+                    self.answer(200, headers={"Location": f"{drive.url}/upload/drive/v3/files?uploadType=resumable&upload_id={upload_id}"})
+                    return
+                match = re.fullmatch(r"/drive/v3/files/([^/]+)/permissions", url.path)
+                if match and match.group(1) in drive.files:
+                    with drive.lock:
+                        drive.files[match.group(1)]["shared"] = True
+                        drive.counts["permissions"] += 1
+                    self.answer(200, {"kind": "drive#permission", "id": "anyoneWithLink", "type": "anyone", "role": "reader"})
+                    return
+                self.answer(404, {"error": {"code": 404, "message": f"Not found: {url.path}"}})
+
+            def do_PUT(self):
+                query = parse_qs(urlparse(self.path).query)
+                body = self.body()
+                if len(body) < int(self.headers.get("Content-Length") or 0):
+                    self.close_connection = True
+                    return                                  # the client gave up sending, nothing is stored
+                with drive.lock:
+                    session = drive.sessions.get((query.get("upload_id") or [None])[0])
+                if session is None:
+                    self.answer(404, {"error": {"code": 404, "message": "Unknown upload session"}})
+                    return
+                match = CONTENT_RANGE.fullmatch(self.headers.get("Content-Range", ""))
+                if match is None:
+                    self.answer(400, {"error": {"code": 400, "message": "Missing Content-Range"}})
+                    return
+                with drive.lock:
+                    if match.group(1) is None:
+                        drive.counts["status_queries"] += 1         # the client asks how far it got
+                    else:
+                        start = int(match.group(1))
+                        if start > len(session["data"]):
+                            self.answer(400, {"error": {"code": 400, "message": f"Chunk starts at {start}, have {len(session['data'])}"}})
+                            return
+                        del session["data"][start:]                 # a resent chunk replaces what was stored
+                        session["data"] += body
+                        drive.counts["chunks"] += 1
+                        drive.counts["bytes"] += len(body)
+                        if drive.drop_after is not None and drive.counts["chunks"] > drive.drop_after and drive.drops_left > 0:
+                            drive.drops_left -= 1
+                            drive.counts["dropped"] += 1
+                            self.close_connection = True
+                            return                                  # stored, but the answer is lost
+                    received = len(session["data"])
+                    complete = received == session["size"]
+                    if complete:
+                        file_id = f"fake{len(drive.files) + 1}"
+                        drive.files[file_id] = {"name": session["name"], "data": bytes(session["data"]), "shared": False}
+                if complete:
+                    self.answer(200, {"id": file_id})
+                elif received:
+                    self.answer(308, headers={"Range": f"bytes=0-{received - 1}"})
+                else:
+                    self.answer(308)
+
+            def do_DELETE(self):
+                match = re.fullmatch(r"/drive/v3/files/([^/?]+)", urlparse(self.path).path)
+                with drive.lock:
+                    found = match is not None and drive.files.pop(match.group(1), None) is not None
+                    if found:
+                        drive.counts["deleted"] += 1
+                if found:
+                    self.answer(204)
+                else:
+                    self.answer(404, {"error": {"code": 404, "message": "File not found"}})
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local fake of the Google Drive upload API")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--drop-after", type=int, help="drop connections after this many chunks")
+    parser.add_argument("--drops", type=int, default=1, help="number of chunk requests to drop")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG)
+    drive = FakeDrive(args.port, args.drop_after, args.drops)
+    print(f"Fake Drive at {drive.url}, set DRIVE_API_ENDPOINT to it")
+    try:
+        drive.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
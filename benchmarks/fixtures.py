@@ -0,0 +1,60 @@
+import os
+import cv2
+import numpy as np
+
+PHOTO_SIZE = (6000, 4000)                   # 24 MP like an APS-C system camera
+LIVEVIEW_SIZE = (1024, 680)
+
+
+def _scene(width, height, seed) -> np.ndarray:
+    # smooth gradients with fine noise, compresses about like a real photo
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 1, width, dtype=np.float32)
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None]
+    image = np.empty((height, width, 3), np.uint8)
+    for channel, (a, b) in enumerate([(180, 60), (120, 110), (60, 170)]):
+        plane = a*x + b*y + 20*np.sin(12*x + 7*y + seed)
+        plane += rng.normal(0, 6, (height, width)).astype(np.float32)
+        image[:, :, channel] = np.clip(plane, 0, 255)
+    cv2.circle(image, (width//2, height//2), height//4, (230, 230, 230), -1)
+    return image
+
+def photo(directory, seed=0, size=PHOTO_SIZE) -> str:
+    # a synthetic capture, created once and reused by later runs
+    path = os.path.join(directory, f"photo_{size[0]}x{size[1]}_{seed}.jpg")
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        cv2.imwrite(path + ".tmp.jpg", _scene(*size, seed), [cv2.IMWRITE_JPEG_QUALITY, 92])
+        os.replace(path + ".tmp.jpg", path)
+    return path
+
+def frame(width, height, seed=0) -> np.ndarray:
+    return _scene(width, height, seed)
+
+def cube(directory, size=33) -> str:
+    # a 3D LUT file with a warm, slightly faded look
+    path = os.path.join(directory, f"look_{size}.cube")
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        levels = np.linspace(0, 1, size)
+        with open(path + ".tmp", "w") as f:
+            f.write(f'TITLE "benchmark look"\nLUT_3D_SIZE {size}\n')
+            for b in levels:
+                for g in levels:
+                    for r in levels:
+                        f.write(f"{0.05 + 0.95*r**0.9:.6f} {0.03 + 0.9*g:.6f} {0.08 + 0.8*b + 0.05*r:.6f}\n")
+        os.replace(path + ".tmp", path)
+    return path
+
+def mjpeg(directory, frames=50, size=LIVEVIEW_SIZE) -> str:
+    # a live view recording like gphoto2 --capture-movie --stdout delivers it
+    path = os.path.join(directory, f"liveview_{size[0]}x{size[1]}_{frames}.mjpeg")
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        background = _scene(*size, 0)
+        with open(path + ".tmp", "wb") as f:
+            for i in range(frames):
+                image = np.roll(background, 8*i, axis=1)
+                f.write(cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 80])[1].tobytes())
+        os.replace(path + ".tmp", path)
+    return path
@@ -0,0 +1,280 @@
+# Benchmarks of the hot paths of the booth with synthetic fixtures, no camera needed.
+#   python benchmarks/run.py                      all benchmarks, results in benchmarks/results/
+#   python benchmarks/run.py -k collage           only benchmarks containing "collage"
+#   python benchmarks/run.py --compare old.json   show the change against earlier results
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+BENCHMARKS_DIR = os.path.dirname(os.path.realpath(__file__))
+ROOT = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCHMARKS_DIR)
+
+import cv2
+import fixtures
+import globals
+import cameraSession
+import derivatives
+import filters
+import imageCache
+from collageBuilder import CollageRenderer
+from collageTemplates import TemplateRegistry
+from fileWatcher import wait_for_complete_file
+from mjpegLiveView import MjpegParser
+from qrCode import make_qr_image
+from streamPipeline import LiveViewTransform, load_preview
+
+FIXTURES_DIR = os.path.join(BENCHMARKS_DIR, "fixtures")
+RESULTS_DIR = os.path.join(BENCHMARKS_DIR, "results")
+FAKE_GPHOTO2_DIR = os.path.join(BENCHMARKS_DIR, "bin")
+DISPLAY_HEIGHT = 840                                # like StreamThread.DISPLAY_HEIGHT
+REGRESSION_THRESHOLD = 0.10
+
+
+def measure(function, repeat, warmup=1) -> list:
+    # seconds of every run after the warmup runs
+    for _ in range(warmup):
+        function()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+def summarize(times, **extra) -> dict:
+    milliseconds = sorted(1000*t for t in times)
+    result = {
+        "unit": "ms",
+        "runs": len(milliseconds),
+        "min": milliseconds[0],
+        "median": statistics.median(milliseconds),
+        "mean": statistics.fmean(milliseconds),
+        "p95": milliseconds[min(len(milliseconds) - 1, round(0.95*(len(milliseconds) - 1)))],
+        "max": milliseconds[-1],
+    }
+    result.update(extra)
+    return result
+
+
+def bench_liveview_transform(scale):
+    results = {}
+    for width, height in [(1280, 720), (1920, 1080)]:
+        frame = fixtures.frame(width, height)
+        transform = LiveViewTransform(width, height, DISPLAY_HEIGHT / height)
+        times = measure(lambda: transform.apply(frame), 200*scale, warmup=10)
+        results[f"liveview_transform_{width}x{height}"] = summarize(times, fps=len(times) / sum(times))
+    return results
+
+def bench_preview_decode(scale):
+    photo = fixtures.photo(FIXTURES_DIR)
+    times = measure(lambda: load_preview(photo, 1260, DISPLAY_HEIGHT), 5*scale)
+    return {"preview_decode_24mp": summarize(times)}
+
+def bench_derivatives(scale):
+    # everything made of one capture: print, share, thumbnail and preview, with and without
+    # the decoded images shared through the image cache
+    photo = fixtures.photo(FIXTURES_DIR)
+    results = {}
+    with tempfile.TemporaryDirectory() as target_dir:
+        capture = os.path.join(target_dir, "photobox_derivatives.jpg")
+        os.symlink(photo, capture)
+        for name, budget in [("uncached", 0), ("cached", globals.DEFAULT_IMAGE_CACHE_MB * 2**20)]:
+            imageCache.CACHE.set_budget(budget)
+
+            def derive():
+                imageCache.CACHE.discard(capture)           # a new capture every run
+                derivatives.make_print(capture)
+                derivatives.make_share(capture)
+                derivatives.make_thumbnail(capture)
+                load_preview(capture, 1260, DISPLAY_HEIGHT)
+            results[f"derivatives_{name}"] = summarize(measure(derive, 3*scale))
+    imageCache.CACHE.set_budget(0)
+    return results
+
+def bench_filters(scale):
+    # every look on a live view frame and on a 24 MP photo
+    frame = fixtures.frame(1344, DISPLAY_HEIGHT)
+    photo = cv2.cvtColor(cv2.imread(fixtures.photo(FIXTURES_DIR)), cv2.COLOR_BGR2RGB)
+    cube = fixtures.cube(FIXTURES_DIR)
+    looks = [filters.load_look(name) for name in filters.BUILTIN_LOOKS]
+    looks.append(filters.parse_cube("cube", cube))
+    results = {}
+    for look in looks:
+        live = frame.copy()
+        times = measure(lambda: look.apply_live(live), 100*scale, warmup=5)
+        results[f"filter_live_{look.name}"] = summarize(times, fps=len(times) / sum(times))
+        times = measure(lambda: look.apply(photo.copy()), scale, warmup=0)
+        results[f"filter_full_{look.name}_24mp"] = summarize(times)
+    return results
+
+def bench_collages(scale):
+    results = {}
+    photos = [fixtures.photo(FIXTURES_DIR, seed) for seed in range(4)]
+    registry = TemplateRegistry()
+    with tempfile.TemporaryDirectory() as target_dir:
+        for layout in registry.scan():
+            renderer = CollageRenderer()
+            peak_bytes = []
+
+            def render():
+                collage = layout.to_collage()
+                for i, position in enumerate(collage.images):
+                    position.imagePath = photos[i % len(photos)]
+                peak_bytes.append(renderer.renderImagesToCollage(collage, os.path.join(target_dir, "collage.jpg")).peak_bytes)
+            times = measure(render, 3*scale)
+            results[f"collage_{layout.name}"] = summarize(times, slots=len(layout.images), peak_mb=max(peak_bytes)/2**20)
+    return results
+
+def bench_qr_code(scale):
+    times = measure(lambda: make_qr_image("http://192.168.4.1:8000/photos/photobox_01012024_120000.jpg"), 50*scale)
+    return {"qr_code": summarize(times)}
+
+def bench_mjpeg_parse(scale):
+    with open(fixtures.mjpeg(FIXTURES_DIR), "rb") as f:
+        stream = f.read() * 10
+    frames = []
+
+    def parse():
+        frames.clear()
+        parser = MjpegParser(lambda frame: frames.append(len(frame)))
+        parser.feed(stream)
+    times = measure(parse, 5*scale)
+    return {"mjpeg_parse": summarize(times, frames=len(frames), mb_per_second=len(stream) / 2**20 / statistics.median(times))}
+
+def bench_capture_to_preview(scale):
+    # shell session with the fake gphoto2: trigger until the preview is ready to be shown
+    os.environ["PATH"] = FAKE_GPHOTO2_DIR + os.pathsep + os.environ["PATH"]
+    os.environ["FAKE_GPHOTO2_IMAGE"] = fixtures.photo(FIXTURES_DIR)
+    session = cameraSession.GPhoto2ShellSession(None)
+    if not session.open():
+        raise RuntimeError("fake gphoto2 did not start")
+    capture_times = []
+    try:
+        with tempfile.TemporaryDirectory() as target_dir:
+            shots = iter(range(1000))
+
+            def capture_and_preview():
+                file_name = os.path.join(target_dir, f"photobox_{next(shots)}.jpg")
+                start = time.perf_counter()
+                result = session.capture(file_name)
+                if not result.success or not wait_for_complete_file(file_name, 10):
+                    raise RuntimeError(f"capture failed: {result.error}")
+                capture_times.append(time.perf_counter() - start)
+                load_preview(file_name, 1260, DISPLAY_HEIGHT)
+            times = measure(capture_and_preview, 5*scale)
+    finally:
+        session.close()
+    return {"capture_to_preview": summarize(times, capture_median_ms=1000*statistics.median(capture_times))}
+
+def bench_upload(scale):
+    # upload queue against the fake Drive: a resumable upload that loses the answer to one
+    # chunk and has to resume where the server got to, then sharing the photo
+    import share_gdrive
+    from fakeDrive import FakeDrive
+    from google.auth.credentials import AnonymousCredentials
+    photo = fixtures.photo(FIXTURES_DIR)
+    drive = FakeDrive(drop_after=2, drops=1).start()
+    http_timeout = share_gdrive.HTTP_TIMEOUT_SECONDS
+    share_gdrive.HTTP_TIMEOUT_SECONDS = 2                   # until the dropped connection is noticed
+    share_gdrive.SERVICE = share_gdrive.build_service(AnonymousCredentials(), drive.url)
+    try:
+        with tempfile.TemporaryDirectory() as target_dir:
+            queue = share_gdrive.UploadQueue(os.path.join(target_dir, share_gdrive.JOURNAL_FILE))
+            shots = iter(range(1000))
+
+            def upload_and_share():
+                file_name = os.path.join(target_dir, f"photobox_{next(shots)}.jpg")
+                os.symlink(photo, file_name)
+                queue.wait_for_link(file_name, 120)
+            try:
+                times = measure(upload_and_share, scale, warmup=0)
+            finally:
+                queue.close()
+    finally:
+        drive.close()
+        share_gdrive.SERVICE = None
+        share_gdrive.HTTP_TIMEOUT_SECONDS = http_timeout
+    with open(photo, "rb") as f:
+        data = f.read()
+    if drive.counts["dropped"] != 1 or drive.counts["status_queries"] < 1 or len(drive.files) != scale \
+            or any(file["data"] != data or not file["shared"] for file in drive.files.values()):
+        raise RuntimeError(f"upload to the fake Drive went wrong: {dict(drive.counts)}")
+    return {"upload_resume_and_share": summarize(times, mb=len(data) / 2**20, chunks=drive.counts["chunks"], resent_mb=(drive.counts["bytes"] - scale*len(data)) / 2**20)}
+
+BENCHMARKS = [bench_liveview_transform, bench_preview_decode, bench_derivatives, bench_filters, bench_collages, bench_qr_code, bench_mjpeg_parse, bench_capture_to_preview, bench_upload]
+
+
+def version() -> str:
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def compare(results, previous):
+    print(f"\nCompared with {previous['version']} ({previous['timestamp']}):")
+    for name, result in results.items():
+        old = previous["benchmarks"].get(name)
+        if old is None:
+            continue
+        change = result["median"] / old["median"] - 1
+        flag = "  SLOWER" if change > REGRESSION_THRESHOLD else ""
+        print(f"  {name:<40} {old['median']:9.2f} -> {result['median']:9.2f} ms  {100*change:+6.1f}%{flag}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the booth with synthetic fixtures")
+    parser.add_argument("-k", dest="filter", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("--scale", type=int, default=1, help="multiplies the number of runs")
+    parser.add_argument("--output", help="result file, default benchmarks/results/<version>.json")
+    parser.add_argument("--compare", help="earlier result file to compare with")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    globals.init()
+    imageCache.CACHE.set_budget(0)                  # the benchmarks measure decoding, not the cache
+    results = {
+        "version": version(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "processor": platform.processor() or platform.machine(),
+        "cpus": os.cpu_count(),
+        "opencv": cv2.__version__,
+        "benchmarks": {},
+    }
+    for benchmark in BENCHMARKS:
+        name = benchmark.__name__[len("bench_"):]
+        if args.filter not in name:
+            continue
+        try:
+            measured = benchmark(args.scale)
+        except Exception as e:
+            logging.error(f"Benchmark {name} failed: {e}")
+            results["benchmarks"][name] = {"error": str(e)}
+            continue
+        for key, result in measured.items():
+            print(f"{key:<40} median {result['median']:9.2f} ms  p95 {result['p95']:9.2f} ms  ({result['runs']} runs)")
+        results["benchmarks"].update(measured)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{results['version']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare({name: result for name, result in results["benchmarks"].items() if "median" in result}, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,386 @@
+# Headless soak test of the booth: runs the real Window with a fake camera, printer and
+# uploader and lets synthetic guests use it, as fast as configured. Needs the generated
+# MainWindow.py and resources_rc.py (see build_qt.sh).
+#   python benchmarks/simulate.py --sessions 1000 --speed 20
+# Reports throughput, RSS growth, thread counts and guests that got stuck.
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+BENCHMARKS_DIR = os.path.dirname(os.path.realpath(__file__))
+ROOT = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCHMARKS_DIR)
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt6.QtCore import QObject, QTimer
+from PyQt6.QtWidgets import QApplication
+import fixtures
+import globals
+import cameraSession
+import filters
+import imageCache
+import share_gdrive
+import tracing
+from printQueue import FakePrintBackend, PrintQueue
+from run import RESULTS_DIR, version
+
+POLL_MS = 20
+STEP_TIMEOUT_SECONDS = 60
+SHARE_WAITING_TEXT = "Download wird vorbereitet...\nBitte warten"
+ACTIONS = {"print": 0.3, "share": 0.3, "delete": 0.1, "recapture": 0.1, "home": 0.2}
+
+
+def process_status() -> dict:
+    # resident memory in MB and native threads of this process
+    status = {}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("VmRSS", "VmHWM"):
+                    status[key] = int(value.split()[0]) / 1024
+                elif key == "Threads":
+                    status[key] = int(value)
+    except OSError:
+        pass
+    try:
+        status["fds"] = len(os.listdir("/proc/self/fd"))
+    except OSError:
+        pass
+    return status
+
+
+class FakeUploadQueue:
+    # stands in for share_gdrive.UploadQueue, every upload takes upload_seconds
+    def __init__(self, upload_seconds, fail_every=0):
+        self.upload_seconds = upload_seconds
+        self.fail_every = fail_every
+        self.uploaded = set()
+        self.links = 0
+        self.lock = threading.Lock()
+
+    def enqueue(self, file_name, share=False):
+        with self.lock:
+            self.uploaded.add(file_name)
+
+    def cancel(self, file_name):
+        with self.lock:
+            self.uploaded.discard(file_name)
+
+    def wait_for_link(self, file_name, timeout) -> str:
+        with self.lock:
+            uploaded = file_name in self.uploaded
+            self.links += 1
+            fail = self.fail_every and self.links % self.fail_every == 0
+        time.sleep(self.upload_seconds / (4 if uploaded else 1))      # speculative uploads only need to be shared
+        if fail:
+            raise share_gdrive.UploadError(f"Simulated upload failure of {file_name}")
+        return f"https://drive.example/{os.path.basename(file_name)}"
+
+    def depth(self) -> int:
+        return 0
+
+    def close(self):
+        pass
+
+
+class Guest(QObject):
+    # Plays one guest after another by pressing the buttons of the window like a person
+    # would, waiting for the screen to react in between. Every step that does not finish
+    # within STEP_TIMEOUT_SECONDS is recorded as stuck and the guest goes home.
+
+    def __init__(self, window, sessions, speed, collage_share, seed, sample_every, on_done):
+        super().__init__()
+        self.window = window
+        self.sessions = sessions
+        self.speed = speed
+        self.collage_share = collage_share
+        self.random = random.Random(seed)
+        self.sample_every = sample_every
+        self.on_done = on_done
+        self.session = 0
+        self.state = "idle"
+        self.state_since = time.monotonic()
+        self.wait_until = 0
+        self.images_left = 0
+        self.counts = Counter()
+        self.stuck = []
+        self.samples = []
+        self.captured = 0
+        self.errors = 0
+        self.rendered = 0
+        window.worker.capture_finished.connect(self.on_captured)
+        window.worker.capture_error.connect(self.on_error)
+        window.collage_rendered.connect(self.on_rendered)
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.step)
+
+    def start(self):
+        self.sample()
+        self.timer.start(POLL_MS)
+
+    def on_captured(self):
+        self.captured += 1
+
+    def on_error(self, error):
+        self.errors += 1
+
+    def on_rendered(self, file_name, error):
+        self.rendered += 1
+
+    def think(self, seconds):
+        # guests need a moment before they press the next button
+        self.wait_until = time.monotonic() + self.random.uniform(0.5, 1.5) * seconds / self.speed
+
+    def go(self, state):
+        self.state = state
+        self.state_since = time.monotonic()
+
+    def sample(self):
+        sample = process_status()
+        sample.update(session=self.session, time=time.monotonic(), python_threads=threading.active_count(),
+                      qobjects=len(self.window.findChildren(QObject)))
+        self.samples.append(sample)
+
+    def finish_session(self):
+        self.session += 1
+        self.counts["sessions"] += 1
+        if self.session % self.sample_every == 0:
+            self.sample()
+        if self.session >= self.sessions:
+            self.timer.stop()
+            self.on_done()
+            return
+        self.think(3)
+        self.go("idle")
+
+    def home(self):
+        self.window.homeButtonClicked()
+        self.finish_session()
+
+    def step(self):
+        window = self.window
+        if time.monotonic() < self.wait_until:
+            return
+        if self.state != "idle" and time.monotonic() - self.state_since > STEP_TIMEOUT_SECONDS:
+            self.stuck.append({"session": self.session, "state": self.state, "page": window.stackedWidget.currentIndex(),
+                               "capture_mode": str(globals.CAPTURE_MODE), "freeze_stream": globals.FREEZE_STREAM,
+                               "capture_button": window.capture_button.isEnabled()})
+            logging.error(f"Simulated guest {self.session} stuck in {self.state}")
+            self.home()
+            return
+
+        if self.state == "idle":
+            if self.random.random() < 0.3:
+                self.counts["collages"] += 1
+                window.collageButtonClicked()
+                self.images_left = len(globals.CURRENT_COLLAGE.images)
+            else:
+                self.counts["singles"] += 1
+                window.startButtonClicked()
+                self.images_left = 1
+            self.think(2)
+            self.go("ready")
+        elif self.state == "ready":
+            if window.capture_button.isEnabled():
+                self.expected = self.captured + 1
+                self.errors_before = self.errors
+                window.captureButtonClicked()
+                self.counts["photos"] += 1
+                self.go("capturing")
+        elif self.state == "capturing":
+            if self.errors > self.errors_before:
+                self.counts["capture_errors"] += 1
+                self.finish_session()
+            elif self.captured >= self.expected:
+                self.images_left -= 1
+                if self.images_left > 0:
+                    self.go("ready")
+                elif globals.CAPTURE_MODE is globals.CaptureMode.COLLAGE:
+                    self.expected_render = self.rendered + 1
+                    self.go("rendering")
+                else:
+                    self.think(2)
+                    self.go("deciding")
+        elif self.state == "rendering":
+            if self.rendered >= self.expected_render:
+                self.think(2)
+                self.go("deciding")
+        elif self.state == "deciding":
+            action = self.random.choices(list(ACTIONS), list(ACTIONS.values()))[0]
+            if action == "recapture" and globals.CAPTURE_MODE is globals.CaptureMode.COLLAGE:
+                action = "home"
+            self.counts[action] += 1
+            if action == "print":
+                window.printButtonClicked()
+                self.finish_session()
+            elif action == "share":
+                window.downloadButtonClicked()
+                self.go("sharing")
+            elif action == "delete":
+                window.deleteButtonClicked()
+                self.finish_session()
+            elif action == "recapture":
+                self.images_left = 1
+                self.counts["photos"] += 1
+                self.expected = self.captured + 1
+                self.errors_before = self.errors
+                window.captureButtonClicked()
+                self.go("capturing")
+            else:
+                self.home()
+        elif self.state == "sharing":
+            if window.instructions.text() != SHARE_WAITING_TEXT:
+                if window.qr_code.pixmap() is None or window.qr_code.pixmap().isNull():
+                    self.counts["share_failures"] += 1
+                self.think(2)
+                self.go("shared")
+        elif self.state == "shared":
+            self.home()
+
+
+def growth(samples, key, skip):
+    # change of key per 1000 sessions after the first skip samples (warm up)
+    samples = [s for s in samples[skip:] if key in s]
+    if len(samples) < 2 or samples[-1]["session"] == samples[0]["session"]:
+        return None
+    return 1000 * (samples[-1][key] - samples[0][key]) / (samples[-1]["session"] - samples[0]["session"])
+
+def report(guest, window, started, args) -> dict:
+    elapsed = time.monotonic() - started
+    first, last = guest.samples[0], guest.samples[-1]
+    skip = min(2, len(guest.samples) - 2)                   # caches fill during the first sessions
+    prints = window.print_queue.stats()
+    return {
+        "version": version(),
+        "arguments": vars(args),
+        "seconds": elapsed,
+        "counts": dict(guest.counts),
+        "sessions_per_minute": 60 * guest.session / elapsed,
+        "photos_per_minute": 60 * guest.counts["photos"] / elapsed,
+        "prints": {key: prints[key] for key in ("completed", "failed", "queued", "in_flight")},
+        "stuck": guest.stuck,
+        "rss_mb": {"start": first.get("VmRSS"), "end": last.get("VmRSS"), "peak": last.get("VmHWM"),
+                   "growth_per_1000_sessions": growth(guest.samples, "VmRSS", skip)},
+        "threads": {"start": first.get("Threads"), "end": last.get("Threads"),
+                    "max": max(s.get("Threads", 0) for s in guest.samples),
+                    "python_start": first["python_threads"], "python_end": last["python_threads"]},
+        "qobjects": {"start": first["qobjects"], "end": last["qobjects"],
+                     "growth_per_1000_sessions": growth(guest.samples, "qobjects", skip)},
+        "fds": {"start": first.get("fds"), "end": last.get("fds")},
+        "image_cache": imageCache.CACHE.stats(),
+        "filter": filters.ENGINE.stats(),
+        "stages": tracing.TRACER.stats(),
+        "samples": guest.samples,
+    }
+
+def print_report(result):
+    counts = result["counts"]
+    print(f"{counts.get('sessions', 0)} guests in {result['seconds']:.0f} s: {result['sessions_per_minute']:.1f} guests/min, "
+          f"{result['photos_per_minute']:.1f} photos/min")
+    print("  " + ", ".join(f"{key} {value}" for key, value in sorted(counts.items())))
+    print(f"  prints: {result['prints']}")
+    rss, threads, qobjects = result["rss_mb"], result["threads"], result["qobjects"]
+    growth = rss["growth_per_1000_sessions"]
+    print(f"  RSS {rss['start']:.0f} -> {rss['end']:.0f} MB (peak {rss['peak']:.0f} MB"
+          + (f", {growth:+.1f} MB per 1000 guests)" if growth is not None else ")"))
+    print(f"  threads {threads['start']} -> {threads['end']} (max {threads['max']}), "
+          f"QObjects {qobjects['start']} -> {qobjects['end']}, fds {result['fds']['start']} -> {result['fds']['end']}")
+    cache = result["image_cache"]
+    print(f"  image cache {cache['resident_mb']:.0f}/{cache['budget_mb']:.0f} MB, {cache['hits']} hits, {cache['misses']} misses, "
+          f"{cache['evictions']} evictions")
+    look = result["filter"]
+    if look["live_frames"]:
+        print(f"  filter {look['filter']}: live p50 {look['live_p50_ms']:.1f} ms p95 {look['live_p95_ms']:.1f} ms, "
+              f"full resolution p50 {look['full_p50_s'] or 0:.2f} s ({look['full_count']})")
+    for stage, stats in result["stages"].items():
+        print(f"  {stage:<16} p50 {stats['p50_ms']:8.0f} ms  p95 {stats['p95_ms']:8.0f} ms  ({stats['count']})")
+    print(f"  stuck: {len(result['stuck'])}")
+    for stuck in result["stuck"][:10]:
+        print(f"    {stuck}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless soak test of the booth with simulated guests")
+    parser.add_argument("--sessions", type=int, default=100, help="number of guests")
+    parser.add_argument("--speed", type=float, default=10, help="guests think and devices work this many times faster")
+    parser.add_argument("--countdown", type=int, default=1, help="countdown seconds")
+    parser.add_argument("--resolution", default="3000x2000", help="size of the fake camera's photos")
+    parser.add_argument("--print-failures", type=int, default=0, help="every nth print fails")
+    parser.add_argument("--upload-failures", type=int, default=0, help="every nth share fails")
+    parser.add_argument("--filter", default=filters.NO_FILTER, help="look applied to live view and photos")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--sample-every", type=int, default=10, help="guests between memory and thread samples")
+    parser.add_argument("--output", help="report file, default benchmarks/results/simulation_<version>.json")
+    parser.add_argument("--log", help="log file of the booth, only warnings are shown otherwise")
+    args = parser.parse_args()
+
+    if args.log:
+        logging.basicConfig(filename=args.log, level=logging.INFO, format="%(asctime)s %(threadName)s %(levelname)s %(message)s")
+    else:
+        logging.basicConfig(level=logging.WARNING)
+    work_dir = tempfile.mkdtemp(prefix="photobox_simulation_")
+    output = args.output or os.path.join(RESULTS_DIR, f"simulation_{version()}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    os.chdir(work_dir)                                       # lock file of the app, does not block a running booth
+
+    globals.init()
+    globals.SETTINGS.path = os.path.join(work_dir, "settings.yaml")
+    globals.SETTINGS.update({
+        "TARGET_DIR": os.path.join(work_dir, "images"),
+        "COUNTDOWN_TIME_SECONDS": args.countdown,
+        "PREVIEW_TIME_SECONDS": 1,
+        "PREARM_SECONDS": 1,
+        "CAMERA_BACKEND": "fake",
+        "SHOW_SHARE": False,                                 # no gallery server or Drive login, the fake uploader is set below
+        "SHOW_RECAPTURE": True,
+        "FILTER": args.filter,
+        "LIVEVIEW_FILE": fixtures.mjpeg(os.path.join(BENCHMARKS_DIR, "fixtures")),
+    })
+    globals.SETTINGS.save()
+    tracing.TRACER.trace_file = os.path.splitext(output)[0] + ".trace.json"
+
+    import app
+    qt_app = QApplication(sys.argv)
+    width, height = (int(v) for v in args.resolution.split("x"))
+    cameraSession.SESSION = cameraSession.FakeCameraSession(0.3/args.speed, 0.05/args.speed, 0.4/args.speed, (width, height))
+    window = app.Window()
+    window.print_queue.close()
+    window.print_queue = PrintQueue(globals.SETTINGS["PRINTER_NAME"], FakePrintBackend(30/args.speed, args.print_failures), poll_interval=0.5, retry_delay=1)
+    share_gdrive.QUEUE = FakeUploadQueue(2/args.speed, args.upload_failures)
+    globals.SETTINGS.update({"SHOW_SHARE": True, "SHARE_BACKEND": "gdrive"})
+    window.enableStartButtons(True)
+
+    started = time.monotonic()
+    guest = Guest(window, args.sessions, args.speed, True, args.seed, args.sample_every, qt_app.quit)
+    QTimer.singleShot(1000, guest.start)                     # let the threads of the window start
+    qt_app.exec()
+
+    guest.sample()
+    # all prints handed to the fake printer are finished before the report
+    deadline = time.monotonic() + 60/args.speed + 5
+    while window.print_queue.depth() and time.monotonic() < deadline:
+        time.sleep(0.1)
+    result = report(guest, window, started, args)
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+    print_report(result)
+    print(f"Report written to {output}, trace to {tracing.TRACER.trace_file}")
+
+    tracing.TRACER.close()
+    window.print_queue.close()
+    shutil.rmtree(work_dir, ignore_errors=True)
+    # the stream, camera and worker threads of the window never end on their own
+    os._exit(1 if result["stuck"] else 0)
+
+
+if __name__ == "__main__":
+    main()
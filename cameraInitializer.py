@@ -1,38 +1,155 @@
 import logging
+import os
+import select
+import socket
 from PyQt6.QtCore import QThread, pyqtSlot, pyqtSignal
 import time
 import subprocess, re
+import yaml
 import globals
+import cameraSession
+from cameraSession import FakeCameraSession
+
+CAMERA_PROFILES_FILE = os.path.join(os.path.dirname(__file__), "camera_profiles.yaml")
+NETLINK_KOBJECT_UEVENT = 15
+
+
+def load_camera_profiles(path=CAMERA_PROFILES_FILE) -> list:
+    try:
+        with open(path) as f:
+            profiles = yaml.safe_load(f)
+    except (OSError, yaml.YAMLError) as exc:
+        logging.error(f"Unable to read camera profiles: {exc}")
+        return []
+    return profiles or []
+
+def find_camera_profile(camera_name, profiles) -> dict:
+    for profile in profiles:
+        if profile.get("match", "") in camera_name:
+            return profile
+    return None
+
+
+class UsbHotplugMonitor:
+    # Waits for USB devices being plugged in or removed. Uses kernel uevents via netlink
+    # and falls back to watching /sys/bus/usb/devices where netlink is not available.
+
+    SYSFS_USB_DEVICES = "/sys/bus/usb/devices"
+    POLL_INTERVAL_SECONDS = 1.0
+    SETTLE_SECONDS = 0.3
+
+    def __init__(self):
+        self.sock = None
+        try:
+            self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            self.sock.bind((0, 1))
+        except (AttributeError, OSError) as e:
+            logging.info(f"USB hotplug events not available ({e}). Watching sysfs instead")
+            self.sock = None
+        self.devices = self._list_devices()
+
+    def _list_devices(self):
+        try:
+            return set(os.listdir(self.SYSFS_USB_DEVICES))
+        except OSError:
+            return set()
+
+    def _is_usb_device_event(self, message):
+        fields = message.split(b"\0")
+        return b"SUBSYSTEM=usb" in fields and b"DEVTYPE=usb_device" in fields
+
+    def wait_for_change(self, timeout=None) -> bool:
+        # returns True if a USB device was added or removed before the timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            if self.sock is not None:
+                readable, _, _ = select.select([self.sock], [], [], remaining)
+                if not readable:
+                    return False
+                if self._is_usb_device_event(self.sock.recv(8192)):
+                    self._drain()
+                    return True
+            else:
+                time.sleep(self.POLL_INTERVAL_SECONDS if remaining is None else min(self.POLL_INTERVAL_SECONDS, remaining))
+                devices = self._list_devices()
+                if devices != self.devices:
+                    self.devices = devices
+                    return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+
+    def _drain(self):
+        # a single plug event causes a burst of uevents. Give the device a moment to settle.
+        while select.select([self.sock], [], [], self.SETTLE_SECONDS)[0]:
+            self.sock.recv(8192)
 
-DEFAULT_ISO=320
-DEFAULT_SHUTTER_SPEED="1/60"
-DEFAULT_FOCUS_MODE="Automatic"
-DEFAULT_WHITEBALANCE_MODE="Flash"
-DEFAULT_F_NUMBER="f/2.8"
 
 class CameraInitializer(QThread):
     enable_buttons_signal = pyqtSignal(bool)
+    RETRY_SECONDS = 5
 
     def __init__(self, window):
         super().__init__()
+        self.camera_port = None
 
     def run(self):
-        # init camera and repeat in case False is returned
-        while not self.initCamera():
-            logging.info("Trying to init camera again")
-            time.sleep(5)
-        self.enable_buttons_signal.emit(True)
+        monitor = UsbHotplugMonitor()
+        while True:
+            start = time.monotonic()
+            # init camera and repeat as soon as something changes on the USB bus
+            while not self.initCamera():
+                logging.info("Waiting for camera to be connected")
+                monitor.wait_for_change(self.RETRY_SECONDS)
+            logging.info(f"Camera ready after {time.monotonic()-start:.2f} s")
+            self.enable_buttons_signal.emit(True)
+
+            if self.camera_port is None:
+                return                                          # nothing to watch for (e.g. fake camera)
+            while self.cameraConnected():
+                monitor.wait_for_change()
+            logging.warning(f"Camera {globals.CURRENT_CAMERA} disconnected")
+            self.enable_buttons_signal.emit(False)
+            globals.CURRENT_CAMERA = None
+            cameraSession.close_session()
+
+    def cameraConnected(self) -> bool:
+        # look up the usb port from gphoto2 --auto-detect in sysfs. No need to talk to the camera.
+        bus, device = self.camera_port
+        try:
+            entries = os.listdir(UsbHotplugMonitor.SYSFS_USB_DEVICES)
+        except OSError:
+            return True                                         # no sysfs, assume it is still there
+        for entry in entries:
+            path = os.path.join(UsbHotplugMonitor.SYSFS_USB_DEVICES, entry)
+            try:
+                with open(os.path.join(path, "busnum")) as f:
+                    if int(f.read()) != bus:
+                        continue
+                with open(os.path.join(path, "devnum")) as f:
+                    if int(f.read()) == device:
+                        return True
+            except (OSError, ValueError):
+                continue
+        return False
 
     def initCamera(self) -> bool:
 
+            if globals.SETTINGS["CAMERA_BACKEND"] == "fake":
+                globals.CURRENT_CAMERA = FakeCameraSession.NAME
+                self.camera_port = None
+                logging.info(f"Using camera: {globals.CURRENT_CAMERA}")
+                return True
+
             # run gphoto2 --auto-detect and analyse output for detected cameras
+            start = time.monotonic()
             process = subprocess.Popen(["gphoto2", "--auto-detect"], stdout=subprocess.PIPE)
             out, err = process.communicate()
             out = out.decode()
             cameras = out.split("\n")
             #extract camera names
             # Define the regular expression pattern to match the camera name
-            pattern = r"^(.*?)\s+usb:\d+,\d+"
+            pattern = r"^(.*?)\s+usb:(\d+),(\d+)"
             cameras = [re.search(pattern, c, re.MULTILINE) for c in cameras]
 
             # filter out none matching lines (e.g. empty lines)
@@ -41,64 +158,36 @@ class CameraInitializer(QThread):
             # if more than one camera was detected use the first one
             if len(cameras) >= 1:
                 globals.CURRENT_CAMERA = cameras[0].group(1).strip()
+                self.camera_port = (int(cameras[0].group(2)), int(cameras[0].group(3)))
             else:
                 logging.warning("No camera detected")
                 return False
 
-            logging.info(f"Using camera: {globals.CURRENT_CAMERA}")
-
-            # if camera name contains Sony call method to init sony camera
-            if "Sony" in globals.CURRENT_CAMERA:
-                logging.info("Sony camera detected")
-                # somehow the first command issued with gphoto2 will not work correctly on Sony cameras. So we issue it two times.
-                settfirsEmptyCommand = subprocess.Popen(["gphoto2", "--set-config", f"/main/imgsettings/iso={DEFAULT_ISO}", "--camera", globals.CURRENT_CAMERA])
-                settfirsEmptyCommand.communicate()
-                time.sleep(0.5)
-
-                settingIso = subprocess.Popen(["gphoto2", "--set-config", f"/main/imgsettings/iso={DEFAULT_ISO}", "--camera", globals.CURRENT_CAMERA])
-                # wait for completion
-                settingIso.communicate()
-                # check if a error occured
-                if settingIso.returncode != None and settingIso.returncode != 0:
-                    logging.error(f"Error setting ISO: {settingIso}")
-                else:
-                    logging.info(f"ISO set to {DEFAULT_ISO}")
-                time.sleep(0.5)
-
-                settingShutter = subprocess.Popen(["gphoto2", "--set-config", f"/main/capturesettings/shutterspeed={DEFAULT_SHUTTER_SPEED}", "--camera", globals.CURRENT_CAMERA])
-                # wait for completion
-                settingShutter.communicate()
-                if settingShutter.returncode != None and settingShutter.returncode != 0:
-                    logging.error(f"Error setting shutter speed: {settingShutter}")
-                else:
-                    logging.info(f"Shutter speed set to {DEFAULT_SHUTTER_SPEED}")
-                time.sleep(0.5)
-            
-                settingFocusMode = subprocess.Popen(["gphoto2", "--set-config", f"/main/capturesettings/focusmode={DEFAULT_FOCUS_MODE}", "--camera", globals.CURRENT_CAMERA])
-                # wait for completion
-                settingFocusMode.communicate()
-                if settingFocusMode.returncode != None and settingFocusMode.returncode != 0:
-                    logging.error(f"Error setting focus mode: {settingFocusMode}")
-                else:
-                    logging.info(f"Focus mode set to {DEFAULT_FOCUS_MODE}")
-                time.sleep(0.5)
-
-                settingWhiteBalance = subprocess.Popen(["gphoto2", "--set-config", f"/main/imgsettings/whitebalance={DEFAULT_WHITEBALANCE_MODE}", "--camera", globals.CURRENT_CAMERA])
-                # wait for completion
-                settingWhiteBalance.communicate()
-                if settingWhiteBalance.returncode != None and settingWhiteBalance.returncode != 0:
-                    logging.error(f"Error setting whitebalance mode: {settingWhiteBalance}")
-                else:
-                    logging.info(f"Whitebalance mode set to {DEFAULT_WHITEBALANCE_MODE}")
-                time.sleep(0.5)
-
-                settingFNumber = subprocess.Popen(["gphoto2", "--set-config", f"/main/capturesettings/f-number={DEFAULT_F_NUMBER}", "--camera", globals.CURRENT_CAMERA])
-                # wait for completion
-                settingFNumber.communicate()
-                if settingFNumber.returncode != None and settingFNumber.returncode != 0 or  settingFNumber.stdout != None and "Error" in settingFNumber.stdout:
-                    logging.error(f"Error setting f number: {settingFNumber}")
-                else:
-                    logging.info(f"F-Number set to {DEFAULT_F_NUMBER}")
-                time.sleep(0.5)
-
-            return True
\ No newline at end of file
+            logging.info(f"Using camera: {globals.CURRENT_CAMERA} (detected in {time.monotonic()-start:.2f} s)")
+            return self.applyCameraProfile()
+
+    def applyCameraProfile(self) -> bool:
+        profile = find_camera_profile(globals.CURRENT_CAMERA, load_camera_profiles())
+        if profile is None:
+            logging.info(f"No camera profile for {globals.CURRENT_CAMERA}. Using camera defaults")
+            return True
+
+        start = time.monotonic()
+        logging.info(f"Applying camera profile {profile['name']}")
+        session = cameraSession.get_session()
+        if not session.open():
+            logging.error("Unable to open camera session")
+            return False
+
+        session.prefocus_config = profile.get("prefocus") or {}
+        config = list((profile.get("config") or {}).items())
+        if profile.get("repeat_first_command") and len(config) > 0:
+            session.set_config(*config[0])
+        for name, value in config:
+            result = session.set_config(name, value)
+            if result.success:
+                logging.info(f"{name} set to {value}")
+            else:
+                logging.error(f"Error setting {name} to {value}: {result.error}")
+        logging.info(f"Camera profile {profile['name']} applied in {time.monotonic()-start:.2f} s")
+        return True
@@ -0,0 +1,361 @@
+import logging
+import os
+import queue
+import re
+import subprocess
+import threading
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from typing import List
+import cv2
+import numpy as np
+import globals
+
+
+@dataclass
+class CommandResult:
+    success: bool
+    output: List[str] = field(default_factory=list)
+    error: str = None
+    duration: float = 0.0
+    timestamps: List[float] = field(default_factory=list)     # monotonic arrival time of every output line
+
+@dataclass
+class CaptureResult:
+    success: bool
+    file_name: str = None
+    error: str = None
+    duration: float = 0.0
+    shutter_time: float = None                                # monotonic time the camera reported the shot
+
+
+class CameraSession(ABC):
+    # A connection to the camera that stays open between shots
+    prefocus_config = {}
+
+    @abstractmethod
+    def open(self) -> bool:
+        pass
+
+    def close(self):
+        pass
+
+    @abstractmethod
+    def is_open(self) -> bool:
+        pass
+
+    @abstractmethod
+    def capture(self, file_name) -> CaptureResult:
+        pass
+
+    @abstractmethod
+    def set_config(self, name, value) -> CommandResult:
+        pass
+
+    def start_liveview(self) -> CommandResult:
+        # some cameras (e.g. Canon M3) switch to playback after a capture. A preview capture switches them back.
+        return CommandResult(True)
+
+    def prefocus(self) -> CommandResult:
+        # half-press: focus now so the shot does not wait for the autofocus
+        start = time.monotonic()
+        if not self.open():
+            return CommandResult(False, error="Camera session is not available")
+        for name, value in self.prefocus_config.items():
+            result = self.set_config(name, value)
+            if not result.success:
+                return result
+        return CommandResult(True, duration=time.monotonic()-start)
+
+
+class GPhoto2ShellSession(CameraSession):
+    # Keeps one "gphoto2 --shell" process running. The USB device is enumerated and the
+    # PTP session is opened only once, every shot afterwards is a single shell command.
+
+    PROMPT = re.compile(rb"gphoto2: \{[^}]*\}[^\n>]*> ?$")
+    SAVED_FILE = re.compile(r"Saving file as (.+)$")
+    NEW_FILE = re.compile(r"New file is in location")
+    COMMAND_TIMEOUT_SECONDS = 10
+    CAPTURE_TIMEOUT_SECONDS = 30
+    _PROMPT_MARKER = object()
+
+    def __init__(self, camera_name):
+        self.camera_name = camera_name
+        self.process = None
+        self.output = None
+        self.local_dir = None
+        self.last_used = 0.0
+        self.lock = threading.RLock()
+
+    def open(self) -> bool:
+        with self.lock:
+            if self.is_open():
+                return True
+            if LIVEVIEW is not None:
+                LIVEVIEW.suspend()                          # only one gphoto2 process can use the camera
+            args = ["gphoto2", "--shell", "--keep", "--force-overwrite"]
+            if self.camera_name is not None:
+                args += ["--camera", self.camera_name]
+            logging.info(f"Opening camera session: {' '.join(args)}")
+            try:
+                self.process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            except OSError as e:
+                logging.error(f"Unable to start gphoto2 shell: {e}")
+                self.process = None
+                return False
+            self.output = queue.Queue()
+            self.local_dir = None
+            threading.Thread(target=self._read_output, args=(self.process, self.output), daemon=True).start()
+
+            # wait for the first prompt, the camera is ready afterwards
+            result = self._collect(self.COMMAND_TIMEOUT_SECONDS, time.monotonic())
+            if not result.success:
+                logging.error(f"Camera session did not come up: {result.error}")
+                self.close()
+                return False
+
+            if self.camera_name is not None and "Canon" in self.camera_name and "M3" in self.camera_name:
+                self.set_config("chdk", "On")
+            return True
+
+    def close(self):
+        with self.lock:
+            if self.process is None:
+                return
+            try:
+                self.process.stdin.write(b"exit\n")
+                self.process.stdin.flush()
+                self.process.wait(timeout=2)
+            except (OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+            self.process = None
+            logging.info("Camera session closed")
+
+    def is_open(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def command(self, line, timeout=COMMAND_TIMEOUT_SECONDS) -> CommandResult:
+        with self.lock:
+            if not self.open():
+                return CommandResult(False, error="Camera session is not available")
+            start = time.monotonic()
+            try:
+                self.process.stdin.write((line + "\n").encode())
+                self.process.stdin.flush()
+            except OSError as e:
+                self.close()
+                return CommandResult(False, error=f"Camera session died: {e}")
+            result = self._collect(timeout, start)
+            self.last_used = time.monotonic()
+            if not result.success:
+                # the shell is out of sync with us or gone, start a new one on the next command
+                self.close()
+            elif result.error is None and any("*** Error" in l for l in result.output):
+                result.success = False
+                result.error = next(l for l in result.output if "*** Error" in l)
+            return result
+
+    def set_config(self, name, value) -> CommandResult:
+        return self.command(f"set-config {name}={value}")
+
+    def start_liveview(self) -> CommandResult:
+        result = self.command("capture-preview")
+        for line in result.output:
+            match = self.SAVED_FILE.search(line)
+            if match:
+                try:
+                    os.remove(os.path.join(self.local_dir or os.getcwd(), match.group(1).strip()))
+                except OSError:
+                    pass
+        return result
+
+    def capture(self, file_name) -> CaptureResult:
+        with self.lock:
+            start = time.monotonic()
+            target_dir = os.path.dirname(os.path.abspath(file_name))
+            if target_dir != self.local_dir:
+                result = self.command(f"lcd {target_dir}")
+                if not result.success:
+                    return CaptureResult(False, error=result.error, duration=time.monotonic()-start)
+                self.local_dir = target_dir
+
+            result = self.command("capture-image-and-download", self.CAPTURE_TIMEOUT_SECONDS)
+            if not result.success:
+                return CaptureResult(False, error=result.error, duration=time.monotonic()-start)
+
+            # the camera reports the new file right after the shutter closed
+            shutter_time = next((t for l, t in zip(result.output, result.timestamps) if self.NEW_FILE.search(l)), None)
+            saved = [m.group(1).strip() for m in map(self.SAVED_FILE.search, result.output) if m]
+            if len(saved) == 0:
+                return CaptureResult(False, error="Camera did not deliver a file", duration=time.monotonic()-start)
+
+            # the shell saves with the name from the camera. Rename it to the requested name.
+            try:
+                os.replace(os.path.join(target_dir, saved[-1]), file_name)
+            except OSError as e:
+                return CaptureResult(False, error=f"Downloaded file is missing: {e}", duration=time.monotonic()-start)
+            return CaptureResult(True, file_name, duration=time.monotonic()-start, shutter_time=shutter_time)
+
+    def _collect(self, timeout, start) -> CommandResult:
+        lines = []
+        timestamps = []
+        deadline = start + timeout
+        while True:
+            try:
+                timestamp, line = self.output.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                return CommandResult(False, lines, "Timeout waiting for camera", time.monotonic()-start)
+            if line is None:
+                return CommandResult(False, lines, "Camera session ended", time.monotonic()-start)
+            if line is self._PROMPT_MARKER:
+                return CommandResult(True, lines, duration=timestamp-start, timestamps=timestamps)
+            lines.append(line)
+            timestamps.append(timestamp)
+
+    def _read_output(self, process, output):
+        pending = b""
+        fd = process.stdout.fileno()
+        while True:
+            try:
+                chunk = os.read(fd, 4096)
+            except OSError:
+                chunk = b""
+            if not chunk:
+                output.put((time.monotonic(), None))
+                return
+            now = time.monotonic()
+            pending += chunk
+            *lines, pending = pending.split(b"\n")
+            for line in lines:
+                line = line.decode(errors="replace").rstrip("\r")
+                logging.debug(f"gphoto2: {line}")
+                output.put((now, line))
+            # the prompt is not terminated by a newline
+            if self.PROMPT.search(pending):
+                output.put((now, self._PROMPT_MARKER))
+                pending = b""
+
+
+class FakeCameraSession(CameraSession):
+    # Simulates a camera without hardware by writing a generated JPEG for every shot.
+    # Focusing, releasing the shutter and transferring the file take the configured time.
+
+    NAME = "Fake Camera"
+
+    def __init__(self, focus_delay=0.3, shutter_delay=0.05, transfer_delay=0.4, resolution=(6000, 4000)):
+        self.focus_delay = focus_delay
+        self.shutter_delay = shutter_delay
+        self.transfer_delay = transfer_delay
+        self.resolution = resolution
+        self.opened = False
+        self.focused = False
+        self.shots = 0
+        self.jpeg = None
+        self.lock = threading.Lock()
+
+    def open(self) -> bool:
+        if self.jpeg is None:
+            width, height = self.resolution
+            gradient = np.linspace(0, 255, width, dtype=np.uint8)
+            image = np.dstack([np.tile(gradient, (height, 1)), np.tile(gradient[::-1], (height, 1)), np.full((height, width), 128, np.uint8)])
+            self.jpeg = cv2.imencode(".jpg", image)[1].tobytes()
+        self.opened = True
+        return True
+
+    def close(self):
+        self.opened = False
+
+    def is_open(self) -> bool:
+        return self.opened
+
+    def set_config(self, name, value) -> CommandResult:
+        self.open()
+        return CommandResult(True, [f"{name}={value}"])
+
+    def prefocus(self) -> CommandResult:
+        with self.lock:
+            start = time.monotonic()
+            self.open()
+            time.sleep(self.focus_delay)
+            self.focused = True
+            return CommandResult(True, duration=time.monotonic()-start)
+
+    def capture(self, file_name) -> CaptureResult:
+        with self.lock:
+            start = time.monotonic()
+            self.open()
+            if not self.focused:
+                time.sleep(self.focus_delay)
+            time.sleep(self.shutter_delay)
+            shutter_time = time.monotonic()
+            self.focused = False
+            time.sleep(self.transfer_delay)
+            with open(file_name, "wb") as f:
+                f.write(self.jpeg)
+            self.shots += 1
+            return CaptureResult(True, file_name, duration=time.monotonic()-start, shutter_time=shutter_time)
+
+
+SESSION = None
+LIVEVIEW = None                                               # gphoto2 live view, stopped while the session needs the camera
+
+def get_session() -> CameraSession:
+    # returns the shared session for the current camera and replaces it if the camera changed
+    global SESSION
+    if globals.SETTINGS.get("CAMERA_BACKEND") == "fake":
+        if not isinstance(SESSION, FakeCameraSession):
+            SESSION = FakeCameraSession()
+    elif not isinstance(SESSION, GPhoto2ShellSession) or SESSION.camera_name != globals.CURRENT_CAMERA:
+        if SESSION is not None:
+            SESSION.close()
+        SESSION = GPhoto2ShellSession(globals.CURRENT_CAMERA)
+    return SESSION
+
+def register_liveview(liveview):
+    global LIVEVIEW
+    LIVEVIEW = liveview
+
+def release_camera(idle_seconds) -> bool:
+    # closes the shell session for the live view if it did not use the camera for idle_seconds,
+    # returns True if the camera is free
+    session = SESSION
+    if not isinstance(session, GPhoto2ShellSession):
+        return True
+    if not session.lock.acquire(blocking=False):
+        return False                                          # a command is running
+    try:
+        if not session.is_open():
+            return True
+        if time.monotonic() - session.last_used < idle_seconds:
+            return False
+        session.close()
+        return True
+    finally:
+        session.lock.release()
+
+def close_session():
+    global SESSION
+    if SESSION is not None:
+        SESSION.close()
+        SESSION = None
+
+
+if __name__ == "__main__":
+    # measure capture throughput: python cameraSession.py [--fake] [shots]
+    import sys, tempfile
+    logging.basicConfig(level=logging.INFO)
+    globals.init()
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    shots = int(args[0]) if args else 10
+    session = FakeCameraSession() if "--fake" in sys.argv else GPhoto2ShellSession(None)
+    if not session.open():
+        sys.exit("Unable to open camera session")
+    target_dir = tempfile.mkdtemp()
+    start = time.monotonic()
+    for i in range(shots):
+        result = session.capture(os.path.join(target_dir, f"shot_{i}.jpg"))
+        print(result)
+    elapsed = time.monotonic() - start
+    print(f"{shots} shots in {elapsed:.2f} s ({shots/elapsed:.2f} shots/s)")
+    session.close()
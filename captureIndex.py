@@ -0,0 +1,252 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from PIL import Image
+import derivatives
+
+INDEX_FILE = ".captures.sqlite"
+IMAGE_EXTENSIONS = (".jpg", ".jpeg")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS captures (
+    id TEXT PRIMARY KEY,                -- file name without extension
+    file_name TEXT NOT NULL,            -- relative to the index directory
+    kind TEXT NOT NULL,                 -- "photo" or "collage"
+    created REAL NOT NULL,
+    mtime_ns INTEGER,
+    size INTEGER,
+    width INTEGER,
+    height INTEGER,
+    thumbnail TEXT,
+    collage_id TEXT REFERENCES captures(id),
+    capture_seconds REAL,               -- photos: trigger until the file was on disk, collages: rendering
+    shutter_lag_ms REAL,
+    prints INTEGER NOT NULL DEFAULT 0,
+    shares INTEGER NOT NULL DEFAULT 0,
+    share_link TEXT,
+    deleted REAL                        -- time of deletion, NULL while the file exists
+);
+CREATE INDEX IF NOT EXISTS captures_created ON captures(created);
+CREATE INDEX IF NOT EXISTS captures_collage ON captures(collage_id);
+CREATE TABLE IF NOT EXISTS events (
+    capture_id TEXT NOT NULL REFERENCES captures(id),
+    time REAL NOT NULL,
+    event TEXT NOT NULL,                -- capture, collage, print, share, delete, missing
+    detail TEXT
+);
+CREATE INDEX IF NOT EXISTS events_capture ON events(capture_id);
+"""
+
+
+def capture_kind(file_name) -> str:
+    return "collage" if os.path.basename(file_name).startswith("collage_") else "photo"
+
+
+def image_size(path):
+    # only the header is read, the image is not decoded
+    try:
+        with Image.open(path) as image:
+            return image.size
+    except OSError:
+        return None, None
+
+
+class CaptureIndex:
+    # Remembers every capture in root in an SQLite database next to the photos: size,
+    # thumbnail, collage membership, timings and what guests did with it. Every change is
+    # one transaction, written by a single background thread so the GUI never waits on the
+    # disk. Reads are answered directly.
+
+    def __init__(self, root, db_path=None):
+        self.root = root
+        self.db_path = db_path or os.path.join(root, INDEX_FILE)
+        os.makedirs(root, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.executescript(SCHEMA)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="capture-index")
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        with self.lock:
+            self.db.close()
+
+    def _relative(self, file_name) -> str:
+        return os.path.relpath(os.path.abspath(file_name), os.path.abspath(self.root))
+
+    def _submit(self, function, *args) -> Future:
+        future = self.executor.submit(function, *args)
+        future.add_done_callback(lambda f: f.exception() and logging.error(f"Updating capture index failed: {f.exception()}"))
+        return future
+
+    def _write(self, statements):
+        # statements is a list of (sql, parameters), all of them are one transaction
+        with self.lock, self.db:
+            for sql, parameters in statements:
+                self.db.execute(sql, parameters)
+
+    def _upsert_statement(self, file_name, now, **values):
+        path = os.path.join(self.root, file_name)
+        stat = os.stat(path)
+        width, height = image_size(path)
+        thumbnail = derivatives.derivative_path(file_name, "thumbnail")
+        row = dict(id=derivatives.capture_id(file_name), file_name=file_name, kind=capture_kind(file_name),
+                   created=stat.st_mtime, mtime_ns=stat.st_mtime_ns, size=stat.st_size, width=width, height=height,
+                   thumbnail=thumbnail, **values)
+        columns = ", ".join(row)
+        updates = ", ".join(f"{c}=excluded.{c}" for c in row if c not in ("id", "created"))
+        return (f"INSERT INTO captures ({columns}) VALUES ({', '.join('?'*len(row))}) "
+                f"ON CONFLICT(id) DO UPDATE SET {updates}, deleted=NULL", list(row.values()))
+
+    def _event(self, capture_id, event, now, detail=None):
+        return "INSERT INTO events (capture_id, time, event, detail) VALUES (?, ?, ?, ?)", (capture_id, now, event, detail)
+
+    def _record_capture(self, file_name, capture_seconds, shutter_lag_ms):
+        now = time.time()
+        file_name = self._relative(file_name)
+        self._write([self._upsert_statement(file_name, now, capture_seconds=capture_seconds, shutter_lag_ms=shutter_lag_ms),
+                     self._event(derivatives.capture_id(file_name), "capture", now)])
+
+    def _record_collage(self, file_name, members, render_seconds):
+        now = time.time()
+        file_name = self._relative(file_name)
+        collage_id = derivatives.capture_id(file_name)
+        statements = [self._upsert_statement(file_name, now, capture_seconds=render_seconds),
+                      self._event(collage_id, "collage", now, ",".join(derivatives.capture_id(m) for m in members))]
+        statements += [("UPDATE captures SET collage_id=? WHERE id=?", (collage_id, derivatives.capture_id(m))) for m in members]
+        self._write(statements)
+
+    def _record_print(self, file_name):
+        capture_id = derivatives.capture_id(file_name)
+        self._write([("UPDATE captures SET prints=prints+1 WHERE id=?", (capture_id,)),
+                     self._event(capture_id, "print", time.time())])
+
+    def _record_share(self, file_name, link):
+        capture_id = derivatives.capture_id(file_name)
+        self._write([("UPDATE captures SET shares=shares+1, share_link=? WHERE id=?", (link, capture_id)),
+                     self._event(capture_id, "share", time.time(), link)])
+
+    def _record_delete(self, file_name, event="delete"):
+        now = time.time()
+        capture_id = derivatives.capture_id(file_name)
+        self._write([("UPDATE captures SET deleted=? WHERE id=? AND deleted IS NULL", (now, capture_id)),
+                     self._event(capture_id, event, now)])
+
+    def record_capture(self, file_name, capture_seconds=None, shutter_lag_ms=None) -> Future:
+        return self._submit(self._record_capture, file_name, capture_seconds, shutter_lag_ms)
+
+    def record_collage(self, file_name, members, render_seconds=None) -> Future:
+        # members are the file names of the photos in the collage
+        return self._submit(self._record_collage, file_name, list(members), render_seconds)
+
+    def record_print(self, file_name) -> Future:
+        return self._submit(self._record_print, file_name)
+
+    def record_share(self, file_name, link) -> Future:
+        return self._submit(self._record_share, file_name, link)
+
+    def record_delete(self, file_name) -> Future:
+        return self._submit(self._record_delete, file_name)
+
+    def _rebuild(self):
+        # Only files that are new or changed since the last run are opened, files that
+        # disappeared are marked as deleted. Collage membership can not be recovered from
+        # the files, it is kept as it was.
+        start = time.perf_counter()
+        with self.lock:
+            known = {row["file_name"]: row for row in self.db.execute("SELECT file_name, mtime_ns, size, deleted FROM captures")}
+        on_disk = {}
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS) and not entry.name.startswith("."):
+                    on_disk[entry.name] = entry.stat()
+
+        now = time.time()
+        statements = []
+        for name, stat in on_disk.items():
+            row = known.get(name)
+            if row is None or row["mtime_ns"] != stat.st_mtime_ns or row["size"] != stat.st_size or row["deleted"] is not None:
+                statements.append(self._upsert_statement(name, now))
+        updated = len(statements)
+        missing = [name for name, row in known.items() if name not in on_disk and row["deleted"] is None]
+        for name in missing:
+            capture_id = derivatives.capture_id(name)
+            statements.append(("UPDATE captures SET deleted=? WHERE id=?", (now, capture_id)))
+            statements.append(self._event(capture_id, "missing", now))
+        if statements:
+            self._write(statements)
+        result = {"files": len(on_disk), "updated": updated, "missing": len(missing), "seconds": time.perf_counter() - start}
+        logging.info(f"Capture index of {self.root} updated in {result['seconds']:.2f} s: {result['files']} files, "
+                     f"{result['updated']} new or changed, {result['missing']} missing")
+        return result
+
+    def rebuild(self) -> Future:
+        # resolves with counts of what was found
+        return self._submit(self._rebuild)
+
+    def _query(self, sql, parameters=()):
+        with self.lock:
+            return [dict(row) for row in self.db.execute(sql, parameters)]
+
+    def get(self, file_name) -> dict:
+        rows = self._query("SELECT * FROM captures WHERE id=?", (derivatives.capture_id(file_name),))
+        return rows[0] if rows else None
+
+    def captures(self, kind=None, include_deleted=False) -> list:
+        # newest first
+        conditions = ["1"]
+        parameters = []
+        if kind is not None:
+            conditions.append("kind=?")
+            parameters.append(kind)
+        if not include_deleted:
+            conditions.append("deleted IS NULL")
+        return self._query(f"SELECT * FROM captures WHERE {' AND '.join(conditions)} ORDER BY created DESC", parameters)
+
+    def collage_members(self, collage_file_name) -> list:
+        return self._query("SELECT * FROM captures WHERE collage_id=? ORDER BY created", (derivatives.capture_id(collage_file_name),))
+
+    def stats(self) -> dict:
+        row = self._query("""SELECT
+            SUM(kind='photo' AND deleted IS NULL) AS photos,
+            SUM(kind='collage' AND deleted IS NULL) AS collages,
+            SUM(deleted IS NOT NULL) AS deleted,
+            SUM(prints) AS prints,
+            SUM(shares) AS shares,
+            AVG(CASE WHEN kind='photo' THEN capture_seconds END) AS capture_seconds_avg,
+            AVG(shutter_lag_ms) AS shutter_lag_ms_avg,
+            AVG(CASE WHEN kind='collage' THEN capture_seconds END) AS render_seconds_avg
+            FROM captures""")[0]
+        return {key: value or 0 for key, value in row.items()}
+
+
+INDEX = None
+
+def open_index(root) -> CaptureIndex:
+    # (re)opens the index of root and brings it up to date in the background
+    global INDEX
+    if INDEX is not None and os.path.abspath(INDEX.root) == os.path.abspath(root):
+        return INDEX
+    if INDEX is not None:
+        INDEX.close()
+    try:
+        INDEX = CaptureIndex(root)
+    except (OSError, sqlite3.Error) as e:
+        logging.error(f"Unable to open capture index in {root}: {e}")
+        INDEX = None
+        return None
+    INDEX.rebuild()
+    return INDEX
+
+def close_index():
+    global INDEX
+    if INDEX is not None:
+        INDEX.close()
+        INDEX = None
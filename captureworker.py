@@ -1,73 +1,141 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import logging
 import os
-import subprocess
 from threading import Timer
 import time
 from PyQt6.QtCore import QThread, pyqtSignal, pyqtSlot, QObject
 import globals
-import asyncio
-import PySide6.QtAsyncio as QtAsyncio
+import cameraSession
+import captureIndex
+import derivatives
+import filters
+import tracing
+import share_gdrive
+from countdown import CountdownScheduler
+from fileWatcher import wait_for_complete_file
+
+
+def switch_canon_to_liveview():
+    # only do this if we use a Canon M3
+    if globals.CURRENT_CAMERA is not None and "Canon" in globals.CURRENT_CAMERA and "M3" in globals.CURRENT_CAMERA:
+        # canon eos m3 goes to picture playback on usb connect and after taking images
+        # this function resets it to shooting mode/liveview
+        # install chdk on your sd card and run this command gphoto2 --set-config chdk=On
+        result = cameraSession.get_session().start_liveview()
+        if not result.success:
+            logging.error(f"Unable to switch camera to liveview: {result.error}")
 
 
 class CaptureWorker(QObject):
     progress = pyqtSignal(int)
     capture_finished = pyqtSignal()
     preview_finished = pyqtSignal()
-    countdown = 0
     capture_error = pyqtSignal(str)
-    countdown_timer = None
+    liveview_ready = pyqtSignal()
+    preview_timer = None
+    next_file_name = None
+    FILE_TIMEOUT_SECONDS = 10.0
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        # child objects follow the worker into its thread, so the countdown runs on the worker's event loop
+        self.countdown = CountdownScheduler(self)
+        self.countdown.tick.connect(self.countdown_tick)
+        self.countdown.finished.connect(self.capture_image)
+        # focusing runs beside the countdown so it does not delay the ticks
+        self.prearm_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prearm")
 
     def cancel_preview_timer(self):
         if self.preview_timer is not None:
             self.preview_timer.cancel()
 
-    def countdown_elapsed(self):
-        if self.countdown == 0:
-            self.countdown_timer.cancel()
-            self.countdown_timer = None
-            self.run_async(self.capture_image())
+    @pyqtSlot()
+    def cancel_countdown(self):
+        self.countdown.cancel()
+
+    @pyqtSlot()
+    def switch_to_liveview(self):
+        # waits for the camera session, so it must not run on the GUI thread
+        switch_canon_to_liveview()
+        self.liveview_ready.emit()
+
+    @pyqtSlot(int, float)
+    def countdown_tick(self, secs_left, jitter):
+        logging.debug(f"Countdown tick {secs_left} (jitter {jitter:.1f} ms)")
+        tracing.TRACER.instant("tick", seconds_left=secs_left, jitter_ms=round(jitter, 1))
+        if secs_left == min(globals.SETTINGS["PREARM_SECONDS"], self.countdown.seconds) and secs_left > 0:
+            self.prearm()
+        self.progress.emit(secs_left)
+
+    def prearm(self):
+        # get everything ready so the shutter is released right on the last tick
+        logging.info("Pre-arming camera")
+        self.ensureTargetDirExists()
+        self.next_file_name = self.new_file_name()
+        self.prearm_executor.submit(self.prefocus, cameraSession.get_session())
+
+    def prefocus(self, session):
+        result = session.prefocus()
+        if result.success:
+            logging.info(f"Camera focused in {result.duration:.2f} s")
         else:
-            self.progress.emit(self.countdown)
-            self.countdown -= 1
-            self.countdown_timer = Timer(1,self.countdown_elapsed)
-            self.countdown_timer.start()
+            logging.warning(f"Pre-focus failed, capture will focus itself: {result.error}")
 
+    def new_file_name(self):
+        return os.path.join(globals.SETTINGS["TARGET_DIR"], "photobox_%s.jpg" %datetime.now().strftime("%m%d%Y_%H%M%S"))
 
-    async def capture_image(self):
+    @pyqtSlot()
+    def capture_image(self):
         logging.info('Capturing image')
-        globals.FILE_NAME = os.path.join(globals.SETTINGS["TARGET_DIR"], "photobox_%s.jpg" %datetime.now().strftime("%m%d%Y_%H%M%S"))
+        fire_time = self.countdown.deadline(self.countdown.seconds)
+        globals.FILE_NAME = self.next_file_name or self.new_file_name()
+        self.next_file_name = None
         
         logging.info(f"Capturing image to {globals.FILE_NAME}")
 
         logging.info("Starting capture")
-        args = ["gphoto2", "--filename",globals.FILE_NAME, "--capture-image-and-download", "--force-overwrite", "--keep", "--camera", globals.CURRENT_CAMERA]
-
-        if globals.CURRENT_CAMERA is not None and "Canon" in globals.CURRENT_CAMERA and "M3" in globals.CURRENT_CAMERA:
-            args += ["--set-config", "chdk=On"]
-
-        captureProc = subprocess.Popen(args)
-        # wait for completion
-        captureProc.communicate()
-        # check exit code of captureProc
-        if captureProc.returncode != None and captureProc.returncode != 0:
-            logging.error(f"Error capturing image: {captureProc}")
+        tracing.TRACER.end("countdown")
+        tracing.TRACER.set_capture_id(derivatives.capture_id(globals.FILE_NAME))
+        with tracing.TRACER.span("capture"):
+            result = cameraSession.get_session().capture(globals.FILE_NAME)
+        if not result.success:
+            logging.error(f"Error capturing image: {result.error}")
+            tracing.TRACER.instant("error", error=result.error)
+            tracing.TRACER.end_session()
             self.capture_error.emit("Error capturing image")
             return
+        logging.info(f"Image captured in {result.duration:.2f} s")
+        if result.shutter_time is not None:
+            logging.info(f"Shutter lag: {1000*(result.shutter_time - fire_time):.0f} ms")
 
-        globals.FREEZE_STREAM = True
+        globals.set_freeze_stream(True)
 
         # wait for image to transfer from camera to device
         try:
-            await asyncio.wait_for(self.wait_for_file(globals.FILE_NAME), timeout=10.0)
-        except asyncio.TimeoutError:
-            logging.error(f"timeout when waiting for file with name: {globals.FILE_NAME} to be present")
-            self.capture_error.emit()
+            with tracing.TRACER.span("file_arrival"):
+                self.wait_for_file(globals.FILE_NAME)
+        except TimeoutError:
+            logging.error(f"timeout when waiting for file with name: {globals.FILE_NAME} to be complete")
+            tracing.TRACER.instant("error", error="file timeout")
+            tracing.TRACER.end_session()
+            self.capture_error.emit("Timeout waiting for image")
             return
+        # preview, print, share and thumbnail versions are created in the background right away
+        derivatives.PIPELINE.submit(globals.FILE_NAME, filters.ENGINE.look())
+        if captureIndex.INDEX is not None:
+            shutter_lag = 1000*(result.shutter_time - fire_time) if result.shutter_time is not None else None
+            captureIndex.INDEX.record_capture(globals.FILE_NAME, time.monotonic() - fire_time, shutter_lag)
+        # single photos are uploaded right away, collages once they are rendered
+        if globals.CAPTURE_MODE == globals.CaptureMode.SINGLE and globals.SETTINGS["SPECULATIVE_UPLOAD"] and share_gdrive.QUEUE is not None:
+            share_gdrive.QUEUE.enqueue(globals.FILE_NAME)
 
         # only show preview if in single mode or last image of collage
         if globals.CAPTURE_MODE == globals.CaptureMode.SINGLE or  globals.CURRENT_COLLAGE is not None and globals.CURRENT_COLLAGE.currentImage == len(globals.CURRENT_COLLAGE.images) - 1:
+            tracing.TRACER.begin("preview")                                 # ends when the preview is on screen
             self.start_preview_countdown()
+        else:
+            tracing.TRACER.end_session()
         self.capture_finished.emit()
         
 
@@ -79,25 +147,14 @@ class CaptureWorker(QObject):
             self.capture_error.emit("Camera is not detected yet. Unable to take a photo")
             return
         
-        self.countdown = globals.SETTINGS["COUNTDOWN_TIME_SECONDS"]
         logging.info("Countdown started")
-
-        # set back timer in case there is still one active
-        if self.countdown_timer is not None and self.countdown_timer.isActive():
-            self.countdown_timer.cancel()
-            self.countdown_timer = None
-
-        self.countdown_timer = Timer(1,self.countdown_elapsed)
-
-        # manually trigger first countdown_elapsed call
-        self.progress.emit(self.countdown)
-        self.countdown -= 1
-
-        self.countdown_timer.start()
+        tracing.TRACER.begin("countdown", seconds=globals.SETTINGS["COUNTDOWN_TIME_SECONDS"])
+        # restarting cancels a countdown that is still active
+        self.countdown.start(globals.SETTINGS["COUNTDOWN_TIME_SECONDS"])
 
 
     def start_preview_countdown(self):
-        self.preview_timer = Timer(globals.SETTINGS["PREVIEW_TIME_SECONDS"],self.on_preview_finished)
+        self.preview_timer = Timer(globals.SESSION.preview_time(),self.on_preview_finished)
         self.preview_timer.start()  
 
     def ensureTargetDirExists(self):
@@ -120,29 +177,7 @@ class CaptureWorker(QObject):
         logging.info("preview time finished. Returning to start screen")
         self.preview_finished.emit()
 
-    async def wait_for_file(self,file_path, check_interval=1):
-        logging.info(f"Waiting for file {file_path} to be present")
-        while True:
-            if os.path.exists(file_path):
-                return True
-            await asyncio.sleep(check_interval)
-
-    def run_async(self,future, as_task=True):
-        """
-        A better implementation of `asyncio.run`.
-
-        :param future: A future or task or call of an async method.
-        :param as_task: Forces the future to be scheduled as task (needed for e.g. aiohttp).
-        """
-
-        try:
-            loop = asyncio.get_running_loop()
-        except RuntimeError:  # no event loop running:
-            loop = asyncio.new_event_loop()
-            return loop.run_until_complete(self._to_task(future, as_task, loop))
-
-
-    def _to_task(self,future, as_task, loop):
-        if not as_task or isinstance(future, asyncio.Task):
-            return future
-        return loop.create_task(future)
\ No newline at end of file
+    def wait_for_file(self,file_path):
+        logging.info(f"Waiting for file {file_path} to be complete")
+        if not wait_for_complete_file(file_path, self.FILE_TIMEOUT_SECONDS):
+            raise TimeoutError()
@@ -1,48 +1,177 @@
+import logging
+import math
 import os
-import numpy as np
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
 import globals
-from PIL import Image, ImageChops, ImageOps
+import derivatives
+import imageCache
+from PIL import Image, ImageOps
+
+
+class CollageError(Exception):
+    pass
+
+
+@dataclass
+class RenderStats:
+    slots: int
+    duration: float
+    peak_bytes: int
+
+
+def image_bytes(image) -> int:
+    return image.width * image.height * len(image.getbands())
 
 
 class CollageRenderer:
 
+    def __init__(self):
+        self.live_bytes = 0
+        self.peak_bytes = 0
+
+    # rough accounting of the pixel buffers alive at the same time
+    def track(self, image):
+        self.live_bytes += image_bytes(image)
+        self.peak_bytes = max(self.peak_bytes, self.live_bytes)
+        return image
+
+    def release(self, *images):
+        self.live_bytes -= sum(image_bytes(i) for i in images)
+
     def fit_image_to_placeholder(self,image, placeholder_size):
         return ImageOps.fit(image, placeholder_size, Image.LANCZOS)
 
-    def renderImagesToCollage(self, collage: globals.Collage, targetFile: str):
-        # Load the collage template
-        collage_template_path = os.path.join(os.path.dirname(__file__), "ui", "collages", collage.name)
-        collage_template = Image.open(collage_template_path).convert("RGBA")
-        if collage_template is None:
-            print(f"Failed to read collage template: {collage_template_path}")
-            return
-        
-        # Render the images to the collage
+    def load_slot_image(self, imagePosition: globals.ImagePosition):
+        # Decodes, scales, rotates and crops one photo for its placeholder.
+        # The photo is scaled down first, so rotation only touches placeholder sized pixels.
+        fullPath = os.path.join(os.path.dirname(__file__), imagePosition.imagePath)
+        placeholder_size = (imagePosition.size.width, imagePosition.size.height)
+        angle = (imagePosition.angle or 0) % 360
+
+        # filtered photos are composited from the original, the look is applied to the slot
+        fullPath, look = derivatives.PIPELINE.source(fullPath)
+
+        # size of the photo that covers the placeholder after rotation
+        width, height = imageCache.CACHE.source_size(fullPath)
+        cos, sin = abs(math.cos(math.radians(angle))), abs(math.sin(math.radians(angle)))
+        rotated_width = width*cos + height*sin
+        rotated_height = width*sin + height*cos
+        scale = min(1.0, max(placeholder_size[0]/rotated_width, placeholder_size[1]/rotated_height))
+        scaled_size = (max(1, math.ceil(width*scale)), max(1, math.ceil(height*scale)))
+
+        # JPEGs are decoded at the smallest of 1/1, 1/2, 1/4 or 1/8 scale that is still large
+        # enough, often the derivatives of the photo decoded it already
+        decoded = self.track(imageCache.CACHE.get(fullPath, scaled_size))
+
+        scaled = decoded
+        if decoded.size != scaled_size:
+            scaled = self.track(decoded.resize(scaled_size, Image.LANCZOS))
+            self.release(decoded)
+
+        if angle != 0:
+            rgba = self.track(scaled.convert("RGBA"))
+            self.release(scaled)
+            rotated = self.track(rgba.rotate(angle, expand=True, resample=Image.BICUBIC))
+            self.release(rgba)
+            scaled = rotated
+        fitted = self.track(derivatives.apply_look(self.fit_image_to_placeholder(scaled, placeholder_size), look))
+        self.release(scaled)
+        return fitted
+
+    def paste_slot_image(self, canvas, imagePosition: globals.ImagePosition, fitted_image):
+        mask = fitted_image if fitted_image.mode == "RGBA" else None
+        canvas.paste(fitted_image, (imagePosition.position.x, imagePosition.position.y), mask)
+        if imagePosition.offset:
+            canvas.paste(fitted_image, (imagePosition.position.x + imagePosition.offset, imagePosition.position.y), mask)
+
+    def load_template(self, collage: globals.Collage, template=None):
+        # template may be an already loaded RGBA image of the collage template
+        if template is None:
+            collage_template_path = os.path.join(os.path.dirname(__file__), "ui", "collages", collage.name)
+            with Image.open(collage_template_path) as template:
+                template = template.convert("RGBA")
+        # every photo is pasted onto one canvas holding the template
+        canvas = self.track(Image.new("RGBA", template.size))
+        canvas.paste(template, (0, 0), template)
+        return canvas
+
+    def renderImagesToCollage(self, collage: globals.Collage, targetFile: str) -> RenderStats:
+        start = time.perf_counter()
+        self.live_bytes = 0
+        self.peak_bytes = 0
+
+        canvas = self.load_template(collage)
+
+        # Render the images to the collage in a single pass
         for imagePosition in collage.images:
-            fullPath = os.path.join(os.path.dirname(__file__), imagePosition.imagePath)
-            print(fullPath)
-            image = Image.open(fullPath).convert("RGBA")
-            rotated_image = image.rotate(imagePosition.angle, expand=True, resample=Image.BICUBIC)
-            placeholder_size = (imagePosition.size.width, imagePosition.size.height)
-            fitted_image = self.fit_image_to_placeholder(rotated_image, placeholder_size)
-            
-        # Create a new image with the same size as the template
-            result = Image.new("RGBA", collage_template.size)
+            fitted_image = self.load_slot_image(imagePosition)
+            self.paste_slot_image(canvas, imagePosition, fitted_image)
+            self.release(fitted_image)
+
+        # Save the final collage as JPG
+        result_rgb = self.track(canvas.convert('RGB'))
+        result_rgb.save(targetFile, "JPEG")
 
-            # Paste the template onto the result image
-            result.paste(collage_template, (0, 0), collage_template)
+        stats = RenderStats(len(collage.images), time.perf_counter() - start, self.peak_bytes)
+        logging.info(f"Collage with {stats.slots} images rendered in {stats.duration:.2f} s, peak memory {stats.peak_bytes/2**20:.0f} MB")
+        return stats
 
-            # Paste the rotated and trimmed image onto the result
-            result.paste(fitted_image, (imagePosition.position.x, imagePosition.position.y), fitted_image)
 
-            result.paste(fitted_image, (imagePosition.position.x + imagePosition.offset, imagePosition.position.y), fitted_image)
+# collages are composited one after another in the background
+RENDER_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="collage")
 
-            collage_template = result
 
-        
-        # Save the final collage
-        # Convert the result to RGB mode
-        result_rgb = collage_template.convert('RGB')
+class IncrementalCollage:
+    # Renders a collage while it is being shot. Every photo is decoded, fitted and pasted
+    # in the background as soon as it arrives, finishing only encodes the JPEG.
 
-        # Save the result as JPG
+    def __init__(self, collage: globals.Collage, template: Future = None, renderer: CollageRenderer = None):
+        # template optionally resolves with the loaded template (see TemplateRegistry.load_template)
+        self.collage = collage
+        self.renderer = renderer or CollageRenderer()
+        self.start = time.perf_counter()
+        self.canvas = None
+        self.steps = [self._submit("Loading the collage template", self._load_template, template)]
+
+    def _submit(self, description, fn, *args) -> Future:
+        # failures are logged when they happen, finish() reports them
+        future = RENDER_EXECUTOR.submit(fn, *args)
+        def done(f):
+            if f.exception() is not None:
+                logging.error(f"{description} failed", exc_info=f.exception())
+        future.add_done_callback(done)
+        return future
+
+    def _load_template(self, template):
+        self.canvas = self.renderer.load_template(self.collage, template.result() if template is not None else None)
+
+    def _add_image(self, imagePosition: globals.ImagePosition):
+        start = time.perf_counter()
+        fitted_image = self.renderer.load_slot_image(imagePosition)
+        self.renderer.paste_slot_image(self.canvas, imagePosition, fitted_image)
+        self.renderer.release(fitted_image)
+        logging.info(f"Collage image {imagePosition.id} composited in {time.perf_counter()-start:.2f} s")
+
+    def _save(self, targetFile) -> RenderStats:
+        # all steps ran before on the single render thread
+        failed = [f for f in self.steps if f.exception() is not None]
+        if failed:
+            raise CollageError(f"{len(failed)} of {len(self.steps)} collage steps failed, not saving {targetFile}")
+        start = time.perf_counter()
+        result_rgb = self.renderer.track(self.canvas.convert('RGB'))
         result_rgb.save(targetFile, "JPEG")
+        stats = RenderStats(len(self.collage.images), time.perf_counter() - self.start, self.renderer.peak_bytes)
+        logging.info(f"Collage saved in {time.perf_counter()-start:.2f} s, peak memory {stats.peak_bytes/2**20:.0f} MB")
+        return stats
+
+    def add_image(self, imagePosition: globals.ImagePosition) -> Future:
+        future = self._submit(f"Compositing collage image {imagePosition.id}", self._add_image, imagePosition)
+        self.steps.append(future)
+        return future
+
+    def finish(self, targetFile) -> Future:
+        # the future resolves with the RenderStats once all images are composited and the file is written,
+        # it fails with CollageError if any image or the template could not be composited
+        return RENDER_EXECUTOR.submit(self._save, targetFile)
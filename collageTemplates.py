@@ -0,0 +1,150 @@
+import json
+import logging
+import os
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+import threading
+from PIL import Image
+import globals
+
+COLLAGES_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "ui", "collages")
+THUMBNAIL_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "cache", "thumbnails")
+THUMBNAIL_SIZE = (540, 360)
+POSITIONS_SUFFIX = "_positions.json"
+
+
+class TemplateError(ValueError):
+    pass
+
+
+@dataclass
+class CollageLayout:
+    name: str
+    filename: str                                   # template image relative to the collages directory
+    template_path: str
+    size: Tuple[int, int]                           # size of the template image
+    images: List[globals.ImagePosition] = field(default_factory=list)
+
+    def to_collage(self) -> globals.Collage:
+        # every collage gets its own positions, imagePath is filled while shooting
+        return globals.Collage(self.filename, [
+            globals.ImagePosition(p.id, globals.Coordinates(p.position.x, p.position.y), p.angle, p.offset, globals.Size(p.size.width, p.size.height))
+            for p in self.images
+        ])
+
+
+def parse_layout(name, positions_path) -> CollageLayout:
+    # Reads a *_positions.json file. Positions are the center of the placeholder unless
+    # "anchor" is "topleft". Raises TemplateError if the file is not usable.
+    try:
+        with open(positions_path) as f:
+            collage_dict = json.load(f)
+    except (OSError, ValueError) as e:
+        raise TemplateError(f"{positions_path}: {e}")
+
+    filename = collage_dict.get("filename")
+    if not isinstance(filename, str):
+        raise TemplateError(f"{positions_path}: filename missing")
+    template_path = os.path.join(os.path.dirname(positions_path), filename)
+    try:
+        with Image.open(template_path) as template:
+            template_size = template.size
+    except OSError as e:
+        raise TemplateError(f"{positions_path}: template {filename} not readable: {e}")
+
+    topleft = collage_dict.get("anchor", "center") == "topleft"
+    images = []
+    for entry in collage_dict.get("images") or []:
+        try:
+            x, y = (int(v) for v in entry["position"])
+            width, height = (int(v) for v in entry["size"])
+            angle = int(entry.get("angle", 0))
+            offset = int(entry.get("offset", 0))
+        except (KeyError, TypeError, ValueError) as e:
+            raise TemplateError(f"{positions_path}: invalid image entry {entry}: {e}")
+        if width <= 0 or height <= 0:
+            raise TemplateError(f"{positions_path}: invalid size of image {entry.get('id')}")
+        if not topleft:
+            x, y = x - width//2, y - height//2
+        if x < 0 or y < 0 or x + offset + width > template_size[0] or y + height > template_size[1]:
+            logging.warning(f"{positions_path}: image {entry.get('id')} exceeds the template")
+        images.append(globals.ImagePosition(entry.get("id", len(images)), globals.Coordinates(x, y), angle, offset, globals.Size(width, height)))
+
+    if len(images) == 0:
+        raise TemplateError(f"{positions_path}: no images defined")
+    return CollageLayout(name, filename, template_path, template_size, images)
+
+
+class TemplateRegistry:
+    # All collage templates in ui/collages. Layouts are parsed once, thumbnails are cached on
+    # disk and regenerated when the template changes, full templates are loaded on demand in
+    # the background and only the most recently used ones are kept.
+
+    CACHED_TEMPLATES = 2
+
+    def __init__(self, collages_dir=COLLAGES_DIR, thumbnail_dir=THUMBNAIL_DIR):
+        self.collages_dir = collages_dir
+        self.thumbnail_dir = thumbnail_dir
+        self.layouts: Dict[str, CollageLayout] = OrderedDict()
+        self.templates = OrderedDict()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="templates")
+
+    def scan(self):
+        self.layouts.clear()
+        for f in sorted(os.listdir(self.collages_dir)):
+            if not f.endswith(POSITIONS_SUFFIX):
+                continue
+            name = f[:-len(POSITIONS_SUFFIX)]
+            try:
+                self.layouts[name] = parse_layout(name, os.path.join(self.collages_dir, f))
+            except TemplateError as e:
+                logging.error(f"Skipping collage template {name}: {e}")
+        logging.info(f"Found {len(self.layouts)} collage templates")
+        return list(self.layouts.values())
+
+    def get(self, name) -> CollageLayout:
+        return self.layouts.get(name)
+
+    def thumbnail_path(self, layout: CollageLayout) -> str:
+        return os.path.join(self.thumbnail_dir, os.path.splitext(layout.filename)[0] + ".png")
+
+    def _ensure_thumbnail(self, layout: CollageLayout) -> str:
+        thumbnail_path = self.thumbnail_path(layout)
+        try:
+            if os.stat(thumbnail_path).st_mtime >= os.stat(layout.template_path).st_mtime:
+                return thumbnail_path
+        except OSError:
+            pass
+        os.makedirs(self.thumbnail_dir, exist_ok=True)
+        with Image.open(layout.template_path) as template:
+            template.draft("RGBA", THUMBNAIL_SIZE)
+            template.thumbnail(THUMBNAIL_SIZE, Image.LANCZOS)
+            tmp_path = thumbnail_path + ".tmp"
+            template.save(tmp_path, "PNG")
+        os.replace(tmp_path, thumbnail_path)
+        logging.info(f"Created thumbnail for collage template {layout.name}")
+        return thumbnail_path
+
+    def thumbnail(self, layout: CollageLayout) -> Future:
+        # resolves with the path of the thumbnail
+        return self.executor.submit(self._ensure_thumbnail, layout)
+
+    def _load_template(self, layout: CollageLayout):
+        with self.lock:
+            if layout.filename in self.templates:
+                self.templates.move_to_end(layout.filename)
+                return self.templates[layout.filename]
+        with Image.open(layout.template_path) as template:
+            template = template.convert("RGBA")
+        with self.lock:
+            self.templates[layout.filename] = template
+            while len(self.templates) > self.CACHED_TEMPLATES:
+                self.templates.popitem(last=False)
+        return template
+
+    def load_template(self, layout: CollageLayout) -> Future:
+        # resolves with the full size template as RGBA image
+        return self.executor.submit(self._load_template, layout)
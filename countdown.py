@@ -0,0 +1,76 @@
+import logging
+import math
+import time
+from PyQt6.QtCore import QObject, QTimer, Qt, pyqtSignal, pyqtSlot
+
+
+class CountdownScheduler(QObject):
+    # Countdown on the Qt event loop of the thread the scheduler lives in.
+    # Every tick targets a deadline relative to the start on the monotonic clock,
+    # so late ticks do not add up. The measured lateness of every tick is emitted as jitter.
+    tick = pyqtSignal(int, float)                          # seconds left, jitter in ms
+    finished = pyqtSignal()
+    cancelled = pyqtSignal()
+
+    def __init__(self, parent=None, interval_seconds=1.0):
+        super().__init__(parent)
+        self.interval = interval_seconds
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setTimerType(Qt.TimerType.PreciseTimer)
+        self.timer.timeout.connect(self._on_timeout)
+        self.seconds = 0
+        self.ticks = 0
+        self.start_time = None
+        self.jitters = []
+
+    def start(self, seconds):
+        self.timer.stop()
+        self.seconds = seconds
+        self.ticks = 0
+        self.jitters = []
+        self.start_time = time.monotonic()
+        self.tick.emit(seconds, 0.0)
+        if seconds <= 0:
+            self.finished.emit()
+        else:
+            self._schedule_next()
+
+    @pyqtSlot()
+    def cancel(self):
+        if self.timer.isActive():
+            self.timer.stop()
+            logging.info("Countdown cancelled")
+            self.cancelled.emit()
+
+    def is_active(self) -> bool:
+        return self.timer.isActive()
+
+    def deadline(self, ticks) -> float:
+        return self.start_time + ticks * self.interval
+
+    def max_jitter(self) -> float:
+        return max(self.jitters, default=0.0)
+
+    def _schedule_next(self):
+        remaining = self.deadline(self.ticks + 1) - time.monotonic()
+        self.timer.start(max(0, round(remaining * 1000)))
+
+    @pyqtSlot()
+    def _on_timeout(self):
+        # Qt timers may fire a little early, the rest is waited for on the event loop
+        early = self.deadline(self.ticks + 1) - time.monotonic()
+        if early > 0:
+            self.timer.start(math.ceil(early * 1000))
+            return
+        self.ticks += 1
+        jitter = 1000 * (time.monotonic() - self.deadline(self.ticks))
+        self.jitters.append(jitter)
+
+        seconds_left = self.seconds - self.ticks
+        self.tick.emit(seconds_left, jitter)
+        if seconds_left <= 0:
+            logging.info(f"Countdown finished. Jitter avg {sum(self.jitters)/len(self.jitters):.1f} ms, max {self.max_jitter():.1f} ms")
+            self.finished.emit()
+        else:
+            self._schedule_next()
@@ -0,0 +1,198 @@
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+import numpy as np
+from PIL import Image, ImageColor, ImageOps
+import filters
+import globals
+import imageCache
+from streamPipeline import load_preview
+
+PRINT_SIZE = (1844, 1240)                   # DNP DS620 6x4" at 300 dpi
+PRINT_DPI = 300
+PRINT_BACKGROUND = (255, 255, 255)          # if IMAGE_BORDER_COLOR is no colour PIL knows
+SHARE_LONG_EDGE = 2048
+THUMBNAIL_LONG_EDGE = 320
+DERIVATIVES_DIR = ".derivatives"
+
+
+def capture_id(file_name) -> str:
+    return os.path.splitext(os.path.basename(file_name))[0]
+
+def derivative_path(file_name, kind) -> str:
+    return os.path.join(os.path.dirname(file_name), DERIVATIVES_DIR, f"{capture_id(file_name)}_{kind}.jpg")
+
+
+def _remove_result(future):
+    if future.cancelled() or future.exception() is not None:
+        return
+    try:
+        os.remove(future.result())
+    except OSError:
+        pass
+
+def _save(image, target, **kwargs):
+    # write to a temporary file first, readers never see half written files
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp = target + ".tmp"
+    image.save(tmp, "JPEG", **kwargs)
+    os.replace(tmp, target)
+    return target
+
+def _link_original(file_name, original):
+    # keeps the unfiltered photo, a hard link costs no space until the photo is replaced
+    os.makedirs(os.path.dirname(original), exist_ok=True)
+    try:
+        os.remove(original)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(file_name, original)
+    except OSError:
+        shutil.copyfile(file_name, original)
+
+def apply_look(image, look):
+    # look applied to a PIL image, at the image's size
+    if look is None:
+        return image
+    return Image.fromarray(look.apply(np.array(image)))
+
+# Derivatives are made of source, the unfiltered original of a filtered photo, and get the
+# look at their own size, so they do not wait for the photo to be filtered at full resolution.
+
+def print_background():
+    # the print is framed like the photo on screen
+    try:
+        return ImageColor.getrgb(globals.SETTINGS["IMAGE_BORDER_COLOR"])
+    except ValueError:
+        return PRINT_BACKGROUND
+
+def make_print(file_name, source=None, look=None) -> str:
+    # fitted into the paper and padded, cropping would cut off the edges of e.g. 4:3 collages
+    source = source or file_name
+    width, height = imageCache.CACHE.source_size(source)
+    size = PRINT_SIZE if width >= height else PRINT_SIZE[::-1]
+    image = apply_look(imageCache.CACHE.get(source, size), look)
+    image = ImageOps.pad(image, size, Image.LANCZOS, color=print_background())
+    return _save(image, derivative_path(file_name, "print"), quality=95, dpi=(PRINT_DPI, PRINT_DPI))
+
+def _make_scaled(file_name, source, look, kind, long_edge, quality) -> str:
+    # decoded images are shared with the print and the preview, see imageCache
+    source = source or file_name
+    width, height = imageCache.CACHE.source_size(source)
+    scale = min(1.0, long_edge / max(width, height))
+    size = (round(width*scale), round(height*scale))
+    image = imageCache.CACHE.get(source, size)
+    if image.size != size:
+        image = image.resize(size, Image.LANCZOS)
+    return _save(apply_look(image, look), derivative_path(file_name, kind), quality=quality)
+
+def make_share(file_name, source=None, look=None) -> str:
+    return _make_scaled(file_name, source, look, "share", SHARE_LONG_EDGE, 85)
+
+def make_thumbnail(file_name, source=None, look=None) -> str:
+    return _make_scaled(file_name, source, look, "thumbnail", THUMBNAIL_LONG_EDGE, 80)
+
+def make_preview(file_name, width, height, source=None, look=None):
+    preview = load_preview(source or file_name, width, height)
+    return preview if look is None else look.apply(preview)
+
+
+class DerivativePipeline:
+    # Produces everything the booth needs from a capture right after it arrived, in parallel:
+    #   preview:   mirrored RGB array in display size (kept in memory)
+    #   print:     JPEG in the printer's native size and dpi
+    #   share:     smaller JPEG for uploads
+    #   thumbnail: JPEG for the gallery
+    #   filtered:  the photo itself with the guest's look, see filters
+    # Results are futures stored by capture id, so consumers can use them as soon as they are ready.
+
+    KEEP_CAPTURES = 20
+
+    def __init__(self, workers=None):
+        self.executor = ThreadPoolExecutor(max_workers=workers or min(4, os.cpu_count() or 2), thread_name_prefix="derivatives")
+        self.captures = OrderedDict()
+        self.lock = threading.Lock()
+        self.preview_size = None
+
+    def _timed(self, kind, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        logging.info(f"Created {kind} of {os.path.basename(args[0])} in {1000*(time.perf_counter()-start):.0f} ms")
+        return result
+
+    def submit(self, file_name, look=None) -> str:
+        # with a look the unfiltered photo is kept as "original" and the photo is replaced by
+        # its filtered version once that is done. Captures are known by absolute path, the
+        # collage and the GUI name the same file differently.
+        file_name = os.path.abspath(file_name)
+        source = file_name
+        if look is not None:
+            source = derivative_path(file_name, "original")
+            _link_original(file_name, source)
+        futures = {
+            "print": self.executor.submit(self._timed, "print", make_print, file_name, source, look),
+            "share": self.executor.submit(self._timed, "share", make_share, file_name, source, look),
+            "thumbnail": self.executor.submit(self._timed, "thumbnail", make_thumbnail, file_name, source, look),
+        }
+        if self.preview_size is not None:
+            futures["preview"] = self.executor.submit(self._timed, "preview", make_preview, file_name, *self.preview_size, source, look)
+        if look is not None:
+            futures["filtered"] = filters.ENGINE.submit(source, file_name, look)
+        with self.lock:
+            self.captures[capture_id(file_name)] = (file_name, futures, source, look)
+            while len(self.captures) > self.KEEP_CAPTURES:
+                self.captures.popitem(last=False)
+        return capture_id(file_name)
+
+    def future(self, file_name, kind) -> Future:
+        with self.lock:
+            entry = self.captures.get(capture_id(file_name))
+        if entry is None or entry[0] != os.path.abspath(file_name):
+            return None
+        return entry[1].get(kind)
+
+    def source(self, file_name):
+        # the unfiltered photo and the look that still has to be applied to it
+        with self.lock:
+            entry = self.captures.get(capture_id(file_name))
+        if entry is None or entry[0] != os.path.abspath(file_name):
+            return file_name, None
+        return entry[2], entry[3]
+
+    def get(self, file_name, kind, timeout=None):
+        # returns the derivative or None if it was not requested, failed or is not ready in time
+        future = self.future(file_name, kind)
+        if future is None:
+            return None
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            return None
+        except Exception as e:
+            logging.error(f"Creating {kind} of {file_name} failed: {e}")
+            return None
+
+    def discard(self, file_name):
+        with self.lock:
+            entry = self.captures.pop(capture_id(file_name), None)
+        imageCache.CACHE.discard(file_name)
+        if entry is None:
+            return
+        for kind, future in entry[1].items():
+            future.cancel()
+            if kind != "preview":
+                future.add_done_callback(_remove_result)
+        if entry[2] != entry[0]:
+            imageCache.CACHE.discard(entry[2])
+            try:
+                os.remove(entry[2])
+            except OSError:
+                pass
+
+
+PIPELINE = DerivativePipeline()
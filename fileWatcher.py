@@ -0,0 +1,98 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct("iIII")
+POLL_INTERVAL_SECONDS = 0.02
+
+JPEG_START = b"\xff\xd8"
+JPEG_END = b"\xff\xd9"
+JPEG_TAIL_BYTES = 4096
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _libc.inotify_init1
+except (OSError, AttributeError, TypeError):
+    _libc = None
+
+
+def is_complete_file(path) -> bool:
+    # JPEGs are complete if the end-of-image marker is present, everything else if it is not empty
+    try:
+        with open(path, "rb") as f:
+            if not path.lower().endswith((".jpg", ".jpeg")):
+                return len(f.read(1)) > 0
+            if f.read(2) != JPEG_START:
+                return False
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(0, size - JPEG_TAIL_BYTES))
+            tail = f.read()
+    except OSError:
+        return False
+    # some cameras pad the file after the end-of-image marker
+    return tail.rstrip(b"\x00").endswith(JPEG_END)
+
+
+def wait_for_complete_file(path, timeout) -> bool:
+    # Returns as soon as the file was closed after writing and is complete.
+    # Uses inotify on Linux and polls on other systems.
+    start = time.monotonic()
+    if _libc is not None:
+        result = _wait_inotify(path, timeout)
+        if result is not None:
+            logging.debug(f"{path} complete after {1000*(time.monotonic()-start):.0f} ms")
+            return result
+    result = _wait_polling(path, timeout - (time.monotonic() - start))
+    logging.debug(f"{path} complete after {1000*(time.monotonic()-start):.0f} ms")
+    return result
+
+
+def _wait_polling(path, timeout) -> bool:
+    deadline = time.monotonic() + timeout
+    while True:
+        if is_complete_file(path):
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(POLL_INTERVAL_SECONDS)
+
+
+def _wait_inotify(path, timeout):
+    # returns None if inotify could not be set up
+    directory = os.path.dirname(os.path.abspath(path))
+    name = os.path.basename(path).encode()
+    fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        return None
+    try:
+        if _libc.inotify_add_watch(fd, directory.encode(), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            return None
+        # the file may have been written before the watch was set up
+        if is_complete_file(path):
+            return True
+
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                # a file that was not closed (e.g. written by another process via mmap) is still accepted if it is complete
+                return is_complete_file(path)
+            data = os.read(fd, 4096)
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                event_name = data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length].rstrip(b"\0")
+                offset += INOTIFY_EVENT.size + length
+                if event_name == name and is_complete_file(path):
+                    return True
+    finally:
+        os.close(fd)
@@ -0,0 +1,310 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from PIL import Image
+import globals
+import tracing
+
+FILTERS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "ui", "filters")
+CUBE_SUFFIX = ".cube"
+NO_FILTER = "none"
+LIVE_BITS = 6                               # precision per channel of the live view table of 3D LUTs
+STRIP_ROWS = 256                            # rows interpolated at once at full resolution, bounds the memory
+
+
+class LookError(ValueError):
+    pass
+
+
+def _curve(points) -> np.ndarray:
+    # 256 entry tone curve through (input, output) points
+    x, y = zip(*points)
+    return np.clip(np.interp(np.arange(256), x, y) + 0.5, 0, 255).astype(np.uint8)
+
+def _rgb_channels(image):
+    # filters work on RGB, the alpha channel of RGBA images is left alone
+    return image if image.shape[2] == 3 else np.ascontiguousarray(image[..., :3])
+
+
+class ParametricLook:
+    # A colour matrix followed by one tone curve per channel, both applied by OpenCV on
+    # precomputed tables. Cheap enough for the live view, and exact, so the live view and
+    # the saved photo use the same code.
+
+    def __init__(self, name, matrix=None, curves=None):
+        self.name = name
+        self.matrix = None if matrix is None else np.asarray(matrix, np.float32)
+        self.lut = None
+        if curves is not None:
+            curves = [c if isinstance(c, np.ndarray) else _curve(c) for c in curves]
+            if all(np.array_equal(c, curves[0]) for c in curves):
+                self.lut = curves[0].reshape(1, 256)        # one curve for all channels is about twice as fast
+            else:
+                self.lut = np.stack(curves, -1).reshape(1, 256, 3)
+
+    def apply_live(self, image):
+        # image is an RGB frame of the live view, changed in place
+        if self.matrix is not None:
+            cv2.transform(image, self.matrix, dst=image)
+        if self.lut is not None:
+            cv2.LUT(image, self.lut, dst=image)
+
+    def apply(self, image) -> np.ndarray:
+        # full quality, in place on an RGB or RGBA uint8 array
+        rgb = _rgb_channels(image)
+        self.apply_live(rgb)
+        if rgb is not image:
+            image[..., :3] = rgb
+        return image
+
+
+class CubeLook:
+    # A 3D LUT of a .cube file, applied with cv2.remap on the LUT laid out as an image.
+    # Saved photos are interpolated trilinearly, strip by strip: the LUT is stored as one
+    # tile (green rows, red columns) per blue level, two bilinear remaps read the tiles
+    # around the blue value of every pixel and are blended. For the live view the LUT is
+    # resampled once into a table of 2**LIVE_BITS levels per channel (green rows, red*blue
+    # columns), so every frame is only a few table lookups and one nearest neighbour remap.
+
+    def __init__(self, name, table, domain_min=(0, 0, 0), domain_max=(1, 1, 1)):
+        self.name = name
+        self.size = table.shape[0]
+        self.table = table.reshape(-1, 3).astype(np.float32)     # index (b*size + g)*size + r
+        self.domain_min = np.asarray(domain_min, np.float32)
+        self.domain_range = np.asarray(domain_max, np.float32) - self.domain_min
+
+        # full resolution: per channel position in the LUT, looked up by cv2.LUT
+        n = self.size
+        self.tiles = np.ascontiguousarray(table.astype(np.float32).transpose(1, 0, 2, 3).reshape(n, n*n, 3))
+        position = np.clip((np.arange(256, dtype=np.float32)[:, None] / 255 - self.domain_min) / self.domain_range, 0, 1) * (n - 1)
+        low = np.minimum(position.astype(np.int32), n - 2)
+        self.red_position = position[:, 0].astype(np.float32).reshape(1, 256)
+        self.green_position = position[:, 1].astype(np.float32).reshape(1, 256)
+        self.blue_tile = (low[:, 2] * n).astype(np.float32).reshape(1, 256)
+        self.blue_fraction = (position[:, 2] - low[:, 2]).astype(np.float32).reshape(1, 256)
+
+        levels = 1 << LIVE_BITS
+        centers = (np.arange(levels, dtype=np.float32) * (256 // levels) + (256 // levels - 1) / 2) / 255
+        r, b = np.divmod(np.arange(levels * levels), levels)
+        grid = np.empty((levels, levels * levels, 3), np.float32)
+        grid[..., 0] = centers[r]
+        grid[..., 1] = centers[:, None]
+        grid[..., 2] = centers[b]
+        self.live_table = self._to_uint8(self._lookup(grid))
+        shift = 8 - LIVE_BITS
+        index = np.arange(256) >> shift
+        self.red_column = (index * levels).astype(np.int16).reshape(1, 256)
+        self.level = index.astype(np.int16).reshape(1, 256)
+        self.buffers = None
+
+    @staticmethod
+    def _to_uint8(values):
+        return np.clip(values * 255 + 0.5, 0, 255).astype(np.uint8)
+
+    def _lookup(self, rgb) -> np.ndarray:
+        # trilinear interpolation of float RGB in 0..1, for building the live view table
+        n = self.size
+        position = np.clip((rgb - self.domain_min) / self.domain_range, 0, 1) * (n - 1)
+        low = np.minimum(position.astype(np.int32), n - 2)
+        fraction = position - low
+        fr, fg, fb = fraction[..., 0:1], fraction[..., 1:2], fraction[..., 2:3]
+        base = (low[..., 2] * n + low[..., 1]) * n + low[..., 0]
+        table = self.table
+        c00 = table[base];             c00 += (table[base + 1] - c00) * fr
+        c10 = table[base + n];         c10 += (table[base + n + 1] - c10) * fr
+        c01 = table[base + n*n];       c01 += (table[base + n*n + 1] - c01) * fr
+        c11 = table[base + n*n + n];   c11 += (table[base + n*n + n + 1] - c11) * fr
+        c00 += (c10 - c00) * fg
+        c01 += (c11 - c01) * fg
+        c00 += (c01 - c00) * fb
+        return c00
+
+    def apply_live(self, image):
+        # image is an RGB frame of the live view, changed in place; only used by the stream thread
+        height, width = image.shape[:2]
+        if self.buffers is None or self.buffers[0][0].shape != (height, width):
+            planes = [np.empty((height, width), np.uint8) for _ in range(3)]
+            self.buffers = (planes, np.empty((height, width), np.int16), np.empty((height, width), np.int16),
+                            np.empty((height, width), np.int16), np.empty((height, width, 2), np.int16))
+        planes, column, blue, row, positions = self.buffers
+        cv2.split(image, planes)
+        cv2.LUT(planes[0], self.red_column, dst=column)
+        cv2.LUT(planes[2], self.level, dst=blue)
+        cv2.add(column, blue, dst=column)
+        cv2.LUT(planes[1], self.level, dst=row)
+        cv2.merge([column, row], positions)
+        cv2.remap(self.live_table, positions, None, cv2.INTER_NEAREST, dst=image)
+
+    def _interpolate(self, rgb) -> np.ndarray:
+        red, green, blue = cv2.split(rgb)
+        x = cv2.LUT(red, self.red_position)
+        x += cv2.LUT(blue, self.blue_tile)
+        y = cv2.LUT(green, self.green_position)
+        low = cv2.remap(self.tiles, x, y, cv2.INTER_LINEAR)
+        x += self.size                                      # the tile of the next blue level
+        high = cv2.remap(self.tiles, x, y, cv2.INTER_LINEAR)
+        high -= low
+        high *= cv2.LUT(blue, self.blue_fraction)[..., None]
+        low += high
+        return self._to_uint8(low)
+
+    def apply(self, image) -> np.ndarray:
+        # full quality, in place on an RGB or RGBA uint8 array
+        for top in range(0, image.shape[0], STRIP_ROWS):
+            strip = image[top:top + STRIP_ROWS]
+            strip[..., :3] = self._interpolate(_rgb_channels(strip))
+        return image
+
+
+def parse_cube(name, path):
+    # Adobe/Resolve .cube files: a 3D LUT with red changing fastest, or one 1D curve per channel
+    size = dimensions = None
+    domain_min, domain_max = [0.0]*3, [1.0]*3
+    values = []
+    try:
+        with open(path) as f:
+            for number, line in enumerate(f, 1):
+                words = line.split()
+                if not words or words[0].startswith("#") or words[0] == "TITLE":
+                    continue
+                try:
+                    if words[0] in ("LUT_3D_SIZE", "LUT_1D_SIZE"):
+                        size, dimensions = int(words[1]), 3 if words[0] == "LUT_3D_SIZE" else 1
+                    elif words[0] == "DOMAIN_MIN":
+                        domain_min = [float(v) for v in words[1:4]]
+                    elif words[0] == "DOMAIN_MAX":
+                        domain_max = [float(v) for v in words[1:4]]
+                    elif words[0] in ("LUT_3D_INPUT_RANGE", "LUT_1D_INPUT_RANGE"):
+                        domain_min, domain_max = [float(words[1])]*3, [float(words[2])]*3
+                    else:
+                        values.append([float(v) for v in words[:3]])
+                except (IndexError, ValueError):
+                    raise LookError(f"{path}:{number}: unable to parse {line.strip()!r}")
+    except OSError as e:
+        raise LookError(f"{path} not readable: {e}")
+
+    if size is None or size < 2:
+        raise LookError(f"{path}: LUT_3D_SIZE or LUT_1D_SIZE missing")
+    expected = size**3 if dimensions == 3 else size
+    if len(values) != expected or any(len(v) != 3 for v in values):
+        raise LookError(f"{path}: {len(values)} entries instead of {expected}")
+    if any(high <= low for low, high in zip(domain_min, domain_max)):
+        raise LookError(f"{path}: empty domain {domain_min} - {domain_max}")
+    table = np.asarray(values, np.float32)
+    if dimensions == 3:
+        return CubeLook(name, table.reshape(size, size, size, 3), domain_min, domain_max)
+    # a 1D LUT is a tone curve per channel
+    inputs = np.arange(256, dtype=np.float32) / 255
+    curves = []
+    for channel in range(3):
+        position = np.clip((inputs - domain_min[channel]) / (domain_max[channel] - domain_min[channel]), 0, 1) * (size - 1)
+        curves.append(np.clip(np.interp(position, np.arange(size), table[:, channel]) * 255 + 0.5, 0, 255).astype(np.uint8))
+    return ParametricLook(name, curves=curves)
+
+
+_GRAY = [0.299, 0.587, 0.114]
+BUILTIN_LOOKS = {
+    "bw": lambda: ParametricLook("bw", [_GRAY]*3, [[(0, 0), (64, 52), (192, 204), (255, 255)]]*3),
+    "sepia": lambda: ParametricLook("sepia", [[0.393, 0.769, 0.189], [0.349, 0.686, 0.168], [0.272, 0.534, 0.131]]),
+    # faded blacks, softer whites, warm and a little desaturated
+    "vintage": lambda: ParametricLook("vintage", 0.8*np.eye(3) + 0.2*np.array([_GRAY]*3),
+                                      [[(0, 30), (128, 140), (255, 240)], [(0, 20), (128, 125), (255, 230)], [(0, 40), (128, 110), (255, 200)]]),
+}
+
+def available_looks(filters_dir=FILTERS_DIR) -> list:
+    # built in looks and the names of the .cube files in ui/filters
+    try:
+        cubes = sorted(f[:-len(CUBE_SUFFIX)] for f in os.listdir(filters_dir) if f.lower().endswith(CUBE_SUFFIX))
+    except OSError:
+        cubes = []
+    return [NO_FILTER] + list(BUILTIN_LOOKS) + [c for c in cubes if c not in BUILTIN_LOOKS]
+
+def load_look(name, filters_dir=FILTERS_DIR):
+    # None for NO_FILTER
+    if not name or name == NO_FILTER:
+        return None
+    if name in BUILTIN_LOOKS:
+        return BUILTIN_LOOKS[name]()
+    return parse_cube(name, os.path.join(filters_dir, name + CUBE_SUFFIX))
+
+
+class FilterEngine:
+    # Applies the look selected by the FILTER setting to the live view and, in a background
+    # worker, to the saved photo at full resolution. Looks are compiled to their tables once
+    # when the setting changes. Keeps rolling timings of both paths.
+
+    TIMING_WINDOW = 200
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.name = None
+        self.current = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="filter")
+        self.live_times = deque(maxlen=self.TIMING_WINDOW)
+        self.full_times = deque(maxlen=self.TIMING_WINDOW)
+
+    def look(self):
+        # the selected look, None without filter or if it can not be loaded
+        name = globals.SETTINGS["FILTER"]
+        if name != self.name:
+            with self.lock:
+                if name != self.name:
+                    start = time.perf_counter()
+                    try:
+                        self.current = load_look(name)
+                        if self.current is not None:
+                            logging.info(f"Filter {name} ready in {1000*(time.perf_counter()-start):.0f} ms")
+                    except LookError as e:
+                        logging.error(f"Unable to load filter {name}: {e}")
+                        self.current = None
+                    self.name = name
+        return self.current
+
+    def apply_live(self, look, image):
+        start = time.perf_counter()
+        look.apply_live(image)
+        self.live_times.append(time.perf_counter() - start)
+
+    def _filter_file(self, source, target, look):
+        start = time.monotonic()
+        with Image.open(source) as image:
+            exif = image.info.get("exif", b"")
+            pixels = np.array(image.convert("RGB"))
+        look.apply(pixels)
+        tmp = target + ".tmp"
+        Image.fromarray(pixels).save(tmp, "JPEG", quality=95, exif=exif)
+        os.replace(tmp, target)
+        end = time.monotonic()
+        self.full_times.append(end - start)
+        logging.info(f"Filter {look.name} applied to {os.path.basename(target)} ({pixels.shape[1]}x{pixels.shape[0]}) in {end - start:.2f} s")
+        tracing.TRACER.record("filter", start, end, os.path.splitext(os.path.basename(target))[0], look=look.name)
+        return target
+
+    def submit(self, source, target, look):
+        # writes source with the look applied to target, returns a future of target
+        return self.executor.submit(self._filter_file, source, target, look)
+
+    def stats(self) -> dict:
+        live, full = list(self.live_times), list(self.full_times)
+        return {
+            "filter": self.name or NO_FILTER,
+            "live_frames": len(live),
+            "live_p50_ms": 1000*tracing.percentile(live, 0.5) if live else None,
+            "live_p95_ms": 1000*tracing.percentile(live, 0.95) if live else None,
+            "full_count": len(full),
+            "full_p50_s": tracing.percentile(full, 0.5) if full else None,
+            "full_max_s": max(full) if full else None,
+        }
+
+
+ENGINE = FilterEngine()
+
+
+if __name__ == "__main__":
+    for name in available_looks():
+        print(name)
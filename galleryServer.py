@@ -0,0 +1,333 @@
+import asyncio
+import html
+import logging
+import os
+import socket
+import threading
+import urllib.parse
+from email.utils import formatdate, parsedate_to_datetime
+import captureIndex
+import derivatives
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg")
+MAX_HEADER_BYTES = 16 * 1024
+KEEP_ALIVE_SECONDS = 15
+CACHE_CONTROL = "public, max-age=3600"
+
+REASONS = {200: "OK", 206: "Partial Content", 304: "Not Modified", 400: "Bad Request", 404: "Not Found",
+           405: "Method Not Allowed", 416: "Range Not Satisfiable", 431: "Request Header Fields Too Large",
+           500: "Internal Server Error", 503: "Service Unavailable"}
+
+INDEX_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><meta name="viewport" content="width=device-width, initial-scale=1">
+<title>Fotobox</title>
+<style>body{{background:#2a3141;color:#f7f4b7;font-family:sans-serif;margin:0;padding:8px}}
+.grid{{display:grid;grid-template-columns:repeat(auto-fill,minmax(150px,1fr));gap:8px}}
+img{{width:100%;border-radius:4px}}</style></head>
+<body><h1>Fotobox</h1><div class="grid">{items}</div></body></html>
+"""
+INDEX_ITEM = '<a href="/photos/{name}"><img src="/thumbnails/{name}" loading="lazy" alt="{name}"></a>'
+
+
+def local_ip() -> str:
+    # the address other devices in the hotspot reach us with, no packet is sent for this
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        try:
+            s.connect(("10.255.255.255", 1))
+            return s.getsockname()[0]
+        except OSError:
+            return "127.0.0.1"
+
+
+def etag(stat) -> str:
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def parse_range(header, size):
+    # returns (start, end) of a single byte range, None to send the whole file
+    # or raises ValueError if the range can not be satisfied
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, dash, last = header[6:].strip().partition("-")
+    if not dash or not (first.isdigit() or first == "") or not (last.isdigit() or last == "") or first == last == "":
+        return None                                         # malformed ranges are ignored
+    if first == "":
+        # the last bytes of the file, none of an empty file
+        length = int(last)
+        if length == 0 or size == 0:
+            raise ValueError(header)
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError(header)
+    return start, min(end, size - 1)
+
+
+class GalleryServer:
+    # Serves the photos in root to the phones in the hotspot:
+    #   /                   gallery of all photos, newest first
+    #   /photos/<name>      the photo itself, sent with sendfile
+    #   /thumbnails/<name>  small version for the gallery, made by the derivative pipeline
+    # Files are cached by the phones with ETags, Range requests allow resuming downloads.
+    # The server runs its own asyncio loop in a background thread and never touches Qt.
+
+    def __init__(self, root, port=8000, host="0.0.0.0", public_host=None):
+        self.root = root
+        self.port = port
+        self.host = host
+        self.public_host = public_host
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.started = threading.Event()
+        self.writers = set()
+        self.requests = 0
+        self.bytes_sent = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="gallery-server", daemon=True)
+        self.thread.start()
+        self.started.wait(5)
+        return self
+
+    def stop(self):
+        if self.loop is None:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result(5)
+        except Exception as e:
+            logging.warning(f"Gallery server did not shut down cleanly: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=5)
+        logging.info(f"Gallery server stopped after {self.requests} requests, {self.bytes_sent/2**20:.1f} MB sent")
+
+    def base_url(self) -> str:
+        return f"http://{self.public_host or local_ip()}:{self.port}"
+
+    def url_for(self, file_name) -> str:
+        return f"{self.base_url()}/photos/{urllib.parse.quote(os.path.basename(file_name))}"
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.server = self.loop.run_until_complete(
+                asyncio.start_server(self._handle_connection, self.host, self.port, backlog=512, reuse_address=True))
+            self.port = self.server.sockets[0].getsockname()[1]
+            logging.info(f"Gallery server running on {self.base_url()}")
+        except OSError as e:
+            logging.error(f"Unable to start gallery server on port {self.port}: {e}")
+            self.started.set()
+            self.loop.close()
+            self.loop = None
+            return
+        self.started.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    async def _shutdown(self):
+        # open keep-alive connections are closed, not left to a closed loop
+        self.server.close()
+        for writer in list(self.writers):
+            writer.transport.abort()
+        await self.server.wait_closed()
+
+    def _photo_path(self, name):
+        # only plain file names inside root are served
+        name = urllib.parse.unquote(name)
+        if name != os.path.basename(name) or name.startswith(".") or not name.lower().endswith(IMAGE_EXTENSIONS):
+            return None
+        path = os.path.join(self.root, name)
+        return path if os.path.isfile(path) else None
+
+    async def _handle_connection(self, reader, writer):
+        self.writers.add(writer)
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), KEEP_ALIVE_SECONDS)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                    break
+                except asyncio.LimitOverrunError:
+                    await self._send_status(writer, 431, keep_alive=False)
+                    break
+                if len(head) > MAX_HEADER_BYTES:
+                    await self._send_status(writer, 431, keep_alive=False)
+                    break
+                keep_alive = await self._handle_request(head.decode("latin-1"), writer)
+                if not keep_alive:
+                    break
+        except (ConnectionError, OSError):
+            pass
+        except Exception as e:
+            logging.error(f"Gallery server error: {e}")
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    async def _handle_request(self, head, writer) -> bool:
+        lines = head.split("\r\n")
+        try:
+            method, target, version = lines[0].split(" ")
+        except ValueError:
+            await self._send_status(writer, 400, keep_alive=False)
+            return False
+        headers = {}
+        for line in lines[1:]:
+            key, _, value = line.partition(":")
+            if key:
+                headers[key.strip().lower()] = value.strip()
+        connection = headers.get("connection", "").lower()
+        keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+        self.requests += 1
+
+        if method not in ("GET", "HEAD"):
+            await self._send_status(writer, 405, keep_alive)
+            return keep_alive
+        path = urllib.parse.urlsplit(target).path
+        if path == "/":
+            await self._send_index(writer, method, keep_alive)
+        elif path.startswith("/photos/"):
+            photo = await self.loop.run_in_executor(None, self._photo_path, path[len("/photos/"):])
+            await self._send_file(writer, method, headers, photo, keep_alive)
+        elif path.startswith("/thumbnails/"):
+            photo = await self.loop.run_in_executor(None, self._photo_path, path[len("/thumbnails/"):])
+            thumbnail = await self._thumbnail(photo) if photo is not None else None
+            await self._send_file(writer, method, headers, thumbnail, keep_alive)
+        else:
+            await self._send_status(writer, 404, keep_alive)
+        return keep_alive
+
+    def _is_newer(self, path, than) -> bool:
+        try:
+            return os.stat(path).st_mtime >= os.stat(than).st_mtime
+        except OSError:
+            return False
+
+    async def _thumbnail(self, photo):
+        # the file system is only touched in the executor, a slow SD card must not stall other downloads
+        thumbnail = derivatives.derivative_path(photo, "thumbnail")
+        if await self.loop.run_in_executor(None, self._is_newer, thumbnail, photo):
+            return thumbnail
+        # photos from before the start of the booth get their thumbnail on first request
+        try:
+            return await self.loop.run_in_executor(derivatives.PIPELINE.executor, derivatives.make_thumbnail, photo)
+        except Exception as e:
+            logging.error(f"Unable to create thumbnail of {photo}: {e}")
+            return None
+
+    def _write_head(self, writer, status, headers, keep_alive):
+        lines = [f"HTTP/1.1 {status} {REASONS[status]}", f"Date: {formatdate(usegmt=True)}", "Server: fotobox",
+                 f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+        lines += [f"{key}: {value}" for key, value in headers.items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+    async def _send_status(self, writer, status, keep_alive):
+        body = f"{status} {REASONS[status]}\n".encode()
+        self._write_head(writer, status, {"Content-Type": "text/plain", "Content-Length": len(body)}, keep_alive)
+        writer.write(body)
+        await writer.drain()
+
+    def _photo_names(self):
+        # newest first, from the capture index if there is one for root
+        index = captureIndex.INDEX
+        if index is not None and os.path.abspath(index.root) == os.path.abspath(self.root):
+            return [capture["file_name"] for capture in index.captures()]
+        try:
+            entries = [e for e in os.scandir(self.root)
+                       if e.is_file() and e.name.lower().endswith(IMAGE_EXTENSIONS) and not e.name.startswith(".")]
+        except OSError:
+            return []
+        entries.sort(key=lambda e: e.stat().st_mtime, reverse=True)
+        return [e.name for e in entries]
+
+    async def _send_index(self, writer, method, keep_alive):
+        names = await self.loop.run_in_executor(None, self._photo_names)
+        items = "".join(INDEX_ITEM.format(name=html.escape(urllib.parse.quote(name))) for name in names)
+        body = INDEX_PAGE.format(items=items).encode()
+        self._write_head(writer, 200, {"Content-Type": "text/html; charset=utf-8", "Content-Length": len(body),
+                                       "Cache-Control": "no-cache"}, keep_alive)
+        if method == "GET":
+            writer.write(body)
+            self.bytes_sent += len(body)
+        await writer.drain()
+
+    async def _send_file(self, writer, method, request_headers, path, keep_alive):
+        if path is None:
+            await self._send_status(writer, 404, keep_alive)
+            return
+        try:
+            f, stat = await self.loop.run_in_executor(None, self._open, path)
+        except OSError:
+            await self._send_status(writer, 404, keep_alive)
+            return
+        with f:
+            tag = etag(stat)
+            headers = {"ETag": tag, "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+                       "Cache-Control": CACHE_CONTROL, "Accept-Ranges": "bytes"}
+
+            if self._not_modified(request_headers, tag, stat):
+                self._write_head(writer, 304, headers, keep_alive)
+                await writer.drain()
+                return
+
+            status, start, length = 200, 0, stat.st_size
+            # a range of an older version of the file is not useful, then the whole file is sent
+            if request_headers.get("if-range", tag) == tag:
+                try:
+                    byte_range = parse_range(request_headers.get("range"), stat.st_size)
+                except ValueError:
+                    headers["Content-Range"] = f"bytes */{stat.st_size}"
+                    headers["Content-Length"] = 0
+                    self._write_head(writer, 416, headers, keep_alive)
+                    await writer.drain()
+                    return
+                if byte_range is not None:
+                    status, start, length = 206, byte_range[0], byte_range[1] - byte_range[0] + 1
+                    headers["Content-Range"] = f"bytes {byte_range[0]}-{byte_range[1]}/{stat.st_size}"
+
+            headers["Content-Type"] = "image/jpeg"
+            headers["Content-Length"] = length
+            self._write_head(writer, status, headers, keep_alive)
+            if method == "GET" and length > 0:
+                await writer.drain()
+                # zero copy from the page cache to the socket, falls back to reading if sendfile is not available
+                await self.loop.sendfile(writer.transport, f, start, length)
+                self.bytes_sent += length
+            await writer.drain()
+
+    def _open(self, path):
+        f = open(path, "rb")
+        try:
+            return f, os.fstat(f.fileno())
+        except OSError:
+            f.close()
+            raise
+
+    def _not_modified(self, request_headers, tag, stat) -> bool:
+        if "if-none-match" in request_headers:
+            return tag in (t.strip() for t in request_headers["if-none-match"].split(",")) or request_headers["if-none-match"].strip() == "*"
+        if "if-modified-since" in request_headers:
+            try:
+                return int(stat.st_mtime) <= parsedate_to_datetime(request_headers["if-modified-since"]).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+
+SERVER = None
+
+def start_server(root, port, public_host=None) -> GalleryServer:
+    global SERVER
+    if SERVER is None:
+        SERVER = GalleryServer(root, port, public_host=public_host).start()
+    return SERVER
+
+def stop_server():
+    global SERVER
+    if SERVER is not None:
+        SERVER.stop()
+        SERVER = None
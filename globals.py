@@ -1,6 +1,9 @@
+import os
+import threading
 from dataclasses import dataclass
 from enum import Enum
 from typing import List
+from settingsStore import Setting, SettingsStore
 
 
 DEFAULT_WELCOME_MESSAGE = "Willkommen zur Fotobox"
@@ -14,10 +17,63 @@ DEFAULT_SHOW_PRINT = False
 DEFAULT_SHOW_SHARE = False
 DEFAULT_SHOW_BUTTON_TEXT = False
 DEFAULT_BACKGROUND_IMAGE = "backgrounds/Landingpage.png"
-DEFAULT_CAMERA_INDEX = 0
+DEFAULT_CAMERA_INDEX = -1                          # /dev/video<index> of the live view, -1 selects the HDMI grabber automatically
 DEFAULT_COUNTDOWN_SOUND = "ui/sounds/countdown_ping.wav"
 DEFAULT_WELCOME_TEXT_COLOR = "rgb(247, 244, 183)"
 DEFAULT_IMAGE_BORDER_COLOR = "rgb(247, 244, 183)"
+DEFAULT_PRINTER_NAME = "Dai_Nippon_Printing_DP_DS620"
+DEFAULT_PREARM_SECONDS = 1                         # focus the camera this many seconds before the countdown ends
+DEFAULT_CAMERA_BACKEND = "gphoto2"                 # "fake" simulates a camera for testing without hardware
+DEFAULT_SPECULATIVE_UPLOAD = True                  # upload photos right after capture so sharing only has to publish them
+DEFAULT_DRIVE_API_ENDPOINT = ""                    # e.g. a local fake Drive server for testing, empty uses Google
+DEFAULT_SHARE_BACKEND = "local"                    # "local" serves photos from the booth to the hotspot, "gdrive" uploads them
+DEFAULT_GALLERY_PORT = 8000
+DEFAULT_GALLERY_HOST = ""                          # address used in the QR code, empty detects it
+DEFAULT_LIVEVIEW_SOURCE = "v4l2"                   # "v4l2" reads an HDMI grabber, "gphoto2" streams the camera's own live view
+DEFAULT_LIVEVIEW_FILE = ""                         # recorded MJPEG stream played as live view instead, for testing
+DEFAULT_FILTER = "none"                            # look applied to live view and photos: "bw", "sepia", "vintage" or a .cube file in ui/filters
+DEFAULT_IMAGE_CACHE_MB = 256                       # decoded photos kept in memory, shared by preview, collage, print and share
+
+SETTINGS_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "settings.yaml")
+SETTINGS_SCHEMA = [
+    Setting("WELCOME_MESSAGE", str, DEFAULT_WELCOME_MESSAGE),
+    Setting("TARGET_DIR", str, DEFAULT_TARGET_DIR),
+    Setting("COUNTDOWN_TIME_SECONDS", int, DEFAULT_COUNTDOWN_TIME_SECONDS),
+    Setting("PREVIEW_TIME_SECONDS", int, DEFAULT_PREVIEW_TIME_SECONDS),
+    Setting("SHOW_COLLAGE", bool, DEFAULT_SHOW_COLLAGE),
+    Setting("SHOW_DELETE", bool, DEFAULT_SHOW_DELETE),
+    Setting("SHOW_RECAPTURE", bool, DEFAULT_SHOW_RECAPTURE),
+    Setting("SHOW_PRINT", bool, DEFAULT_SHOW_PRINT),
+    Setting("SHOW_SHARE", bool, DEFAULT_SHOW_SHARE),
+    Setting("SHOW_BUTTON_TEXT", bool, DEFAULT_SHOW_BUTTON_TEXT),
+    Setting("BACKGROUND_IMAGE", str, DEFAULT_BACKGROUND_IMAGE),
+    Setting("CAMERA_INDEX", int, DEFAULT_CAMERA_INDEX),
+    Setting("COUNTDOWN_SOUND", str, DEFAULT_COUNTDOWN_SOUND),
+    Setting("WELCOME_TEXT_COLOR", str, DEFAULT_WELCOME_TEXT_COLOR),
+    Setting("IMAGE_BORDER_COLOR", str, DEFAULT_IMAGE_BORDER_COLOR),
+    Setting("PRINTER_NAME", str, DEFAULT_PRINTER_NAME),
+    Setting("PREARM_SECONDS", int, DEFAULT_PREARM_SECONDS),
+    Setting("CAMERA_BACKEND", str, DEFAULT_CAMERA_BACKEND, ("gphoto2", "fake")),
+    Setting("SPECULATIVE_UPLOAD", bool, DEFAULT_SPECULATIVE_UPLOAD),
+    Setting("DRIVE_API_ENDPOINT", str, DEFAULT_DRIVE_API_ENDPOINT),
+    Setting("SHARE_BACKEND", str, DEFAULT_SHARE_BACKEND, ("local", "gdrive")),
+    Setting("GALLERY_PORT", int, DEFAULT_GALLERY_PORT),
+    Setting("GALLERY_HOST", str, DEFAULT_GALLERY_HOST),
+    Setting("LIVEVIEW_SOURCE", str, DEFAULT_LIVEVIEW_SOURCE, ("v4l2", "gphoto2")),
+    Setting("LIVEVIEW_FILE", str, DEFAULT_LIVEVIEW_FILE),
+    Setting("FILTER", str, DEFAULT_FILTER),
+    Setting("IMAGE_CACHE_MB", int, DEFAULT_IMAGE_CACHE_MB),
+]
+
+
+@dataclass
+class SessionState:
+    # state of the running booth, never written to settings.yaml
+    collage_id: int = None
+    preview_time_override: int = None                 # e.g. short previews between the photos of a collage
+
+    def preview_time(self) -> int:
+        return self.preview_time_override if self.preview_time_override is not None else SETTINGS["PREVIEW_TIME_SECONDS"]
 
 
 def init():
@@ -26,28 +82,18 @@ def init():
 
     global SETTINGS
     # Settings are read from settings.yaml. Adjust them there or in GUI by long pressing the welcome message
-    SETTINGS = {
-        "WELCOME_MESSAGE": DEFAULT_WELCOME_MESSAGE,
-        "TARGET_DIR": DEFAULT_TARGET_DIR,
-        "COUNTDOWN_TIME_SECONDS": DEFAULT_COUNTDOWN_TIME_SECONDS,
-        "PREVIEW_TIME_SECONDS": DEFAULT_PREVIEW_TIME_SECONDS,
-        "SHOW_COLLAGE": DEFAULT_SHOW_COLLAGE,
-        "SHOW_DELETE": DEFAULT_SHOW_DELETE,
-        "SHOW_RECAPTURE": DEFAULT_SHOW_RECAPTURE,
-        "SHOW_PRINT": DEFAULT_SHOW_PRINT,
-        "SHOW_SHARE": DEFAULT_SHOW_SHARE,
-        "SHOW_BUTTON_TEXT": DEFAULT_SHOW_BUTTON_TEXT,
-        "BACKGROUND_IMAGE": DEFAULT_BACKGROUND_IMAGE,
-        "CAMERA_INDEX": DEFAULT_CAMERA_INDEX,
-        "COUNTDOWN_SOUND": DEFAULT_COUNTDOWN_SOUND,
-        "BACKGROUND_IMAGE": DEFAULT_BACKGROUND_IMAGE,
-        "WELCOME_TEXT_COLOR": DEFAULT_WELCOME_TEXT_COLOR,
-        "IMAGE_BORDER_COLOR": DEFAULT_IMAGE_BORDER_COLOR
-    }
+    SETTINGS = SettingsStore(SETTINGS_FILE, SETTINGS_SCHEMA)
+
+    global SESSION
+    SESSION = SessionState()
 
     global FREEZE_STREAM
     FREEZE_STREAM = False
 
+    global STREAM_CHANGED
+    # set whenever the stream has to switch between live view and preview or the preview file changed
+    STREAM_CHANGED = threading.Event()
+
     global FILE_NAME
     FILE_NAME = ""
     
@@ -57,6 +103,11 @@ def init():
     global CURRENT_COLLAGE
     CURRENT_COLLAGE = None
     
+def set_freeze_stream(freeze):
+    global FREEZE_STREAM
+    FREEZE_STREAM = freeze
+    STREAM_CHANGED.set()
+
 class CaptureMode(Enum):
     SINGLE = 1
     COLLAGE = 2
@@ -0,0 +1,158 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from PIL import Image
+import globals
+
+JPEG_SCALES = (8, 4, 2, 1)                  # reductions the JPEG decoder does while decoding
+KEEP_SOURCES = 256
+
+
+def image_bytes(image) -> int:
+    return image.width * image.height * len(image.getbands())
+
+def jpeg_scale(source_size, size) -> int:
+    # the reduction Image.draft picks: the largest that still covers size, none for images
+    # smaller than size
+    if size is None:
+        return 1
+    fits = min(source_size[0] // max(1, size[0]), source_size[1] // max(1, size[1]))
+    return next((scale for scale in JPEG_SCALES if fits >= scale), 1)
+
+
+class ImageCache:
+    # Decoded RGB images shared by the preview, the collage and the derivatives, so a capture
+    # is decoded once per scale instead of once per consumer. Entries are keyed by path, mtime
+    # and the reduced scale the JPEG decoder used (1/1, 1/2, 1/4 or 1/8), and evicted least
+    # recently used first once they need more than budget_bytes. Images larger than the budget
+    # are decoded but not kept. Concurrent requests for the same entry wait for one decode.
+    # Cached images are shared: callers must not modify them in place.
+
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()                        # (path, mtime_ns, scale) -> Image
+        self.loading = {}                                   # (path, mtime_ns, scale) -> Future
+        self.sources = OrderedDict()                        # (path, mtime_ns) -> (size of the file's image, JPEG or not)
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.decode_seconds = 0.0
+
+    def set_budget(self, budget_bytes):
+        with self.lock:
+            self.budget_bytes = budget_bytes
+            self._evict()
+
+    def source_size(self, file_name) -> tuple:
+        # full size of the image in the file, read from the header only
+        return self._source(file_name, os.stat(file_name).st_mtime_ns)[0]
+
+    def _source(self, file_name, mtime):
+        key = (file_name, mtime)
+        with self.lock:
+            source = self.sources.get(key)
+        if source is None:
+            with Image.open(file_name) as image:
+                source = (image.size, image.format == "JPEG")
+            with self.lock:
+                self.sources[key] = source
+                while len(self.sources) > KEEP_SOURCES:
+                    self.sources.popitem(last=False)
+        return source
+
+    def get(self, file_name, size=None) -> Image.Image:
+        # RGB image of the file that covers size, decoded at the smallest scale that does;
+        # the full image if size is None
+        file_name = os.path.abspath(file_name)
+        mtime = os.stat(file_name).st_mtime_ns
+        source_size, is_jpeg = self._source(file_name, mtime)
+        scale = jpeg_scale(source_size, size) if is_jpeg else 1
+        key = (file_name, mtime, scale)
+        with self.lock:
+            image = self.entries.get(key)
+            if image is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return image
+            loading = self.loading.get(key)
+            decoding = loading is None
+            if decoding:
+                self.misses += 1
+                loading = self.loading[key] = Future()
+            else:
+                self.hits += 1
+        if not decoding:
+            return loading.result()
+
+        try:
+            image = self._decode(file_name, size)
+        except BaseException as e:
+            with self.lock:
+                del self.loading[key]
+            loading.set_exception(e)
+            raise
+        with self.lock:
+            del self.loading[key]
+            self._insert(key, image)
+        loading.set_result(image)
+        return image
+
+    def _decode(self, file_name, size):
+        start = time.perf_counter()
+        with Image.open(file_name) as image:
+            if size is not None:
+                image.draft("RGB", size)
+            decoded = image.convert("RGB")
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.decode_seconds += elapsed
+        logging.debug(f"Decoded {os.path.basename(file_name)} at {decoded.width}x{decoded.height} in {1000*elapsed:.0f} ms")
+        return decoded
+
+    def _insert(self, key, image):
+        size = image_bytes(image)
+        if size > self.budget_bytes:
+            return
+        # an older version of the file is never asked for again
+        for old in [k for k in self.entries if k[0] == key[0] and k[1] != key[1]]:
+            self._remove(old)
+        self.entries[key] = image
+        self.resident_bytes += size
+        self._evict()
+
+    def _remove(self, key):
+        self.resident_bytes -= image_bytes(self.entries.pop(key))
+
+    def _evict(self):
+        while self.resident_bytes > self.budget_bytes and self.entries:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def discard(self, file_name):
+        # e.g. the photo was deleted
+        file_name = os.path.abspath(file_name)
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == file_name]:
+                self._remove(key)
+
+    def stats(self) -> dict:
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "resident_mb": self.resident_bytes / 2**20,
+                "budget_mb": self.budget_bytes / 2**20,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else None,
+                "evictions": self.evictions,
+                "decode_seconds": self.decode_seconds,
+            }
+
+
+CACHE = ImageCache(globals.DEFAULT_IMAGE_CACHE_MB * 2**20)
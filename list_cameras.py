@@ -1,21 +1,239 @@
-import subprocess
-
-# function to detect camera index
-def list_stream_cameras():
-    CAMERA_INDEX = 0
-
-    cmd = ["/usr/bin/v4l2-ctl", "--list-devices"]
-    out, err = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-    out, err = out.strip(), err.strip()
-    for l in [i.split(b"\n\t") for i in out.split(b"\n\n")]:
-        if l == [b'']: continue
-        index = int(l[1].decode()[-1])
-        if index == 0:
-            print("Index 0 is skipped because most of the times it belongs to a webcam")
-        else:
-            print("Found Camera %s as %s" %(l[0].decode(), l[1].decode()))
-            CAMERA_INDEX = index
-
-    return CAMERA_INDEX
-
-    
\ No newline at end of file
+import fcntl
+import logging
+import os
+import struct
+from dataclasses import dataclass, field
+from typing import List
+import cv2
+
+SYSFS_VIDEO4LINUX = "/sys/class/video4linux"
+
+# ioctls and structs of linux/videodev2.h
+VIDIOC_QUERYCAP = 0x80685600                # struct v4l2_capability, 104 bytes
+VIDIOC_ENUM_FMT = 0xc0405602                # struct v4l2_fmtdesc, 64 bytes
+VIDIOC_ENUM_FRAMESIZES = 0xc02c564a         # struct v4l2_frmsizeenum, 44 bytes
+VIDIOC_ENUM_FRAMEINTERVALS = 0xc034564b     # struct v4l2_frmivalenum, 52 bytes
+CAPABILITY = struct.Struct("16s32s32sIII12x")
+FMTDESC = struct.Struct("III32sII12x")
+FRMSIZEENUM = struct.Struct("IIIIIIIII8x")
+FRMIVALENUM = struct.Struct("IIIIIIIIIII8x")
+
+V4L2_BUF_TYPE_VIDEO_CAPTURE = 1
+V4L2_CAP_VIDEO_CAPTURE = 0x00000001
+V4L2_CAP_DEVICE_CAPS = 0x80000000
+V4L2_FRMSIZE_TYPE_DISCRETE = 1
+V4L2_FRMIVAL_TYPE_DISCRETE = 1
+
+# Formats OpenCV converts itself. YUYV costs only a cheap conversion but needs 2 bytes per
+# pixel on the bus, MJPG is small on the bus but every frame has to be decoded.
+SUPPORTED_FORMATS = ("YUYV", "MJPG")
+USB_USABLE_SHARE = 0.4                      # of the nominal bus speed, isochronous transfers get less than half
+
+# HDMI grabbers are recognized by USB id or name, built-in webcams are avoided
+GRABBER_USB_IDS = {"534d:2109", "345f:2109", "345f:2130", "0fd9:0066", "0fd9:007b", "1164:f57a"}
+GRABBER_NAMES = ("hdmi", "capture", "grabber", "cam link", "usb video", "ms2109", "ms2130")
+WEBCAM_NAMES = ("integrated", "webcam", "facetime", "built-in")
+
+
+@dataclass
+class CaptureMode:
+    pixel_format: str
+    width: int
+    height: int
+    fps: float
+
+    def bytes_per_second(self) -> float:
+        # MJPG frames are compressed, about a tenth of the raw size
+        bytes_per_pixel = 2 if self.pixel_format == "YUYV" else 0.2
+        return self.width * self.height * bytes_per_pixel * self.fps
+
+    def __str__(self):
+        return f"{self.width}x{self.height} {self.pixel_format} @ {self.fps:g} fps"
+
+
+@dataclass
+class CaptureDevice:
+    path: str
+    index: int
+    name: str
+    driver: str = ""
+    bus_info: str = ""
+    usb_id: str = ""
+    usb_speed_mbps: int = 480
+    modes: List[CaptureMode] = field(default_factory=list)
+
+    def is_grabber(self) -> bool:
+        name = self.name.lower()
+        return self.usb_id in GRABBER_USB_IDS or any(n in name for n in GRABBER_NAMES)
+
+    def bus_budget(self) -> float:
+        # bytes per second UVC devices get through the port in practice
+        return self.usb_speed_mbps * 1e6 / 8 * USB_USABLE_SHARE
+
+    def __str__(self):
+        return f"{self.path} ({self.name}{', ' + self.usb_id if self.usb_id else ''})"
+
+
+def _ioctl(fd, request, packed) -> bytes:
+    buffer = bytearray(packed)
+    fcntl.ioctl(fd, request, buffer)
+    return bytes(buffer)
+
+def _text(raw) -> str:
+    return raw.split(b"\0", 1)[0].decode(errors="replace")
+
+def _fourcc(code) -> str:
+    return code.to_bytes(4, "little").decode(errors="replace")
+
+def _read_sysfs(path) -> str:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+
+def _enumerate(fd, request, layout, make):
+    # calls an VIDIOC_ENUM_* ioctl with increasing index until the driver has no more entries
+    entries = []
+    for index in range(64):
+        try:
+            entries.append(layout.unpack(_ioctl(fd, request, make(index))))
+        except OSError:
+            break
+    return entries
+
+def _frame_rates(fd, fourcc, width, height) -> List[float]:
+    rates = []
+    entries = _enumerate(fd, VIDIOC_ENUM_FRAMEINTERVALS, FRMIVALENUM,
+                         lambda i: FRMIVALENUM.pack(i, fourcc, width, height, 0, 0, 0, 0, 0, 0, 0))
+    for _, _, _, _, kind, numerator, denominator, *_ in entries:
+        # for stepwise intervals the first fraction is the shortest interval, i.e. the highest rate
+        if numerator:
+            rates.append(denominator / numerator)
+        if kind != V4L2_FRMIVAL_TYPE_DISCRETE:
+            break
+    return rates
+
+def _modes(fd) -> List[CaptureMode]:
+    modes = []
+    formats = _enumerate(fd, VIDIOC_ENUM_FMT, FMTDESC, lambda i: FMTDESC.pack(i, V4L2_BUF_TYPE_VIDEO_CAPTURE, 0, b"", 0, 0))
+    for _, _, _, _, fourcc, _ in formats:
+        pixel_format = _fourcc(fourcc)
+        if pixel_format not in SUPPORTED_FORMATS:
+            continue
+        sizes = _enumerate(fd, VIDIOC_ENUM_FRAMESIZES, FRMSIZEENUM, lambda i: FRMSIZEENUM.pack(i, fourcc, 0, 0, 0, 0, 0, 0, 0))
+        for _, _, kind, *size in sizes:
+            # of stepwise and continuous sizes only the maximum is offered
+            width, height = (size[0], size[1]) if kind == V4L2_FRMSIZE_TYPE_DISCRETE else (size[1], size[4])
+            for fps in _frame_rates(fd, fourcc, width, height):
+                modes.append(CaptureMode(pixel_format, width, height, fps))
+            if kind != V4L2_FRMSIZE_TYPE_DISCRETE:
+                break
+    return modes
+
+def probe_device(path) -> CaptureDevice:
+    # returns None if path is no video capture device, e.g. the metadata node of an UVC device
+    node = os.path.basename(path)
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+    except OSError as e:
+        logging.info(f"Unable to open {path}: {e}")
+        return None
+    try:
+        driver, card, bus_info, _, capabilities, device_caps = CAPABILITY.unpack(
+            _ioctl(fd, VIDIOC_QUERYCAP, bytes(CAPABILITY.size)))
+        if capabilities & V4L2_CAP_DEVICE_CAPS:
+            capabilities = device_caps
+        if not capabilities & V4L2_CAP_VIDEO_CAPTURE:
+            return None
+        modes = _modes(fd)
+    except OSError as e:
+        logging.info(f"{path} is no V4L2 device: {e}")
+        return None
+    finally:
+        os.close(fd)
+
+    usb_device = os.path.join(SYSFS_VIDEO4LINUX, node, "device", "..")
+    vendor, product = _read_sysfs(os.path.join(usb_device, "idVendor")), _read_sysfs(os.path.join(usb_device, "idProduct"))
+    speed = _read_sysfs(os.path.join(usb_device, "speed"))
+    return CaptureDevice(path=path, index=int(node[len("video"):]), name=_read_sysfs(os.path.join(SYSFS_VIDEO4LINUX, node, "name")) or _text(card),
+                         driver=_text(driver), bus_info=_text(bus_info), usb_id=f"{vendor}:{product}" if vendor else "",
+                         usb_speed_mbps=int(speed) if speed.isdigit() else 480, modes=modes)
+
+def probe_devices() -> List[CaptureDevice]:
+    # all video capture devices, ordered by their /dev/video number
+    try:
+        nodes = [n for n in os.listdir(SYSFS_VIDEO4LINUX) if n.startswith("video") and n[len("video"):].isdigit()]
+    except OSError:
+        return []
+    devices = []
+    for node in sorted(nodes, key=lambda n: int(n[len("video"):])):
+        device = probe_device(os.path.join("/dev", node))
+        if device is not None:
+            devices.append(device)
+    return devices
+
+
+def select_device(devices, index=-1) -> CaptureDevice:
+    # index >= 0 selects /dev/video<index>, otherwise the most likely HDMI grabber is used
+    if index >= 0:
+        for device in devices:
+            if device.index == index:
+                return device
+        logging.warning(f"/dev/video{index} is no capture device. Selecting one automatically")
+    if not devices:
+        return None
+
+    def score(device):
+        name = device.name.lower()
+        return (device.is_grabber(), not any(n in name for n in WEBCAM_NAMES), device.bus_info.startswith("usb"),
+                bool(device.modes), device.index > 0)
+    return max(devices, key=score)
+
+def choose_mode(modes, height, fps, bus_budget=480e6/8*USB_USABLE_SHARE) -> CaptureMode:
+    # The smallest frames of at least height that reach fps are enough for the display,
+    # bigger frames only cost bandwidth and scaling. YUYV is preferred where the bus can
+    # carry it, because MJPG frames have to be decoded.
+    if not modes:
+        return None
+
+    def cost(mode):
+        fast_enough = mode.fps >= fps * 0.95
+        big_enough = mode.height >= height
+        fits_bus = mode.bytes_per_second() <= bus_budget
+        return (not fits_bus, not fast_enough, not big_enough,
+                mode.height if big_enough else -mode.height,
+                mode.pixel_format != "YUYV", -mode.fps)
+    return min(modes, key=cost)
+
+
+def open_capture(device, mode, fallback_index=0):
+    # returns the opened cv2.VideoCapture and the mode it really delivers
+    if device is None or mode is None:
+        cap = cv2.VideoCapture(device.index if device is not None else fallback_index)
+    else:
+        cap = cv2.VideoCapture(device.path, cv2.CAP_V4L2)
+        # the format has to be set first, sizes and rates depend on it
+        cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*mode.pixel_format))
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, mode.width)
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, mode.height)
+        cap.set(cv2.CAP_PROP_FPS, mode.fps)
+    if not cap.isOpened():
+        return cap, CaptureMode("?", 0, 0, 0)
+    negotiated = CaptureMode(_fourcc(int(cap.get(cv2.CAP_PROP_FOURCC)) & 0xffffffff).strip("\0") or "?",
+                             int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                             cap.get(cv2.CAP_PROP_FPS))
+    return cap, negotiated
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    devices = probe_devices()
+    selected = select_device(devices)
+    for device in devices:
+        print(f"{'*' if device is selected else ' '} {device} driver {device.driver}, {device.bus_info}")
+        for mode in device.modes:
+            print(f"      {mode}")
+    if selected is not None:
+        print(f"Mode for a 840 px high live view at 25 fps: {choose_mode(selected.modes, 840, 25, selected.bus_budget())}")
@@ -0,0 +1,301 @@
+import logging
+import subprocess
+import threading
+import time
+import cv2
+import numpy as np
+import cameraSession
+import globals
+
+SOI = b"\xff\xd8"
+EOI = b"\xff\xd9"
+SOS = 0xda
+STANDALONE_MARKERS = {0x01} | set(range(0xd0, 0xd8))       # TEM and RSTn have no length
+
+
+class MjpegParser:
+    # Splits a stream of concatenated JPEG frames (gphoto2 --capture-movie --stdout) into frames.
+    # The stream is read straight into one reusable buffer. Marker segments before the image
+    # data are skipped by their length, so EXIF thumbnails do not end a frame early, and the
+    # image data is only searched for the end marker in bytes that were not searched before.
+    # Complete frames are handed to on_frame as a memoryview into the buffer, valid only
+    # during the call.
+
+    def __init__(self, on_frame, chunk_size=64*1024):
+        self.on_frame = on_frame
+        self.chunk_size = chunk_size
+        self.buffer = bytearray(4*chunk_size)
+        self.end = 0                                        # bytes in the buffer
+        self.reset()
+        self.frames = 0
+        self.garbage = 0                                    # bytes outside of frames
+
+    def reset(self):
+        self.start = None                                   # start of the current frame
+        self.position = 0                                   # everything before was parsed
+        self.in_scan = False                                # in the entropy coded data
+
+    def read_from(self, stream) -> int:
+        # reads one chunk with readinto, returns the number of bytes or 0 at the end of the stream
+        if len(self.buffer) - self.end < self.chunk_size:
+            self._compact()
+            if len(self.buffer) - self.end < self.chunk_size:
+                self.buffer.extend(bytes(len(self.buffer)))
+        with memoryview(self.buffer) as view:
+            count = stream.readinto(view[self.end:self.end + self.chunk_size]) or 0
+        self.end += count
+        self._parse()
+        return count
+
+    def feed(self, data):
+        # for streams without readinto
+        if len(self.buffer) - self.end < len(data):
+            self._compact()
+            if len(self.buffer) - self.end < len(data):
+                self.buffer.extend(bytes(len(data) + len(self.buffer)))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+        self._parse()
+
+    def _compact(self):
+        # only the unfinished frame is kept
+        keep = self.start if self.start is not None else self.position
+        if keep == 0:
+            return
+        self.buffer[:self.end - keep] = self.buffer[keep:self.end]
+        self.end -= keep
+        self.position -= keep
+        if self.start is not None:
+            self.start -= keep
+
+    def _parse(self):
+        buffer = self.buffer
+        while True:
+            if self.start is None:
+                index = buffer.find(SOI, self.position, self.end)
+                if index < 0:
+                    # a trailing 0xff may be the start of the next marker
+                    new_position = max(self.position, self.end - 1)
+                    self.garbage += new_position - self.position
+                    self.position = new_position
+                    return
+                self.garbage += index - self.position
+                self.start = index
+                self.position = index + 2
+                self.in_scan = False
+            if not self.in_scan:
+                # marker segments: 0xff, marker, 2 byte length including itself
+                while True:
+                    if self.end - self.position < 4:
+                        return
+                    if buffer[self.position] != 0xff:
+                        # not a JPEG after all, search for the next start
+                        self.start = None
+                        break
+                    marker = buffer[self.position + 1]
+                    if marker == 0xff:                      # fill byte
+                        self.position += 1
+                        continue
+                    if marker in STANDALONE_MARKERS:
+                        self.position += 2
+                        continue
+                    if marker == EOI[1]:
+                        self._frame(self.position + 2)
+                        break
+                    length = buffer[self.position + 2] << 8 | buffer[self.position + 3]
+                    if marker == SOS:
+                        self.position += 2 + length
+                        self.in_scan = True
+                        break
+                    self.position += 2 + length
+                if not self.in_scan:
+                    continue
+            # in the image data 0xff is always followed by 0x00 or RSTn, except for markers
+            # between the scans of progressive JPEGs, so 0xff 0xd9 is the end of the frame
+            index = buffer.find(EOI, self.position, self.end)
+            if index < 0:
+                self.position = max(self.position, self.end - 1)
+                return
+            self._frame(index + 2)
+
+    def _frame(self, end):
+        self.frames += 1
+        with memoryview(self.buffer) as view, view[self.start:end] as frame:
+            self.on_frame(frame)
+        self.start = None
+        self.position = end
+        self.in_scan = False
+
+
+class MjpegLiveView:
+    # Live view from a camera without HDMI output. gphoto2 streams the camera's live view as
+    # MJPEG, a reader thread splits it into frames and keeps only the newest one. Frames are
+    # decoded when the stream thread reads them, frames it does not ask for are never decoded.
+    # Behaves like the parts of cv2.VideoCapture the stream thread uses.
+    #
+    # gphoto2 can only be used by one process at a time: the stream is stopped while the
+    # camera session uses the camera and restarted once the session was idle for RESUME_SECONDS.
+    # With file, a recorded MJPEG stream is played at fps instead of using a camera.
+
+    READ_TIMEOUT_SECONDS = 1.0
+    RESUME_SECONDS = 3.0
+    RESTART_SECONDS = 2.0
+    REPORT_INTERVAL_SECONDS = 10
+
+    def __init__(self, camera_name=None, file=None, fps=25, loop=True):
+        self.camera_name = camera_name
+        self.file = file
+        self.fps = fps
+        self.loop = loop
+        self.lock = threading.Condition()
+        self.process = None
+        self.thread = None
+        self.stop_reading = threading.Event()
+        self.latest = None                                  # newest complete JPEG frame
+        self.sequence = 0                                   # number of the newest frame
+        self.read_sequence = 0                              # number of the last frame read
+        self.last_start = 0
+        self.received = 0
+        self.decoded = 0
+        self.window_start = time.monotonic()
+        self.closed = False
+        if file is None:
+            cameraSession.register_liveview(self)
+
+    def command(self):
+        args = ["gphoto2", "--capture-movie", "--stdout"]
+        camera_name = self.camera_name or globals.CURRENT_CAMERA
+        if camera_name is not None:
+            args += ["--camera", camera_name]
+        return args
+
+    def isOpened(self) -> bool:
+        return not self.closed
+
+    def _start(self) -> bool:
+        # starts the stream if it is not running, returns False while it can not be started
+        if self.thread is not None and self.thread.is_alive():
+            return True
+        if self.closed or time.monotonic() - self.last_start < self.RESTART_SECONDS:
+            return False
+        if self.file is None and not cameraSession.release_camera(self.RESUME_SECONDS):
+            return False
+        self.last_start = time.monotonic()
+        try:
+            if self.file is not None:
+                stream = open(self.file, "rb", buffering=0)
+            else:
+                logging.info(f"Starting live view: {' '.join(self.command())}")
+                self.process = subprocess.Popen(self.command(), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=0)
+                stream = self.process.stdout
+        except OSError as e:
+            logging.error(f"Unable to start live view: {e}")
+            return False
+        self.stop_reading.clear()
+        self.thread = threading.Thread(target=self._read, args=(stream,), name="mjpeg-live-view", daemon=True)
+        self.thread.start()
+        return True
+
+    def _on_frame(self, frame):
+        data = bytes(frame)                                 # the only copy of a frame
+        with self.lock:
+            self.latest = data
+            self.sequence += 1
+            self.received += 1
+            self.lock.notify_all()
+
+    def _read(self, stream):
+        parser = MjpegParser(self._on_frame)
+        interval = 1.0 / self.fps if self.file is not None else 0
+        next_frame = time.monotonic()
+        try:
+            while not self.stop_reading.is_set():
+                frames = parser.frames
+                if parser.read_from(stream) == 0:
+                    if self.file is not None and self.loop and parser.frames > 0:
+                        stream.seek(0)
+                        parser.reset()
+                        continue
+                    break
+                if interval and parser.frames != frames:
+                    # a recorded stream is played in real time
+                    next_frame += interval * (parser.frames - frames)
+                    delay = next_frame - time.monotonic()
+                    if delay > 0:
+                        self.stop_reading.wait(delay)
+                    else:
+                        next_frame = time.monotonic()
+        except (OSError, ValueError) as e:
+            if not self.stop_reading.is_set():
+                logging.error(f"Reading live view failed: {e}")
+        finally:
+            stream.close()
+        if parser.garbage:
+            logging.warning(f"Live view stream contained {parser.garbage} bytes outside of JPEG frames")
+        if not self.stop_reading.is_set():
+            logging.warning(f"Live view stream ended after {parser.frames} frames")
+        with self.lock:
+            self.lock.notify_all()
+
+    def suspend(self):
+        # gives the camera to the camera session
+        self.stop_reading.set()
+        process, self.process = self.process, None
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+            logging.info("Live view stopped, camera session takes over")
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout=2)
+        self.thread = None
+        self.last_start = 0                                 # may restart as soon as the camera is free
+
+    def grab(self) -> bool:
+        # skips the newest frame without decoding it, False if there is none
+        with self.lock:
+            if self.sequence == self.read_sequence:
+                return False
+            self.read_sequence = self.sequence
+            return True
+
+    def read(self, image=None):
+        # returns (True, BGR frame) for a frame newer than the last one read, waits up to READ_TIMEOUT_SECONDS
+        if not self._start():
+            with self.lock:
+                unread = self.sequence != self.read_sequence
+            # the last frame of a stream that ended is still shown
+            if not unread:
+                time.sleep(0.1)
+                return False, None
+        thread = self.thread
+        with self.lock:
+            if not self.lock.wait_for(lambda: self.sequence != self.read_sequence or thread is None or not thread.is_alive(),
+                                      self.READ_TIMEOUT_SECONDS) or self.sequence == self.read_sequence:
+                return False, None
+            data, self.read_sequence = self.latest, self.sequence
+        frame = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        if frame is None:
+            logging.warning("Unable to decode live view frame")
+            return False, None
+        self.decoded += 1
+        self._report()
+        return True, frame
+
+    def _report(self):
+        elapsed = time.monotonic() - self.window_start
+        if elapsed < self.REPORT_INTERVAL_SECONDS:
+            return
+        logging.info(f"MJPEG live view: {self.received/elapsed:.1f} fps received, {self.decoded/elapsed:.1f} fps decoded, "
+                     f"{self.received - self.decoded} frames skipped without decoding")
+        self.received = self.decoded = 0
+        self.window_start = time.monotonic()
+
+    def release(self):
+        self.closed = True
+        self.suspend()
+        if self.file is None:
+            cameraSession.register_liveview(None)
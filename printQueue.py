@@ -0,0 +1,287 @@
+import logging
+import re
+import subprocess
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import List
+import tracing
+
+
+class PrintError(Exception):
+    pass
+
+
+class PrintJobState(Enum):
+    QUEUED = 1
+    PRINTING = 2
+    COMPLETED = 3
+    FAILED = 4
+
+
+@dataclass
+class PrintJob:
+    id: int
+    file_name: str
+    options: List[str] = field(default_factory=list)
+    state: PrintJobState = PrintJobState.QUEUED
+    cups_id: str = None
+    attempts: int = 0
+    error: str = None
+    created: float = field(default_factory=time.monotonic)
+    submitted: float = None
+    finished: float = None
+    retry_at: float = 0.0
+    trace_id: str = None                                      # capture id the job is traced as
+
+    @property
+    def latency(self) -> float:
+        # from pressing print until the printer is done
+        if self.finished is None:
+            return None
+        return self.finished - self.created
+
+
+class PrintBackend(ABC):
+    # Talks to the print system. Status is one of "pending", "completed", "aborted" (the
+    # printer gave up, printing again is safe), "cancelled" or "unknown" (the print system
+    # forgot the job, it may well have been printed).
+
+    @abstractmethod
+    def submit(self, printer, file_name, options) -> str:
+        pass
+
+    @abstractmethod
+    def status(self, printer, job_id) -> str:
+        pass
+
+
+class CupsBackend(PrintBackend):
+    # Uses the CUPS command line tools. Other commands with the same output (e.g. a fake
+    # lp/lpstat for testing) can be passed in.
+
+    REQUEST_ID = re.compile(r"request id is (\S+)")
+    ABORTED_REASONS = {"aborted-by-system", "job-aborted-by-system"}
+
+    def __init__(self, lp="lp", lpstat="lpstat", timeout=30):
+        self.lp = lp
+        self.lpstat = lpstat
+        self.timeout = timeout
+
+    def _run(self, args) -> str:
+        try:
+            result = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=self.timeout)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            raise PrintError(f"{args[0]} failed: {e}")
+        if result.returncode != 0:
+            raise PrintError(f"{args[0]} failed: {result.stderr.decode(errors='replace').strip()}")
+        return result.stdout.decode(errors="replace")
+
+    def submit(self, printer, file_name, options) -> str:
+        out = self._run([self.lp, "-d", printer] + list(options) + [file_name])
+        match = self.REQUEST_ID.search(out)
+        if match is None:
+            raise PrintError(f"Unexpected answer from {self.lp}: {out.strip()}")
+        return match.group(1)
+
+    def _jobs(self, printer, which) -> dict:
+        # job id -> job-state-reasons, lpstat -l lists them as "Alerts:" below every job
+        out = self._run([self.lpstat, "-W", which, "-l", "-o", printer])
+        jobs = {}
+        reasons = None
+        for line in out.splitlines():
+            if not line.strip():
+                continue
+            if not line[0].isspace():
+                reasons = jobs.setdefault(line.split()[0], set())
+            elif reasons is not None and line.strip().startswith("Alerts:"):
+                reasons.update(r for r in re.split(r"[\s,]+", line.split(":", 1)[1]) if r)
+        return jobs
+
+    def status(self, printer, job_id) -> str:
+        if job_id in self._jobs(printer, "not-completed"):
+            return "pending"
+        # completed jobs include the cancelled and aborted ones
+        reasons = self._jobs(printer, "completed").get(job_id)
+        if reasons is None:
+            return "unknown"                                  # job history purged or not kept (PreserveJobHistory No)
+        if reasons & self.ABORTED_REASONS:
+            return "aborted"
+        if any(r.startswith("job-canceled") for r in reasons):
+            return "cancelled"
+        return "completed"
+
+
+class FakePrintBackend(PrintBackend):
+    # Pretends to print every job in print_seconds
+
+    def __init__(self, print_seconds=1.0, fail_every=0):
+        self.print_seconds = print_seconds
+        self.fail_every = fail_every
+        self.jobs = {}
+        self.submitted = 0
+
+    def submit(self, printer, file_name, options) -> str:
+        self.submitted += 1
+        if self.fail_every and self.submitted % self.fail_every == 0:
+            raise PrintError("Fake printer rejected the job")
+        job_id = f"{printer}-{self.submitted}"
+        self.jobs[job_id] = time.monotonic()
+        return job_id
+
+    def status(self, printer, job_id) -> str:
+        if job_id not in self.jobs:
+            return "unknown"
+        return "completed" if time.monotonic() - self.jobs[job_id] >= self.print_seconds else "pending"
+
+
+class PrintQueue:
+    # Hands print jobs to the printer in a background thread and follows them until the
+    # printer is done. At most max_in_flight jobs are sent to the printer at the same time.
+    # Jobs the printer did not accept or aborted are retried up to max_attempts times, any
+    # other job the printer accepted is never sent again, so nothing is printed twice.
+
+    LATENCY_HISTORY = 100
+
+    def __init__(self, printer, backend: PrintBackend = None, max_in_flight=1, max_attempts=3, poll_interval=2.0, job_timeout=600, retry_delay=5.0):
+        self.printer = printer
+        self.retry_delay = retry_delay
+        self.backend = backend or CupsBackend()
+        self.max_in_flight = max_in_flight
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.job_timeout = job_timeout
+        self.queued = deque()
+        self.in_flight = []
+        self.completed = 0
+        self.failed = 0
+        self.latencies = deque(maxlen=self.LATENCY_HISTORY)
+        self.next_id = 1
+        self.running = True
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name="print-queue", daemon=True)
+        self.thread.start()
+
+    def submit(self, file_name, options=(), trace_id=None) -> PrintJob:
+        with self.condition:
+            job = PrintJob(self.next_id, file_name, list(options), trace_id=trace_id)
+            self.next_id += 1
+            self.queued.append(job)
+            self.condition.notify()
+        logging.info(f"Print job {job.id} for {file_name} queued. Queue depth: {self.depth()}")
+        return job
+
+    def depth(self) -> int:
+        with self.condition:
+            return len(self.queued) + len(self.in_flight)
+
+    def stats(self) -> dict:
+        with self.condition:
+            latencies = sorted(self.latencies)
+            return {
+                "queued": len(self.queued),
+                "in_flight": len(self.in_flight),
+                "completed": self.completed,
+                "failed": self.failed,
+                "latency_avg": sum(latencies)/len(latencies) if latencies else None,
+                "latency_max": latencies[-1] if latencies else None,
+            }
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join(timeout=5)
+
+    def _due_jobs(self, now):
+        return [job for job in self.queued if job.retry_at <= now]
+
+    def _wait_timeout(self, now):
+        # sleep until a new job arrives, a retry is due or it is time to look at the printer again
+        timeouts = []
+        if len(self.in_flight) < self.max_in_flight:
+            timeouts += [job.retry_at - now for job in self.queued]
+        if self.in_flight:
+            timeouts.append(self.poll_interval)
+        return max(0, min(timeouts)) if timeouts else None
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if not self.running:
+                    return
+                now = time.monotonic()
+                if len(self._due_jobs(now)) == 0 or len(self.in_flight) >= self.max_in_flight:
+                    self.condition.wait(self._wait_timeout(now))
+                to_submit = []
+                for job in self._due_jobs(time.monotonic()):
+                    if len(self.in_flight) + len(to_submit) >= self.max_in_flight:
+                        break
+                    self.queued.remove(job)
+                    to_submit.append(job)
+                in_flight = list(self.in_flight)
+
+            # the backend is only called outside of the lock so submitting never blocks the GUI
+            for job in to_submit:
+                self._submit(job)
+            for job in in_flight:
+                self._poll(job)
+
+    def _submit(self, job: PrintJob):
+        job.attempts += 1
+        try:
+            job.cups_id = self.backend.submit(self.printer, job.file_name, job.options)
+        except PrintError as e:
+            self._failed(job, str(e))
+            return
+        job.state = PrintJobState.PRINTING
+        job.submitted = time.monotonic()
+        tracing.TRACER.record("print_handoff", job.created, job.submitted, job.trace_id, job=job.id, attempts=job.attempts)
+        with self.condition:
+            self.in_flight.append(job)
+        logging.info(f"Print job {job.id} sent to printer as {job.cups_id} after {job.submitted-job.created:.2f} s")
+
+    def _poll(self, job: PrintJob):
+        try:
+            status = self.backend.status(self.printer, job.cups_id)
+        except PrintError as e:
+            logging.warning(f"Unable to get status of print job {job.id}: {e}")
+            return
+        if status == "pending" and time.monotonic() - job.submitted <= self.job_timeout:
+            return
+        with self.condition:
+            self.in_flight.remove(job)
+        if status == "unknown":
+            logging.warning(f"Print job {job.id} is no longer known to the printer ({job.cups_id}), assuming it was printed")
+        if status in ("completed", "unknown"):
+            job.state = PrintJobState.COMPLETED
+            job.finished = time.monotonic()
+            with self.condition:
+                self.completed += 1
+                self.latencies.append(job.latency)
+            logging.info(f"Print job {job.id} printed in {job.latency:.1f} s")
+        elif status == "aborted":
+            self._failed(job, f"Printer aborted job {job.cups_id}")
+        elif status == "cancelled":
+            self._failed(job, f"Job {job.cups_id} was cancelled", retry=False)
+        else:
+            # it may still come out of the printer, sending it again could print it twice
+            self._failed(job, f"Job {job.cups_id} not printed after {self.job_timeout} s", retry=False)
+
+    def _failed(self, job: PrintJob, error, retry=True):
+        job.error = error
+        with self.condition:
+            if retry and job.attempts < self.max_attempts:
+                logging.warning(f"Print job {job.id} failed ({error}). Retrying in {self.retry_delay*job.attempts:.0f} s")
+                job.state = PrintJobState.QUEUED
+                job.retry_at = time.monotonic() + self.retry_delay*job.attempts
+                self.queued.append(job)
+                self.condition.notify()
+                return
+            job.state = PrintJobState.FAILED
+            job.finished = time.monotonic()
+            self.failed += 1
+        logging.error(f"Print job {job.id} failed after {job.attempts} attempts: {error}")
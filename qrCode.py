@@ -0,0 +1,21 @@
+import numpy as np
+import qrcode
+from PIL import Image
+
+FILL_COLOR = (247, 244, 183)
+BACK_COLOR = (42, 49, 65)
+
+
+def make_qr_image(data, size=600) -> np.ndarray:
+    # RGB array of size x size pixels in the colors of the booth
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+
+    img = qr.make_image(fill_color=FILL_COLOR, back_color=BACK_COLOR)
+    return np.array(img.resize((size, size), Image.NEAREST))
@@ -0,0 +1,157 @@
+import logging
+import os
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, List
+import yaml
+
+
+class SettingsError(ValueError):
+    pass
+
+
+@dataclass
+class Setting:
+    name: str
+    type: type
+    default: Any
+    choices: tuple = None
+
+
+def coerce(setting: Setting, value):
+    # converts values written by hand in settings.yaml (e.g. "yes" or "5") to the type of the setting
+    if setting.type is bool:
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, str) and value.strip().lower() in ("true", "yes", "on", "1", "false", "no", "off", "0"):
+            return value.strip().lower() in ("true", "yes", "on", "1")
+        if isinstance(value, int):
+            return bool(value)
+    elif setting.type in (int, float):
+        if not isinstance(value, bool):
+            try:
+                value = setting.type(value)
+            except (TypeError, ValueError):
+                pass
+            else:
+                return value
+    elif setting.type is str:
+        if value is None:
+            return ""
+        if isinstance(value, (str, int, float)) and not isinstance(value, bool):
+            value = str(value)
+            if setting.choices is None or value in setting.choices:
+                return value
+    raise SettingsError(f"Invalid value for {setting.name}: {value!r} (expected {setting.type.__name__}"
+                        + (f" out of {', '.join(setting.choices)})" if setting.choices else ")"))
+
+
+class SettingsStore:
+    # The persistent configuration of the booth, backed by settings.yaml.
+    # Values are checked against the schema when they are read or set. Subscribers are
+    # called with the names of the settings that really changed, so widgets are only
+    # restyled when something is different. The file is replaced atomically on save.
+    # Runtime state that must not end up in the file belongs in globals.SESSION.
+
+    def __init__(self, path, schema: List[Setting]):
+        self.path = path
+        self.schema: Dict[str, Setting] = {setting.name: setting for setting in schema}
+        self.values = {setting.name: setting.default for setting in schema}
+        self.extra = {}                                     # unknown keys are kept in the file
+        self.subscribers = []
+        self.lock = threading.RLock()
+
+    def __getitem__(self, name):
+        with self.lock:
+            return self.values[name]
+
+    def __contains__(self, name):
+        return name in self.values
+
+    def get(self, name, default=None):
+        with self.lock:
+            return self.values.get(name, default)
+
+    def as_dict(self) -> dict:
+        with self.lock:
+            return dict(self.values)
+
+    def subscribe(self, callback: Callable[[set], None], names: Iterable[str] = None):
+        # callback gets the set of changed names, optionally only if one of names changed
+        self.subscribers.append((callback, set(names) if names is not None else None))
+
+    def __setitem__(self, name, value):
+        self.update({name: value})
+
+    def update(self, values: dict) -> set:
+        # sets all values or none of them if one is invalid, returns the names that changed
+        with self.lock:
+            coerced = {}
+            for name, value in values.items():
+                if name not in self.schema:
+                    raise SettingsError(f"Unknown setting {name}")
+                coerced[name] = coerce(self.schema[name], value)
+            changed = {name for name, value in coerced.items() if self.values[name] != value}
+            self.values.update({name: coerced[name] for name in changed})
+        self._notify(changed)
+        return changed
+
+    def _notify(self, changed):
+        if not changed:
+            return
+        logging.info(f"Settings changed: {', '.join(sorted(changed))}")
+        # subscribers are called outside of the lock, they may read the settings
+        for callback, names in list(self.subscribers):
+            if names is None or names & changed:
+                try:
+                    callback(changed)
+                except Exception as e:
+                    logging.error(f"Settings subscriber failed: {e}")
+
+    def load(self) -> set:
+        # Reads settings.yaml. Missing or invalid values are replaced by their defaults, a missing
+        # or empty file is created with all defaults.
+        try:
+            with open(self.path) as f:
+                data = yaml.safe_load(f)
+        except FileNotFoundError:
+            logging.info("No settings file found. Creating default settings.")
+            data = None
+        except (OSError, yaml.YAMLError) as e:
+            logging.error(f"Unable to read {self.path}, using defaults: {e}")
+            return self.update({})
+        if not isinstance(data, dict):
+            data = {}
+
+        values = {}
+        for name, setting in self.schema.items():
+            if name not in data:
+                values[name] = setting.default
+                continue
+            try:
+                values[name] = coerce(setting, data[name])
+            except SettingsError as e:
+                logging.error(f"{e}, using default {setting.default!r}")
+                values[name] = setting.default
+        with self.lock:
+            self.extra = {key: value for key, value in data.items() if key not in self.schema}
+        if self.extra:
+            logging.warning(f"Unknown settings in {self.path}: {', '.join(map(str, self.extra))}")
+        changed = self.update(values)
+        if not data:
+            self.save()
+        return changed
+
+    def save(self):
+        with self.lock:
+            data = dict(self.values)
+            data.update(self.extra)
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                yaml.safe_dump(data, f, default_flow_style=False, sort_keys=False, allow_unicode=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except (OSError, yaml.YAMLError) as e:
+            logging.error(f"Unable to save settings to {self.path}: {e}")
@@ -1,17 +1,37 @@
+import json
+import logging
 import os.path
+import threading
+import time
 
+import google_auth_httplib2
+import httplib2
+from google.auth.credentials import AnonymousCredentials
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.discovery_cache import get_static_doc
 from googleapiclient.errors import HttpError
 from google.auth.exceptions import TransportError
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.http import MediaFileUpload, build_http
 
 
 # If modifying these scopes, delete the file token.json.
 SCOPES = ["https://www.googleapis.com/auth/drive"]
 SERVICE = None
+QUEUE = None
+CHUNK_SIZE = 256 * 1024                 # resumable uploads need multiples of 256 KiB
+JOURNAL_FILE = "uploads.json"
+HTTP_TIMEOUT_SECONDS = 30              # per socket operation, the library default is 60
+# everything a weak connection can throw at us
+NETWORK_ERRORS = (HttpError, TransportError, httplib2.HttpLib2Error, OSError)
+
+def is_transient(e) -> bool:
+    # errors that can go away by trying again: the network and 5xx, 408 and 429 answers
+    if isinstance(e, HttpError):
+        return e.resp.status >= 500 or e.resp.status in (408, 429)
+    return isinstance(e, NETWORK_ERRORS)
 
 def get_token():
     # The file token.json stores the user's access and refresh tokens, and is
@@ -28,7 +48,23 @@ def get_token():
     with open("token.json", "w") as token:
         token.write(creds.to_json())
 
-def get_credentials():
+def build_service(creds, api_endpoint=None):
+    # httplib2 silently resends a request whose connection dropped, but the chunk stream of
+    # the upload is already consumed then and the request only ends with the timeout
+    http = build_http()
+    http.timeout = HTTP_TIMEOUT_SECONDS
+    http = google_auth_httplib2.AuthorizedHttp(creds, http=http)
+    if not api_endpoint:
+        return build("drive", "v3", http=http)
+    # client_options only moves the host of upload urls but keeps https, so the
+    # whole root of the discovery document is replaced instead
+    document = json.loads(get_static_doc("drive", "v3"))
+    document["rootUrl"] = api_endpoint if api_endpoint.endswith("/") else api_endpoint + "/"
+    return build_from_document(document, http=http)
+
+def get_credentials(api_endpoint=None, upload_file=None):
+    # api_endpoint points the client to another server, e.g. a local fake Drive for testing.
+    # The client is created once and shared by all uploads, see UploadQueue for upload_file.
     global SERVICE
     dir_path = os.path.dirname(os.path.realpath(__file__))
     token_path = os.path.join(dir_path, "token.json")
@@ -45,20 +81,41 @@ def get_credentials():
                 return
 
         # create drive api client
-        SERVICE = build("drive", "v3", credentials=creds)
+        SERVICE = build_service(creds, api_endpoint)
+    elif api_endpoint:
+        SERVICE = build_service(AnonymousCredentials(), api_endpoint)
     else:
         print("WARNING: Please run share_gdrive.py to generate a token.json from your credentials.json if you want to use the share function")
+        return
+    start_queue(os.path.join(dir_path, JOURNAL_FILE), upload_file)
 
-def upload_image(image_path):
-    # https://developers.google.com/drive/api/guides/manage-uploads#multipart
-    file_metadata = {"name": image_path}
-    media = MediaFileUpload(image_path, mimetype="image/jpeg")
-    file = (
-        SERVICE.files()
-        .create(body=file_metadata, media_body=media, fields="id")
-        .execute()
-    )
-    return file.get("id")
+def upload_image(image_path, name=None, progress=None):
+    # https://developers.google.com/drive/api/guides/manage-uploads#resumable
+    # The file is sent in chunks. After a failure the same request continues with the
+    # chunk the server has not confirmed yet instead of starting over.
+    file_metadata = {"name": name or os.path.basename(image_path)}
+    media = MediaFileUpload(image_path, mimetype="image/jpeg", chunksize=CHUNK_SIZE, resumable=True)
+    request = SERVICE.files().create(body=file_metadata, media_body=media, fields="id")
+    response = None
+    attempt = 0
+    while response is None:
+        try:
+            # the library's own retries resend an already consumed chunk, so retries are done here:
+            # after an error the next call asks the server how much it got and continues from there
+            status, response = request.next_chunk()
+            attempt = 0
+            if status is not None and progress is not None:
+                progress(status.progress())
+        except NETWORK_ERRORS as e:
+            if not is_transient(e):
+                raise
+            attempt += 1
+            if attempt > UploadQueue.CHUNK_RETRIES:
+                raise
+            delay = UploadQueue.backoff(attempt)
+            logging.warning(f"Upload of {image_path} interrupted ({e}). Retrying in {delay:.0f} s")
+            time.sleep(delay)
+    return response.get("id")
 
 def share_image(file_id):
     SERVICE.permissions().create(body={"role":"reader", "type":"anyone"}, fileId=file_id).execute()
@@ -66,9 +123,205 @@ def share_image(file_id):
     return link
 
 def delete_image(file_id):
-    # deletion of shared images is done manually after the event
+    # shared images are deleted manually after the event, only uploads of deleted photos are removed
+    SERVICE.files().delete(fileId=file_id).execute()
+
+
+class UploadError(Exception):
     pass
 
 
+class UploadQueue:
+    # Uploads photos one after another in a background thread. Photos can be queued right
+    # after capture, they are only made public once a guest asks for the link. Every job is
+    # written to a journal, so uploads that did not finish are continued after a restart.
+    #
+    # Job states: "pending" (not uploaded), "uploaded", "shared", "delete" (upload of a deleted photo to remove)
+
+    CHUNK_RETRIES = 5
+    MAX_ATTEMPTS = 10
+    MAX_BACKOFF_SECONDS = 60
+
+    def __init__(self, journal_path, upload_file=None):
+        # upload_file maps a photo to the file that is actually sent, e.g. a smaller copy
+        self.journal_path = journal_path
+        self.upload_file = upload_file or (lambda file_name: file_name)
+        self.jobs = {}
+        self.condition = threading.Condition()
+        self.running = True
+        self._load_journal()
+        self.thread = threading.Thread(target=self._run, name="upload-queue", daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def backoff(attempt) -> float:
+        return min(UploadQueue.MAX_BACKOFF_SECONDS, 2 ** attempt)
+
+    def _load_journal(self):
+        try:
+            with open(self.journal_path) as f:
+                jobs = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.error(f"Unable to read upload journal {self.journal_path}: {e}")
+            return
+        for job in jobs:
+            job["attempts"] = 0
+            job["retry_at"] = 0
+            job["error"] = None
+            self.jobs[job["file_name"]] = job
+        pending = [j for j in self.jobs.values() if j["state"] in ("pending", "delete") or j["share"] and j["state"] != "shared"]
+        logging.info(f"Continuing {len(pending)} uploads from {self.journal_path}")
+
+    def _write_journal(self):
+        # called with the condition held, the file is replaced atomically
+        jobs = [{key: job[key] for key in ("file_name", "state", "share", "file_id", "link")} for job in self.jobs.values()]
+        tmp_path = self.journal_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(jobs, f, indent=1)
+            os.replace(tmp_path, self.journal_path)
+        except (OSError, TypeError, ValueError) as e:
+            logging.error(f"Unable to write upload journal {self.journal_path}: {e}")
+
+    def enqueue(self, file_name, share=False):
+        # starts the upload in the background, share also makes the photo public
+        with self.condition:
+            job = self.jobs.get(file_name)
+            if job is None:
+                job = {"file_name": file_name, "state": "pending", "share": share, "file_id": None, "link": None, "attempts": 0, "retry_at": 0, "error": None}
+                self.jobs[file_name] = job
+            elif share and (not job["share"] or job["attempts"] >= self.MAX_ATTEMPTS):
+                # a guest asking for the link also revives an upload that gave up
+                job["share"] = True
+                job["attempts"] = 0
+                job["retry_at"] = 0
+            else:
+                return
+            self._write_journal()
+            self.condition.notify_all()
+        logging.info(f"Upload of {file_name} queued (share: {share})")
+
+    def cancel(self, file_name):
+        # the photo was deleted, an already finished upload is removed again
+        with self.condition:
+            job = self.jobs.get(file_name)
+            if job is None:
+                return
+            if job["file_id"] is None:
+                del self.jobs[file_name]
+            else:
+                job["state"] = "delete"
+                job["share"] = False
+                job["retry_at"] = 0
+            self._write_journal()
+            self.condition.notify_all()
+
+    def wait_for_link(self, file_name, timeout) -> str:
+        # queues the photo for sharing if needed and waits until it is public
+        self.enqueue(file_name, share=True)
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                job = self.jobs.get(file_name)
+                if job is None:
+                    raise UploadError(f"Upload of {file_name} was cancelled")
+                if job["link"] is not None:
+                    return job["link"]
+                if job["attempts"] >= self.MAX_ATTEMPTS:
+                    raise UploadError(f"Upload of {file_name} failed: {job['error']}")
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise UploadError(f"Upload of {file_name} not finished after {timeout} s: {job['error'] or 'still running'}")
+                self.condition.wait(remaining)
+
+    def depth(self) -> int:
+        with self.condition:
+            return len(self._open_jobs())
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join(timeout=5)
+
+    def _open_jobs(self):
+        return [job for job in self.jobs.values()
+                if job["attempts"] < self.MAX_ATTEMPTS and (job["state"] in ("pending", "delete") or job["share"] and job["state"] != "shared")]
+
+    def _next_job(self):
+        # photos guests are waiting for come first
+        now = time.monotonic()
+        due = [job for job in self._open_jobs() if job["retry_at"] <= now]
+        due.sort(key=lambda job: not job["share"])
+        return due[0] if due else None
+
+    def _wait_timeout(self):
+        retries = [job["retry_at"] - time.monotonic() for job in self._open_jobs()]
+        return max(0, min(retries)) if retries else None
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if not self.running:
+                    return
+                job = self._next_job()
+                if job is None:
+                    self.condition.wait(self._wait_timeout())
+                    continue
+                file_name, state, share, file_id = job["file_name"], job["state"], job["share"], job["file_id"]
+
+            # the network is only used outside of the lock so queueing never blocks the GUI
+            try:
+                if state == "delete":
+                    delete_image(file_id)
+                    update = None
+                elif state == "pending":
+                    start = time.monotonic()
+                    update = {"state": "uploaded", "file_id": upload_image(self.upload_file(file_name), os.path.basename(file_name))}
+                    logging.info(f"Uploaded {file_name} in {time.monotonic()-start:.1f} s")
+                else:
+                    update = {"state": "shared", "link": share_image(file_id)}
+            except Exception as e:
+                # anything but a network problem will not go away by itself, the job is given
+                # up until a guest asks for it again
+                transient = is_transient(e)
+                with self.condition:
+                    job["attempts"] = job["attempts"] + 1 if transient else self.MAX_ATTEMPTS
+                    job["error"] = str(e)
+                    job["retry_at"] = time.monotonic() + self.backoff(job["attempts"])
+                    self.condition.notify_all()
+                if transient:
+                    logging.error(f"Upload job for {file_name} failed (attempt {job['attempts']}): {e}")
+                else:
+                    logging.exception(f"Upload job for {file_name} failed and is given up")
+                continue
+
+            with self.condition:
+                if self.jobs.get(file_name) is not job:
+                    if update is not None and update.get("file_id"):
+                        # the photo was deleted while it was uploading
+                        job.update(update, state="delete", share=False, attempts=0, retry_at=0)
+                        self.jobs[file_name] = job
+                        self._write_journal()
+                    continue
+                if update is None:
+                    del self.jobs[file_name]
+                else:
+                    job.update(update)
+                    job["attempts"] = 0
+                    job["error"] = None
+                self._write_journal()
+                self.condition.notify_all()
+
+
+def start_queue(journal_path, upload_file=None):
+    global QUEUE
+    if QUEUE is None:
+        QUEUE = UploadQueue(journal_path, upload_file)
+    return QUEUE
+
+
 if __name__ == "__main__":
     get_token()
\ No newline at end of file
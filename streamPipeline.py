@@ -0,0 +1,234 @@
+import logging
+import threading
+import time
+import cv2
+import numpy as np
+import imageCache
+
+
+class LiveViewTransform:
+    # Crops the black borders, mirrors, converts BGR->RGB and scales a capture frame.
+    # All intermediate and output buffers are allocated once and reused for every frame.
+    # Output buffers are handed out round robin, skipping buffers that are still busy
+    # (see FrameMailbox.busy), so the GUI thread never reads a frame while it is written.
+
+    def __init__(self, width, height, scale, output_buffers=3):
+        self.output_buffers = output_buffers
+        self.configure(width, height, scale)
+
+    def configure(self, width, height, scale):
+        self.width = width
+        self.height = height
+        self.scale = scale
+
+        cropped_width = int(3*height/2)                     # crop black borders of 16:9 monitor
+        width_to_crop = width-cropped_width
+        self.crop_start = int(width_to_crop/2)
+        self.crop_end = int(width-(width_to_crop/2))
+        cropped_width = self.crop_end - self.crop_start
+
+        self.scaled_width = int(cropped_width*scale)
+        self.scaled_height = int(height*scale)
+
+        # flipping and color conversion are done on the smaller of both images
+        self.convert_before_resize = scale >= 1
+        if self.convert_before_resize:
+            self.intermediate = np.empty((height, cropped_width, 3), np.uint8)
+        else:
+            self.intermediate = np.empty((self.scaled_height, self.scaled_width, 3), np.uint8)
+        self.interpolation = cv2.INTER_LINEAR if scale >= 1 else cv2.INTER_AREA
+
+        self.outputs = [np.empty((self.scaled_height, self.scaled_width, 3), np.uint8) for _ in range(self.output_buffers)]
+        self.next_output = 0
+        self.last_output = None
+
+    def apply(self, frame, busy=()) -> np.ndarray:
+        # busy are indices of output buffers that must not be written, the index of the
+        # buffer that was used is stored in last_output
+        # capture cards may ignore the requested size, adapt to what they actually deliver
+        # while keeping the size on screen
+        if frame.shape[0] != self.height or frame.shape[1] != self.width:
+            logging.info(f"Stream delivers {frame.shape[1]}x{frame.shape[0]} instead of {self.width}x{self.height}")
+            self.configure(frame.shape[1], frame.shape[0], self.scaled_height / frame.shape[0])
+
+        cropped = frame[:, self.crop_start:self.crop_end]   # view, no copy
+        index = self.next_output
+        for _ in range(len(self.outputs)):
+            if index not in busy:
+                break
+            index = (index + 1) % len(self.outputs)
+        output = self.outputs[index]
+        self.last_output = index
+        self.next_output = (index + 1) % len(self.outputs)
+
+        if self.convert_before_resize:
+            cv2.flip(cropped, 1, dst=self.intermediate)
+            cv2.cvtColor(self.intermediate, cv2.COLOR_BGR2RGB, dst=self.intermediate)
+            cv2.resize(self.intermediate, (self.scaled_width, self.scaled_height), dst=output, interpolation=self.interpolation)
+        else:
+            cv2.resize(cropped, (self.scaled_width, self.scaled_height), dst=self.intermediate, interpolation=self.interpolation)
+            cv2.flip(self.intermediate, 1, dst=output)
+            cv2.cvtColor(output, cv2.COLOR_BGR2RGB, dst=output)
+        return output
+
+
+class FramePacer:
+    # Keeps the stream loop at a target frame rate on the monotonic clock and backs off
+    # exponentially while the capture device does not deliver frames.
+
+    MIN_BACKOFF_SECONDS = 0.01
+    MAX_BACKOFF_SECONDS = 1.0
+
+    def __init__(self, target_fps):
+        self.frame_interval = 1.0 / target_fps
+        self.next_deadline = time.monotonic()
+        self.backoff = 0
+
+    def wait_for_next_frame(self):
+        now = time.monotonic()
+        if self.next_deadline > now:
+            time.sleep(self.next_deadline - now)
+            self.next_deadline += self.frame_interval
+        else:
+            # we are late, do not try to catch up with a burst of frames
+            self.next_deadline = now + self.frame_interval
+
+    def read_succeeded(self):
+        self.backoff = 0
+
+    def read_failed(self):
+        if self.backoff == 0:
+            logging.warning("Reading from stream failed. Backing off")
+            self.backoff = self.MIN_BACKOFF_SECONDS
+        else:
+            self.backoff = min(self.backoff * 2, self.MAX_BACKOFF_SECONDS)
+        time.sleep(self.backoff)
+        self.next_deadline = time.monotonic()
+
+
+class FrameStats:
+    # Measures the cost of every frame and logs a summary in a fixed interval
+
+    def __init__(self, name="Stream", report_interval_seconds=10):
+        self.name = name
+        self.report_interval = report_interval_seconds
+        self.reset()
+
+    def reset(self):
+        self.frames = 0
+        self.total_cost = 0.0
+        self.max_cost = 0.0
+        self.window_start = time.monotonic()
+
+    def add(self, cost_seconds):
+        self.frames += 1
+        self.total_cost += cost_seconds
+        self.max_cost = max(self.max_cost, cost_seconds)
+        self.last_cost = cost_seconds
+
+        elapsed = time.monotonic() - self.window_start
+        if elapsed >= self.report_interval:
+            logging.info(self.summary(elapsed))
+            self.reset()
+
+    def summary(self, elapsed=None):
+        if elapsed is None:
+            elapsed = time.monotonic() - self.window_start
+        if self.frames == 0 or elapsed <= 0:
+            return f"{self.name}: no frames"
+        return (f"{self.name}: {self.frames/elapsed:.1f} fps, "
+                f"avg {1000*self.total_cost/self.frames:.2f} ms/frame, max {1000*self.max_cost:.2f} ms/frame")
+
+
+class FrameMailbox:
+    # Hands the newest frame from the stream thread to the GUI thread. There is a single
+    # slot: a frame that was not picked up before the next one arrives is dropped instead of
+    # queued, so a slow GUI shows fewer but current frames. The consumer takes a frame,
+    # displays it and releases it, until then its buffer is reported as busy.
+
+    def __init__(self, name="Live view", report_interval_seconds=10):
+        self.name = name
+        self.report_interval = report_interval_seconds
+        self.lock = threading.Lock()
+        self.slot = None                                    # (image, buffer index, capture time)
+        self.reading = None                                 # buffer index the consumer holds
+        self.posted = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.reset_window()
+
+    def reset_window(self):
+        self.window_start = time.monotonic()
+        self.window_delivered = 0
+        self.window_dropped = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def post(self, image, buffer, captured_at) -> bool:
+        # returns True if the slot was empty, i.e. the consumer has to be notified
+        with self.lock:
+            self.posted += 1
+            was_empty = self.slot is None
+            if not was_empty:
+                self.dropped += 1
+                self.window_dropped += 1
+            self.slot = (image, buffer, captured_at)
+        return was_empty
+
+    def take(self):
+        # returns (image, capture time) of the newest frame or None
+        with self.lock:
+            if self.slot is None:
+                return None
+            image, buffer, captured_at = self.slot
+            self.slot = None
+            self.reading = buffer
+        return image, captured_at
+
+    def release(self, captured_at):
+        # the frame is on screen, its buffer can be reused
+        now = time.monotonic()
+        with self.lock:
+            self.reading = None
+            self.delivered += 1
+            self.window_delivered += 1
+            latency = now - captured_at
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+            elapsed = now - self.window_start
+            report = elapsed >= self.report_interval
+            if report:
+                summary = self.summary(elapsed)
+                self.reset_window()
+        if report:
+            logging.info(summary)
+
+    def busy(self) -> set:
+        with self.lock:
+            return {buffer for buffer in (self.reading, self.slot[1] if self.slot else None) if buffer is not None}
+
+    def counters(self) -> dict:
+        with self.lock:
+            elapsed = max(1e-6, time.monotonic() - self.window_start)
+            return {
+                "delivered": self.delivered,
+                "dropped": self.dropped,
+                "fps": self.window_delivered / elapsed,
+                "latency_avg_ms": 1000*self.latency_total/self.window_delivered if self.window_delivered else None,
+                "latency_max_ms": 1000*self.latency_max if self.window_delivered else None,
+            }
+
+    def summary(self, elapsed):
+        if self.window_delivered == 0:
+            return f"{self.name}: no frames delivered"
+        return (f"{self.name}: {self.window_delivered/elapsed:.1f} fps delivered, {self.window_dropped} dropped, "
+                f"latency avg {1000*self.latency_total/self.window_delivered:.1f} ms, max {1000*self.latency_max:.1f} ms")
+
+
+def load_preview(file_name, width, height) -> np.ndarray:
+    # Decodes an image mirrored as RGB in display size. JPEGs are decoded at a reduced
+    # scale (1/2, 1/4 or 1/8) directly by the decoder, so a 24 MP capture never has to be
+    # decoded at full resolution just to be shown on the screen.
+    image = imageCache.CACHE.get(file_name, (width, height))
+    preview = cv2.resize(np.asarray(image), (width, height), interpolation=cv2.INTER_AREA)
+    return cv2.flip(preview, 1, dst=preview)
@@ -0,0 +1,51 @@
+# python -m pytest tests
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+from PIL import Image
+from cameraSession import FakeCameraSession
+
+FOCUS_DELAY = 0.2
+TOLERANCE = 0.08                                            # sleeps overshoot on a busy machine
+
+
+def fake_session(**kwargs) -> FakeCameraSession:
+    delays = dict(focus_delay=FOCUS_DELAY, shutter_delay=0.02, transfer_delay=0.05, resolution=(320, 240))
+    delays.update(kwargs)
+    return FakeCameraSession(**delays)
+
+
+def test_capture_writes_a_jpeg_at_the_resolution(tmp_path):
+    session = fake_session()
+    file_name = str(tmp_path / "shot.jpg")
+    result = session.capture(file_name)
+    assert result.success and result.file_name == file_name
+    with Image.open(file_name) as image:
+        assert image.format == "JPEG"
+        assert image.size == (320, 240)
+        image.load()
+    assert session.shots == 1
+
+
+def test_prefocus_takes_the_focus_delay_off_the_next_capture(tmp_path):
+    session = fake_session()
+    unfocused = session.capture(str(tmp_path / "1.jpg")).duration
+    assert session.prefocus().success
+    focused = session.capture(str(tmp_path / "2.jpg")).duration
+    assert abs((unfocused - focused) - FOCUS_DELAY) < TOLERANCE
+    # focus is used up by the shot
+    assert session.capture(str(tmp_path / "3.jpg")).duration > focused + FOCUS_DELAY - TOLERANCE
+
+
+def test_shutter_time_lies_within_the_capture(tmp_path):
+    session = fake_session()
+    start = time.monotonic()
+    result = session.capture(str(tmp_path / "shot.jpg"))
+    end = time.monotonic()
+    assert start <= result.shutter_time <= end
+    # the file is transferred after the shutter
+    assert end - result.shutter_time >= session.transfer_delay
@@ -0,0 +1,92 @@
+# python -m pytest tests
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pytest
+from PyQt6.QtCore import QCoreApplication, QEventLoop, QTimer
+from countdown import CountdownScheduler
+
+INTERVAL = 0.1
+SECONDS = 5
+MAX_JITTER_MS = 30                                          # generous for a loaded test machine
+
+
+@pytest.fixture(scope="module")
+def app():
+    return QCoreApplication.instance() or QCoreApplication([])
+
+
+class Recorder:
+    def __init__(self, scheduler):
+        self.ticks = []
+        self.finished = 0
+        self.cancelled = 0
+        scheduler.tick.connect(lambda seconds, jitter: self.ticks.append((seconds, jitter)))
+        scheduler.finished.connect(self.on_finished)
+        scheduler.cancelled.connect(self.on_cancelled)
+
+    def on_finished(self):
+        self.finished += 1
+
+    def on_cancelled(self):
+        self.cancelled += 1
+
+
+def run_loop(seconds, quit_signal=None):
+    loop = QEventLoop()
+    if quit_signal is not None:
+        quit_signal.connect(loop.quit)
+    QTimer.singleShot(round(seconds * 1000), loop.quit)
+    loop.exec()
+
+
+def test_counts_down_to_zero_on_time(app):
+    scheduler = CountdownScheduler(interval_seconds=INTERVAL)
+    recorder = Recorder(scheduler)
+    scheduler.start(SECONDS)
+    run_loop(SECONDS * INTERVAL + 2, scheduler.finished)
+    assert [seconds for seconds, _ in recorder.ticks] == list(range(SECONDS, -1, -1))
+    assert recorder.finished == 1
+    assert all(jitter >= 0 for _, jitter in recorder.ticks)     # never early
+    assert scheduler.max_jitter() < MAX_JITTER_MS
+
+
+class EarlyTimerScheduler(CountdownScheduler):
+    # a timer that fires well before the deadline, like a coarse system timer
+    def _schedule_next(self):
+        remaining = self.deadline(self.ticks + 1) - time.monotonic()
+        self.timer.start(max(0, round(remaining * 1000) - 40))
+
+
+def test_early_timer_waits_for_the_deadline(app, monkeypatch):
+    # the rest is waited for on the event loop, the thread must not block
+    sleeps = []
+    monkeypatch.setattr(time, "sleep", sleeps.append)
+    scheduler = EarlyTimerScheduler(interval_seconds=INTERVAL)
+    recorder = Recorder(scheduler)
+    scheduler.start(3)
+    run_loop(3 * INTERVAL + 2, scheduler.finished)
+    assert [seconds for seconds, _ in recorder.ticks] == [3, 2, 1, 0]
+    assert sleeps == []
+    assert all(jitter >= 0 for _, jitter in recorder.ticks)
+    assert scheduler.max_jitter() < MAX_JITTER_MS
+
+
+def test_cancel_stops_ticks_and_finished(app):
+    scheduler = CountdownScheduler(interval_seconds=INTERVAL)
+    recorder = Recorder(scheduler)
+    scheduler.start(SECONDS)
+    run_loop(2.5 * INTERVAL)
+    scheduler.cancel()
+    ticks = len(recorder.ticks)
+    assert recorder.cancelled == 1
+    assert not scheduler.is_active()
+    run_loop(SECONDS * INTERVAL)
+    assert len(recorder.ticks) == ticks
+    assert recorder.finished == 0
+    scheduler.cancel()                                      # cancelling again emits nothing
+    assert recorder.cancelled == 1
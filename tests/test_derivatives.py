@@ -0,0 +1,92 @@
+# python -m pytest tests
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pytest
+from PIL import Image, ImageColor
+import globals
+from settingsStore import SettingsStore
+import collageBuilder
+import derivatives
+import filters
+
+TARGET_DIR = os.path.join("data", "images")                 # relative, like DEFAULT_TARGET_DIR
+
+
+@pytest.fixture(autouse=True)
+def settings(tmp_path, monkeypatch):
+    monkeypatch.setattr(globals, "SETTINGS", SettingsStore(str(tmp_path / "settings.yaml"), globals.SETTINGS_SCHEMA), raising=False)
+    return globals.SETTINGS
+
+
+@pytest.fixture
+def capture(tmp_path, monkeypatch):
+    # a capture in a relative TARGET_DIR below the working directory
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(TARGET_DIR)
+    file_name = os.path.join(TARGET_DIR, "photobox_1.jpg")
+    Image.new("RGB", (640, 480), (128, 128, 128)).save(file_name)
+    return file_name
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    pipeline = derivatives.DerivativePipeline(workers=1)
+    monkeypatch.setattr(derivatives, "PIPELINE", pipeline)
+    yield pipeline
+    pipeline.executor.shutdown(wait=True)
+    filters.ENGINE.executor.submit(lambda: None).result()   # the full resolution pass is done
+
+
+def test_relative_and_absolute_names_find_the_same_capture(capture, pipeline):
+    look = filters.load_look("sepia")
+    pipeline.submit(capture, look)
+    original = os.path.abspath(derivatives.derivative_path(capture, "original"))
+    for name in (capture, os.path.abspath(capture)):
+        assert pipeline.source(name) == (original, look)
+        assert pipeline.future(name, "print") is not None
+
+    pipeline.discard(os.path.abspath(capture))
+    assert pipeline.source(capture) == (capture, None)
+    assert not os.path.exists(original)
+
+
+def test_collage_slot_gets_the_look_of_its_photo(capture, pipeline, monkeypatch):
+    # the collage names slot photos relative to the program directory
+    monkeypatch.setattr(collageBuilder, "__file__", os.path.abspath("collageBuilder.py"))
+    look = filters.load_look("sepia")
+    pipeline.submit(capture, look)
+    for kind in ("print", "share", "thumbnail"):
+        pipeline.future(capture, kind).result()
+    applied = []
+    apply_look = derivatives.apply_look
+    monkeypatch.setattr(derivatives, "apply_look", lambda image, look: applied.append(look) or apply_look(image, look))
+
+    position = globals.ImagePosition(0, globals.Coordinates(0, 0), 0, 0, globals.Size(200, 150), capture)
+    collageBuilder.CollageRenderer().load_slot_image(position)
+    assert applied == [look]
+
+
+def test_print_of_a_4_by_3_collage_is_padded_not_cropped(tmp_path, settings):
+    # red left edge, blue right edge: both must still be on the print
+    file_name = str(tmp_path / "collage_1.jpg")
+    collage = Image.new("RGB", (2048, 1536), (128, 128, 128))
+    collage.paste((255, 0, 0), (0, 0, 64, 1536))
+    collage.paste((0, 0, 255), (1984, 0, 2048, 1536))
+    collage.save(file_name, quality=95)
+    with Image.open(derivatives.make_print(file_name)) as image:
+        assert image.size == derivatives.PRINT_SIZE
+        assert image.info["dpi"] == (derivatives.PRINT_DPI, derivatives.PRINT_DPI)
+        width, height = image.size
+        fitted_width = round(2048 * height / 1536)
+        left = (width - fitted_width) // 2
+        border = ImageColor.getrgb(settings["IMAGE_BORDER_COLOR"])
+        for x in (left // 2, width - left // 2):
+            assert all(abs(a - b) < 8 for a, b in zip(image.getpixel((x, height // 2)), border))
+        red = image.getpixel((left + 10, height // 2))
+        blue = image.getpixel((left + fitted_width - 10, height // 2))
+        assert red[0] > 200 and red[2] < 60
+        assert blue[2] > 200 and blue[0] < 60
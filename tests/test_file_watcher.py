@@ -0,0 +1,85 @@
+# python -m pytest tests
+import io
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pytest
+from PIL import Image
+import fileWatcher
+from fileWatcher import is_complete_file, wait_for_complete_file
+
+PAUSE = 0.3
+
+
+def jpeg_bytes() -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 48), (200, 100, 50)).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+@pytest.fixture(params=["inotify", "polling"])
+def watcher(request, monkeypatch):
+    if request.param == "inotify" and fileWatcher._libc is None:
+        pytest.skip("no inotify")
+    if request.param == "polling":
+        monkeypatch.setattr(fileWatcher, "_libc", None)
+    return request.param
+
+
+def test_waits_for_the_second_half_of_the_file(tmp_path, watcher):
+    path = str(tmp_path / "photobox_1.jpg")
+    data = jpeg_bytes()
+
+    def write():
+        # closed after each half, like a camera that transfers in two parts
+        with open(path, "wb") as f:
+            f.write(data[:len(data) // 2])
+        time.sleep(PAUSE)
+        with open(path, "ab") as f:
+            f.write(data[len(data) // 2:])
+    writer = threading.Thread(target=write)
+    start = time.monotonic()
+    writer.start()
+    try:
+        assert wait_for_complete_file(path, 5)
+        assert time.monotonic() - start >= PAUSE
+        with open(path, "rb") as f:
+            assert f.read() == data
+    finally:
+        writer.join()
+
+
+def test_zero_padding_after_the_end_of_image_is_complete(tmp_path, watcher):
+    path = str(tmp_path / "padded.jpg")
+    with open(path, "wb") as f:
+        f.write(jpeg_bytes() + b"\x00" * 1000)
+    assert is_complete_file(path)
+    assert wait_for_complete_file(path, 1)
+
+
+def test_times_out_on_a_truncated_file(tmp_path, watcher):
+    path = str(tmp_path / "truncated.jpg")
+    with open(path, "wb") as f:
+        f.write(jpeg_bytes()[:-2])
+    assert not is_complete_file(path)
+    start = time.monotonic()
+    assert not wait_for_complete_file(path, 0.2)
+    assert 0.2 <= time.monotonic() - start < 1
+
+
+def test_missing_file_times_out(tmp_path, watcher):
+    assert not wait_for_complete_file(str(tmp_path / "missing.jpg"), 0.1)
+
+
+def test_other_files_are_complete_when_not_empty(tmp_path):
+    path = str(tmp_path / "movie.mp4")
+    open(path, "wb").close()
+    assert not is_complete_file(path)
+    with open(path, "wb") as f:
+        f.write(b"x")
+    assert is_complete_file(path)
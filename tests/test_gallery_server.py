@@ -0,0 +1,126 @@
+# python -m pytest tests
+import http.client
+import os
+import sys
+from email.utils import formatdate
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pytest
+from galleryServer import GalleryServer, etag, parse_range
+
+SIZE = 1000
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, None),
+    ("", None),
+    ("bytes=0-99", (0, 99)),
+    ("bytes=990-", (990, 999)),
+    ("bytes=500-5000", (500, 999)),
+    ("bytes=999-999", (999, 999)),
+    ("bytes=-10", (990, 999)),
+    ("bytes=-5000", (0, 999)),
+    ("items=0-99", None),                                   # unknown unit
+    ("bytes=0-9,20-29", None),                              # several ranges, the whole file is sent
+    ("bytes=a-b", None),
+    ("bytes=-", None),
+    ("bytes=5", None),
+    ("bytes=1--5", None),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, SIZE) == expected
+
+
+@pytest.mark.parametrize("header, size", [
+    ("bytes=1000-", SIZE),
+    ("bytes=2000-3000", SIZE),
+    ("bytes=20-10", SIZE),
+    ("bytes=-0", SIZE),
+    ("bytes=-5", 0),
+    ("bytes=0-", 0),
+])
+def test_parse_range_not_satisfiable(header, size):
+    with pytest.raises(ValueError):
+        parse_range(header, size)
+
+
+@pytest.fixture
+def server(tmp_path):
+    with open(tmp_path / "photo.jpg", "wb") as f:
+        f.write(bytes(range(256)) * 4)                      # content does not matter, only the bytes
+    open(tmp_path / "empty.jpg", "wb").close()
+    server = GalleryServer(str(tmp_path), port=0, host="127.0.0.1").start()
+    yield server
+    server.stop()
+
+
+def get(server, path, **headers):
+    connection = http.client.HTTPConnection("127.0.0.1", server.port, timeout=5)
+    try:
+        connection.request("GET", path, headers={key.replace("_", "-"): value for key, value in headers.items()})
+        response = connection.getresponse()
+        return response.status, dict(response.getheaders()), response.read()
+    finally:
+        connection.close()
+
+
+def photo_tag(server):
+    return etag(os.stat(os.path.join(server.root, "photo.jpg")))
+
+
+def photo_date(server, offset=0):
+    return formatdate(os.stat(os.path.join(server.root, "photo.jpg")).st_mtime + offset, usegmt=True)
+
+
+@pytest.mark.parametrize("headers, status", [
+    ({}, 200),
+    ({"If-None-Match": "{tag}"}, 304),
+    ({"If-None-Match": '"other", {tag}'}, 304),
+    ({"If-None-Match": "*"}, 304),
+    ({"If-None-Match": '"other"'}, 200),
+    ({"If-Modified-Since": "{date}"}, 304),
+    ({"If-Modified-Since": "{later}"}, 304),
+    ({"If-Modified-Since": "{earlier}"}, 200),
+    ({"If-Modified-Since": "yesterday"}, 200),
+    ({"If-None-Match": '"other"', "If-Modified-Since": "{later}"}, 200),  # If-None-Match wins
+])
+def test_conditional_get(server, headers, status):
+    values = dict(tag=photo_tag(server), date=photo_date(server), later=photo_date(server, 60), earlier=photo_date(server, -60))
+    headers = {key: value.format(**values) for key, value in headers.items()}
+    response_status, response_headers, body = get(server, "/photos/photo.jpg", **headers)
+    assert response_status == status
+    assert response_headers["ETag"] == values["tag"]
+    assert len(body) == (1024 if status == 200 else 0)
+
+
+@pytest.mark.parametrize("headers, status, content_range, length", [
+    ({"Range": "bytes=0-99"}, 206, "bytes 0-99/1024", 100),
+    ({"Range": "bytes=-24"}, 206, "bytes 1000-1023/1024", 24),
+    ({"Range": "bytes=0-99", "If-Range": "{tag}"}, 206, "bytes 0-99/1024", 100),
+    ({"Range": "bytes=0-99", "If-Range": '"older"'}, 200, None, 1024),  # the file changed, all of it is sent
+    ({"Range": "bytes=-0"}, 416, "bytes */1024", 0),
+    ({"Range": "bytes=2000-"}, 416, "bytes */1024", 0),
+    ({"Range": "bytes=0-9,20-29"}, 200, None, 1024),
+])
+def test_range_get(server, headers, status, content_range, length):
+    headers = {key: value.format(tag=photo_tag(server)) for key, value in headers.items()}
+    response_status, response_headers, body = get(server, "/photos/photo.jpg", **headers)
+    assert response_status == status
+    assert response_headers.get("Content-Range") == content_range
+    assert len(body) == length
+    if status == 206:
+        start = int(content_range.split()[1].split("-")[0])
+        assert body == (bytes(range(256)) * 4)[start:start + length]
+
+
+def test_suffix_range_of_an_empty_file_is_not_satisfiable(server):
+    status, headers, body = get(server, "/photos/empty.jpg", Range="bytes=-5")
+    assert status == 416
+    assert headers["Content-Range"] == "bytes */0"
+
+
+def test_missing_and_hidden_files_are_not_found(server):
+    assert get(server, "/photos/missing.jpg")[0] == 404
+    assert get(server, "/photos/..%2Fphoto.jpg")[0] == 404
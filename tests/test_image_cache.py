@@ -0,0 +1,105 @@
+# python -m pytest tests
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pytest
+from PIL import Image
+from imageCache import ImageCache, jpeg_scale
+
+SIZE = (64, 48)
+IMAGE_BYTES = SIZE[0] * SIZE[1] * 3
+
+
+@pytest.mark.parametrize("source_size, size, scale", [
+    ((100, 100), (200, 200), 1),                            # smaller than asked for
+    ((200, 150), (200, 150), 1),
+    ((399, 300), (200, 150), 1),                            # just short of 2x
+    ((400, 300), (200, 150), 2),                            # exactly 2x
+    ((800, 300), (200, 150), 2),                            # the shorter side decides
+    ((1599, 1200), (200, 150), 4),
+    ((1600, 1200), (200, 150), 8),                          # exactly 8x
+    ((6000, 4000), (200, 150), 8),                          # never more than 8x
+    ((6000, 4000), None, 1),
+    ((6000, 4000), (0, 0), 8),
+])
+def test_jpeg_scale(source_size, size, scale):
+    assert jpeg_scale(source_size, size) == scale
+
+
+def save(path, color, size=SIZE, mtime_ns=None):
+    Image.new("RGB", size, color).save(path, quality=95)
+    if mtime_ns is not None:
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+    return str(path)
+
+
+@pytest.mark.parametrize("source_size, size, decoded_size", [
+    ((1600, 1200), (200, 150), (200, 150)),
+    ((1600, 1200), (400, 300), (400, 300)),
+    ((1600, 1200), (401, 300), (800, 600)),
+    ((150, 100), (300, 200), (150, 100)),                   # decoded at full scale, not enlarged
+])
+def test_decoded_at_the_reduced_scale(tmp_path, source_size, size, decoded_size):
+    cache = ImageCache(2**30)
+    image = cache.get(save(tmp_path / "photo.jpg", (10, 20, 30), source_size), size)
+    assert image.size == decoded_size
+    assert image.mode == "RGB"
+    assert cache.source_size(str(tmp_path / "photo.jpg")) == source_size
+
+
+def test_least_recently_used_is_evicted_first(tmp_path):
+    cache = ImageCache(2 * IMAGE_BYTES)
+    a, b, c = (save(tmp_path / f"{name}.jpg", (i * 80, 0, 0)) for i, name in enumerate("abc"))
+    first_a = cache.get(a)
+    cache.get(b)
+    assert cache.get(a) is first_a                          # hit, a is now the most recently used
+    cache.get(c)
+    stats = cache.stats()
+    assert (stats["entries"], stats["hits"], stats["misses"], stats["evictions"]) == (2, 1, 3, 1)
+    assert stats["resident_mb"] * 2**20 == 2 * IMAGE_BYTES
+    assert cache.get(a) is first_a
+    cache.get(b)                                            # was evicted, decoded again
+    assert cache.stats()["misses"] == 4
+
+
+def test_smaller_budget_evicts_right_away(tmp_path):
+    cache = ImageCache(2 * IMAGE_BYTES)
+    for name in "ab":
+        cache.get(save(tmp_path / f"{name}.jpg", (0, 0, 0)))
+    cache.set_budget(IMAGE_BYTES)
+    assert cache.stats()["entries"] == 1
+    assert cache.resident_bytes <= IMAGE_BYTES
+
+
+def test_image_larger_than_the_budget_is_not_kept(tmp_path):
+    cache = ImageCache(IMAGE_BYTES - 1)
+    path = save(tmp_path / "photo.jpg", (0, 0, 0))
+    assert cache.get(path).size == SIZE
+    assert cache.stats()["entries"] == 0
+    assert cache.resident_bytes == 0
+
+
+def test_changed_file_is_decoded_again(tmp_path):
+    cache = ImageCache(2**30)
+    path = save(tmp_path / "photo.jpg", (255, 0, 0), mtime_ns=1_000_000_000)
+    assert cache.get(path).getpixel((0, 0))[0] > 200
+    # same size, other content, only the modification time tells them apart
+    save(tmp_path / "photo.jpg", (0, 0, 255), mtime_ns=2_000_000_000)
+    image = cache.get(path)
+    assert image.getpixel((0, 0))[2] > 200
+    assert cache.stats()["misses"] == 2
+    assert list(cache.entries) == [(path, 2_000_000_000, 1)]   # the old version is dropped
+    assert cache.resident_bytes == IMAGE_BYTES
+
+
+def test_relative_and_absolute_names_share_an_entry(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cache = ImageCache(2**30)
+    save(tmp_path / "photo.jpg", (0, 0, 0))
+    assert cache.get("photo.jpg") is cache.get(str(tmp_path / "photo.jpg"))
+    cache.discard("photo.jpg")
+    assert cache.stats()["entries"] == 0
+    assert cache.resident_bytes == 0
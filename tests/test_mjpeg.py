@@ -0,0 +1,92 @@
+# python -m pytest tests
+import io
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+import cv2
+import numpy as np
+import pytest
+from mjpegLiveView import EOI, SOI, MjpegLiveView, MjpegParser
+
+FRAMES = 6
+GARBAGE = b"garbage\xff\x00\xffjunk"                        # between frames, no start of image in it
+
+
+def jpeg(value, size=(64, 48)) -> bytes:
+    image = np.full((size[1], size[0], 3), value, np.uint8)
+    return cv2.imencode(".jpg", image)[1].tobytes()
+
+
+def with_thumbnail(frame) -> bytes:
+    # an EXIF segment right after the start with a complete JPEG inside, like cameras send
+    thumbnail = jpeg(0, (16, 12))
+    payload = b"Exif\x00\x00" + thumbnail
+    return frame[:2] + b"\xff\xe1" + (len(payload) + 2).to_bytes(2, "big") + payload + frame[2:]
+
+
+def frames():
+    return [with_thumbnail(jpeg(40 * i)) if i % 2 else jpeg(40 * i) for i in range(FRAMES)]
+
+
+def stream(frames) -> bytes:
+    return GARBAGE + GARBAGE.join(frames) + GARBAGE
+
+
+def parse(data, chunk_size):
+    received = []
+    parser = MjpegParser(lambda frame: received.append(bytes(frame)), chunk_size=64)
+    for i in range(0, len(data), chunk_size):
+        parser.feed(data[i:i + chunk_size])
+    return parser, received
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 97, 4096])
+def test_frames_are_found_in_odd_chunks(chunk_size):
+    expected = frames()
+    parser, received = parse(stream(expected), chunk_size)
+    assert parser.frames == FRAMES
+    assert received == expected
+    assert all(frame.startswith(SOI) and frame.endswith(EOI) for frame in received)
+    assert parser.garbage == (FRAMES + 1) * len(GARBAGE) - 1   # the last byte could start a marker
+
+
+@pytest.mark.parametrize("chunk_size", [97, 1000])
+def test_read_from_a_stream(chunk_size):
+    expected = frames()
+    received = []
+    parser = MjpegParser(lambda frame: received.append(bytes(frame)), chunk_size=chunk_size)
+    data = io.BytesIO(stream(expected))
+    while parser.read_from(data):
+        pass
+    assert received == expected
+    assert parser.garbage == (FRAMES + 1) * len(GARBAGE) - 1
+
+
+def test_truncated_frame_is_not_delivered():
+    expected = frames()
+    parser, received = parse(b"".join(expected)[:-10], 97)
+    assert received == expected[:-1]
+
+
+def test_live_view_decodes_only_the_newest_frame(tmp_path):
+    path = str(tmp_path / "liveview.mjpeg")
+    expected = frames()
+    with open(path, "wb") as f:
+        f.write(stream(expected))
+    view = MjpegLiveView(file=path, fps=200, loop=False)
+    try:
+        assert view._start()
+        view.thread.join(5)                                  # all frames are received, none is read
+        assert view.received == FRAMES and view.decoded == 0
+        success, frame = view.read()
+        assert success
+        newest = cv2.imdecode(np.frombuffer(expected[-1], np.uint8), cv2.IMREAD_COLOR)
+        assert np.array_equal(frame, newest)
+        assert view.decoded == 1
+        assert view.read() == (False, None)                 # nothing newer, nothing decoded
+        assert view.decoded == 1
+    finally:
+        view.release()
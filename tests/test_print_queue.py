@@ -0,0 +1,146 @@
+# python -m pytest tests
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pytest
+from printQueue import CupsBackend, PrintJobState, PrintQueue
+
+PRINTER = "DNP"
+BIN_DIR = os.path.join(ROOT, "tests", "bin")                # fake lp and lpstat
+
+
+class FakeCups:
+    # the state file shared with tests/bin/lp and tests/bin/lpstat
+    def __init__(self, path):
+        self.path = path
+        self.write({"next_id": 1, "reject": 0, "submitted": [], "jobs": {}})
+
+    def read(self) -> dict:
+        with open(self.path) as f:
+            return json.load(f)
+
+    def write(self, state):
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(self.path + ".tmp", self.path)
+
+    def update(self, **changes):
+        state = self.read()
+        state.update(changes)
+        self.write(state)
+
+    def finish(self, job_id, reasons="job-completed-successfully"):
+        state = self.read()
+        state["jobs"][job_id] = reasons
+        self.write(state)
+
+    def submitted(self) -> list:
+        return self.read()["submitted"]
+
+
+@pytest.fixture
+def cups(tmp_path, monkeypatch):
+    monkeypatch.setenv("PATH", BIN_DIR + os.pathsep + os.environ["PATH"])
+    monkeypatch.setenv("FAKE_CUPS_STATE", str(tmp_path / "cups.json"))
+    return FakeCups(str(tmp_path / "cups.json"))
+
+
+@pytest.fixture
+def make_queue():
+    queues = []
+    def make_queue(**kwargs):
+        options = dict(poll_interval=0.05, retry_delay=0.05)
+        options.update(kwargs)
+        queues.append(PrintQueue(PRINTER, CupsBackend(), **options))
+        return queues[-1]
+    yield make_queue
+    for queue in queues:
+        queue.close()
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+def test_accepted_job_that_fails_later_is_not_sent_again(cups, make_queue):
+    queue = make_queue()
+    job = queue.submit("photo.jpg")
+    assert wait_until(lambda: job.state is PrintJobState.PRINTING)
+    assert job.cups_id == "DNP-1"
+    cups.finish("DNP-1", "job-canceled-at-device")
+    assert wait_until(lambda: job.state is PrintJobState.FAILED)
+    time.sleep(0.3)                                         # longer than poll_interval and retry_delay
+    assert cups.submitted() == ["photo.jpg"]
+    assert job.attempts == 1
+    assert queue.stats()["failed"] == 1
+
+
+def test_aborted_job_is_printed_again(cups, make_queue):
+    queue = make_queue()
+    job = queue.submit("photo.jpg")
+    assert wait_until(lambda: job.cups_id == "DNP-1")
+    cups.finish("DNP-1", "aborted-by-system")
+    assert wait_until(lambda: job.cups_id == "DNP-2")
+    cups.finish("DNP-2")
+    assert wait_until(lambda: job.state is PrintJobState.COMPLETED)
+    assert cups.submitted() == ["photo.jpg", "photo.jpg"]
+
+
+def test_rejected_job_is_retried_up_to_max_attempts(cups, make_queue):
+    cups.update(reject=10)
+    queue = make_queue(max_attempts=3)
+    job = queue.submit("photo.jpg")
+    assert wait_until(lambda: job.state is PrintJobState.FAILED)
+    assert job.attempts == 3
+    assert "not available" in job.error
+    time.sleep(0.3)
+    assert len(cups.submitted()) == 3
+
+
+def test_rejected_job_is_printed_once_accepted(cups, make_queue):
+    cups.update(reject=1)
+    queue = make_queue(max_attempts=3)
+    job = queue.submit("photo.jpg")
+    assert wait_until(lambda: job.state is PrintJobState.PRINTING)
+    assert job.attempts == 2
+    cups.finish(job.cups_id)
+    assert wait_until(lambda: job.state is PrintJobState.COMPLETED)
+
+
+def test_job_timeout_gives_up_without_printing_again(cups, make_queue):
+    queue = make_queue(job_timeout=0.3)
+    job = queue.submit("photo.jpg")
+    assert wait_until(lambda: job.state is PrintJobState.FAILED)
+    assert job.finished - job.submitted >= 0.3
+    assert "not printed after" in job.error
+    time.sleep(0.3)
+    assert cups.submitted() == ["photo.jpg"]
+
+
+def test_depth_and_stats(cups, make_queue):
+    queue = make_queue(max_in_flight=1)
+    jobs = [queue.submit(f"photo_{i}.jpg") for i in range(3)]
+    assert wait_until(lambda: jobs[0].state is PrintJobState.PRINTING)
+    assert queue.depth() == 3
+    stats = queue.stats()
+    assert (stats["queued"], stats["in_flight"], stats["completed"], stats["failed"]) == (2, 1, 0, 0)
+    assert stats["latency_avg"] is None
+
+    for i, job in enumerate(jobs):
+        assert wait_until(lambda: job.state is PrintJobState.PRINTING)
+        cups.finish(f"DNP-{i+1}")
+        assert wait_until(lambda: job.state is PrintJobState.COMPLETED)
+    assert queue.depth() == 0
+    stats = queue.stats()
+    assert (stats["queued"], stats["in_flight"], stats["completed"], stats["failed"]) == (0, 0, 3, 0)
+    assert 0 < stats["latency_avg"] <= stats["latency_max"] == max(job.latency for job in jobs)
@@ -0,0 +1,116 @@
+# python -m pytest tests
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pytest
+import yaml
+import globals
+from settingsStore import Setting, SettingsError, SettingsStore, coerce
+
+SHOW_PRINT = Setting("SHOW_PRINT", bool, True)
+CAMERA_BACKEND = Setting("CAMERA_BACKEND", str, "gphoto2", ("gphoto2", "fake"))
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SettingsStore(str(tmp_path / "settings.yaml"), globals.SETTINGS_SCHEMA)
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("yes", True), ("Yes ", True), ("on", True), ("1", True), ("true", True),
+    ("0", False), ("no", False), ("OFF", False), ("false", False),
+    (True, True), (False, False), (1, True), (0, False),
+])
+def test_coerce_bool(value, expected):
+    assert coerce(SHOW_PRINT, value) is expected
+
+
+@pytest.mark.parametrize("value", ["maybe", "", None, 1.5])
+def test_coerce_rejects_other_bools(value):
+    with pytest.raises(SettingsError):
+        coerce(SHOW_PRINT, value)
+
+
+def test_coerce_numbers_and_strings():
+    assert coerce(Setting("COUNTDOWN_TIME_SECONDS", int, 5), "7") == 7
+    assert coerce(Setting("WELCOME_MESSAGE", str, ""), 42) == "42"
+    assert coerce(Setting("WELCOME_MESSAGE", str, ""), None) == ""
+    with pytest.raises(SettingsError):
+        coerce(Setting("COUNTDOWN_TIME_SECONDS", int, 5), True)
+    with pytest.raises(SettingsError):
+        coerce(Setting("COUNTDOWN_TIME_SECONDS", int, 5), "soon")
+
+
+def test_coerce_rejects_a_choice_that_is_not_offered():
+    assert coerce(CAMERA_BACKEND, "fake") == "fake"
+    with pytest.raises(SettingsError, match="gphoto2, fake"):
+        coerce(CAMERA_BACKEND, "foo")
+
+
+def test_invalid_choice_in_the_file_falls_back_to_the_default(store):
+    with open(store.path, "w") as f:
+        yaml.safe_dump({"CAMERA_BACKEND": "foo", "SHOW_PRINT": "yes"}, f)
+    store.load()
+    assert store["CAMERA_BACKEND"] == globals.DEFAULT_CAMERA_BACKEND
+    assert store["SHOW_PRINT"] is True
+
+
+def test_update_is_all_or_nothing(store):
+    with pytest.raises(SettingsError):
+        store.update({"SHOW_PRINT": True, "CAMERA_BACKEND": "foo"})
+    assert store["SHOW_PRINT"] is globals.DEFAULT_SHOW_PRINT
+    with pytest.raises(SettingsError):
+        store["NO_SUCH_SETTING"] = 1
+
+
+def test_subscribers_are_only_notified_of_real_changes(store):
+    calls = []
+    border = []
+    store.subscribe(calls.append)
+    store.subscribe(border.append, ["IMAGE_BORDER_COLOR"])
+    assert store.update({"SHOW_PRINT": globals.DEFAULT_SHOW_PRINT}) == set()
+    store["COUNTDOWN_TIME_SECONDS"] = str(globals.DEFAULT_COUNTDOWN_TIME_SECONDS)    # same value once coerced
+    assert calls == []
+
+    assert store.update({"SHOW_PRINT": "yes", "COUNTDOWN_TIME_SECONDS": 9}) == {"SHOW_PRINT", "COUNTDOWN_TIME_SECONDS"}
+    assert calls == [{"SHOW_PRINT", "COUNTDOWN_TIME_SECONDS"}]
+    assert border == []
+    store["IMAGE_BORDER_COLOR"] = "red"
+    assert border == [{"IMAGE_BORDER_COLOR"}]
+    assert len(calls) == 2
+
+
+def test_failing_subscriber_does_not_stop_the_others(store):
+    def fail(changed):
+        raise RuntimeError("broken widget")
+    calls = []
+    store.subscribe(fail)
+    store.subscribe(calls.append)
+    store["SHOW_PRINT"] = True
+    assert calls == [{"SHOW_PRINT"}]
+
+
+def test_unknown_keys_are_kept_through_save(store):
+    with open(store.path, "w") as f:
+        yaml.safe_dump({"SHOW_PRINT": True, "OLD_SETTING": "keep me", "NESTED": {"a": 1}}, f)
+    store.load()
+    assert "OLD_SETTING" not in store
+    store["COUNTDOWN_TIME_SECONDS"] = 3
+    store.save()
+    with open(store.path) as f:
+        data = yaml.safe_load(f)
+    assert data["OLD_SETTING"] == "keep me"
+    assert data["NESTED"] == {"a": 1}
+    assert data["SHOW_PRINT"] is True
+    assert data["COUNTDOWN_TIME_SECONDS"] == 3
+    assert not os.path.exists(store.path + ".tmp")
+
+
+def test_missing_file_is_created_with_the_defaults(store):
+    store.load()
+    with open(store.path) as f:
+        data = yaml.safe_load(f)
+    assert data == {setting.name: setting.default for setting in globals.SETTINGS_SCHEMA}
@@ -0,0 +1,223 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
+
+TRACE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "cache", "traces")
+
+
+@dataclass
+class Span:
+    stage: str
+    session: int
+    start: float                                            # monotonic
+    end: float = None
+    thread: str = ""
+    args: dict = field(default_factory=dict)
+
+    @property
+    def duration(self) -> float:
+        return None if self.end is None else self.end - self.start
+
+
+@dataclass
+class Session:
+    id: int
+    start: float
+    capture_id: str = None
+    stages: dict = field(default_factory=dict)              # stage -> seconds, for the summary in the log
+
+    @property
+    def name(self) -> str:
+        return self.capture_id or f"session {self.id}"
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[round(q * (len(values) - 1))] if values else None
+
+
+class Tracer:
+    # Records how long every stage of a capture takes, from the button press to the print or
+    # upload hand-off. Every capture is a session, identified by the capture id of its photo as
+    # soon as it is known. Spans can begin and end in different threads, they are found by
+    # stage and session. Keeps rolling p50/p95 per stage and exports everything in the Chrome
+    # trace format (chrome://tracing or https://ui.perfetto.dev), one row per session.
+
+    MAX_SPANS = 5000
+    MAX_SESSIONS = 500
+    STATS_WINDOW = 200                                      # durations per stage the percentiles are computed of
+
+    def __init__(self, trace_file=None):
+        self.trace_file = trace_file
+        self.lock = threading.Lock()
+        self.origin = time.monotonic()
+        self.spans = deque(maxlen=self.MAX_SPANS)
+        self.open = {}                                      # (session, stage) -> Span
+        self.durations = {}                                 # stage -> deque of seconds
+        self.sessions = OrderedDict()                       # id -> Session
+        self.by_capture = {}                                # capture id -> session id
+        self.current = None
+        self.next_session = 1
+        self.exporter = ThreadPoolExecutor(max_workers=1, thread_name_prefix="trace-export")
+
+    def _new_session(self, capture_id=None) -> Session:
+        session = Session(self.next_session, time.monotonic(), capture_id)
+        self.next_session += 1
+        self.sessions[session.id] = session
+        if capture_id is not None:
+            self.by_capture[capture_id] = session.id
+        while len(self.sessions) > self.MAX_SESSIONS:
+            _, old = self.sessions.popitem(last=False)
+            self.by_capture.pop(old.capture_id, None)
+        return session
+
+    def _session(self, capture_id) -> Session:
+        # capture_id None is the current session, unknown capture ids get a session of their own
+        if capture_id is None:
+            if self.current is None:
+                self.current = self._new_session()
+            return self.current
+        session_id = self.by_capture.get(capture_id)
+        if session_id is not None and session_id in self.sessions:
+            return self.sessions[session_id]
+        return self._new_session(capture_id)
+
+    def start_session(self) -> int:
+        # a guest pressed the button, following spans without capture id belong to this session
+        with self.lock:
+            previous = self.current
+            self.current = self._new_session()
+            session_id = self.current.id
+        if previous is not None and previous.stages:
+            self._log_session(previous)
+        self.export()
+        return session_id
+
+    def set_capture_id(self, capture_id, session_id=None):
+        with self.lock:
+            session = self.sessions.get(session_id) if session_id is not None else self._session(None)
+            if session is None:
+                return
+            session.capture_id = capture_id
+            self.by_capture[capture_id] = session.id
+
+    def begin(self, stage, capture_id=None, **args):
+        now = time.monotonic()
+        with self.lock:
+            session = self._session(capture_id)
+            self.open[(session.id, stage)] = Span(stage, session.id, now, thread=threading.current_thread().name, args=args)
+
+    def end(self, stage, capture_id=None, **args) -> float:
+        # returns the duration or None if the stage was not begun
+        now = time.monotonic()
+        with self.lock:
+            session = self._session(capture_id)
+            span = self.open.pop((session.id, stage), None)
+            if span is None:
+                return None
+            span.end = now
+            span.args.update(args)
+            self._add(span, session)
+        return span.duration
+
+    def record(self, stage, start, end, capture_id=None, **args):
+        # a span measured elsewhere, start and end are monotonic times
+        with self.lock:
+            session = self._session(capture_id)
+            self._add(Span(stage, session.id, start, end, threading.current_thread().name, args), session)
+
+    @contextmanager
+    def span(self, stage, capture_id=None, **args):
+        self.begin(stage, capture_id, **args)
+        try:
+            yield
+        finally:
+            self.end(stage, capture_id)
+
+    def instant(self, name, capture_id=None, **args):
+        now = time.monotonic()
+        with self.lock:
+            session = self._session(capture_id)
+            self.spans.append(Span(name, session.id, now, now, threading.current_thread().name, args))
+
+    def _add(self, span, session):
+        self.spans.append(span)
+        session.stages[span.stage] = session.stages.get(span.stage, 0.0) + span.duration
+        self.durations.setdefault(span.stage, deque(maxlen=self.STATS_WINDOW)).append(span.duration)
+
+    def end_session(self, capture_id=None):
+        # records the time from the button press until now as "total" and logs the session
+        with self.lock:
+            session = self._session(capture_id)
+            now = time.monotonic()
+            self._add(Span("total", session.id, session.start, now, threading.current_thread().name), session)
+        self._log_session(session)
+
+    def stats(self) -> dict:
+        # stage -> rolling count, p50, p95 and max in milliseconds
+        with self.lock:
+            durations = {stage: list(values) for stage, values in self.durations.items()}
+        return {stage: {"count": len(values),
+                        "p50_ms": 1000*percentile(values, 0.5),
+                        "p95_ms": 1000*percentile(values, 0.95),
+                        "max_ms": 1000*max(values)} for stage, values in durations.items() if values}
+
+    def _log_session(self, session):
+        with self.lock:
+            stages = dict(session.stages)
+            session.stages.clear()
+        if not stages:
+            return
+        logging.info(f"Trace {session.name}: " + ", ".join(f"{stage} {1000*seconds:.0f} ms" for stage, seconds in stages.items()))
+        logging.info("Trace p50/p95: " + ", ".join(f"{stage} {s['p50_ms']:.0f}/{s['p95_ms']:.0f} ms" for stage, s in self.stats().items()))
+
+    def chrome_trace(self) -> dict:
+        with self.lock:
+            spans = list(self.spans)
+            names = {session.id: session.name for session in self.sessions.values()}
+        pid = os.getpid()
+        events = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": "photobox"}}]
+        for session_id in sorted({span.session for span in spans}):
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": session_id,
+                           "args": {"name": names.get(session_id, f"session {session_id}")}})
+        for span in spans:
+            event = {"name": span.stage, "cat": "capture", "pid": pid, "tid": span.session,
+                     "ts": round(1e6*(span.start - self.origin)), "args": dict(span.args, thread=span.thread)}
+            if span.end == span.start:
+                event.update(ph="i", s="t")
+            else:
+                event.update(ph="X", dur=round(1e6*(span.end - span.start)))
+            events.append(event)
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def _write(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+        os.replace(tmp_path, path)
+
+    def export(self, path=None):
+        # written in the background, the button press that triggers it must not wait for the disk
+        path = path or self.trace_file
+        if path is None:
+            return None
+        future = self.exporter.submit(self._write, path)
+        future.add_done_callback(lambda f: f.exception() and logging.error(f"Unable to write trace {path}: {f.exception()}"))
+        return future
+
+    def close(self):
+        if self.current is not None:
+            self._log_session(self.current)
+        self.export()
+        self.exporter.shutdown(wait=True)
+
+
+TRACER = Tracer(os.path.join(TRACE_DIR, f"trace_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"))